@@ -41,6 +41,8 @@ class Error:
 
     class Interrupted(LiveStatusClientError):
         pass
+    class ResponseAborted(LiveStatusClientError):
+        ''' When a streamed response fails after a part of it has been sent '''
 
     client_error = ClientError('Error on communication channel')
     client_left = ClientLeft('Client closed connection')
@@ -205,8 +207,19 @@ class LiveStatusClientThread(threading.Thread):
     def send_response(self, response):
         if not isinstance(response, LiveStatusListResponse):
             response = [response]
-        for data in response:
-            self._send_data(data)
+        sent = False
+        try:
+            for data in response:
+                self._send_data(data)
+                sent = sent or bool(data)
+        except LiveStatusQueryError as err:
+            if not sent:
+                raise
+            # The response status has already been sent, the client can
+            # only know the response is incomplete by the connection
+            # being closed, which ending the client thread does
+            raise Error.ResponseAborted(
+                'Streamed response aborted after being partly sent: %s' % (err,))
 
     def request_stop(self):
         self.stop_requested = True
@@ -27,43 +27,63 @@ import time
 
 
 class LiveStatusCounters:  # (LiveStatus):
+
+    # Names of the event counters. Each of them has a matching `<name>_rate`
+    # pseudo counter giving the averaged number of events per second.
+    names = (
+        'neb_callbacks',
+        'connections',
+        'service_checks',
+        'host_checks',
+        'forks',
+        'log_message',
+        'external_commands',
+        # Brok ingestion into the mongo backend
+        'broks',
+        'bulk_writes',
+        'bulk_operations',
+        'object_updates',
+        'object_writes',
+        'object_skips',
+        'side_skips',
+        'log_flushes',
+        'log_flush_time',
+        # Staged ingestion pipeline, items processed by each stage and
+        # number of times a stage had to wait for the next one
+        'pipeline_decoded',
+        'pipeline_normalized',
+        'pipeline_written',
+        'pipeline_stalls',
+        # Query plans cache
+        'query_plan_hits',
+        'query_plan_misses',
+        # Stats queries answered from the in memory tactical overview
+        # counters, or that had to be answered by an aggregation
+        'overview_hits',
+        'overview_fallbacks',
+        # Responses rows formatted by chunks, including while being sent,
+        # and streamed responses that failed
+        'response_chunks',
+        'response_rows',
+        'response_format_time',
+        'response_errors',
+    )
+
     def __init__(self):
         self.lock = threading.Lock()
-        self.counters = {
-            'neb_callbacks': 0,
-            'connections': 0,
-            'service_checks': 0,
-            'host_checks': 0,
-            'forks': 0,
-            'log_message': 0,
-            'external_commands': 0
-        }
-        self.last_counters = {
-            'neb_callbacks': 0,
-            'connections': 0,
-            'service_checks': 0,
-            'host_checks': 0,
-            'forks': 0,
-            'log_message': 0,
-            'external_commands': 0
-        }
-        self.rate = {
-            'neb_callbacks': 0.0,
-            'connections': 0.0,
-            'service_checks': 0.0,
-            'host_checks': 0.0,
-            'forks': 0.0,
-            'log_message': 0.0,
-            'external_commands': 0.0
-        }
+        self.counters = dict([(name, 0) for name in self.names])
+        self.last_counters = dict([(name, 0) for name in self.names])
+        self.rate = dict([(name, 0.0) for name in self.names])
         self.last_update = 0
         self.interval = 10
         self.rating_weight = 0.25
+        # Instant values, computed when read
+        self.gauges = {}
 
-    def increment(self, counter):
+    def increment(self, counter, value=1):
         if counter in self.counters:
             with self.lock:
-                self.counters[counter] += 1
+                self.counters[counter] += value
 
     def calc_rate(self):
         with self.lock:
@@ -83,8 +103,17 @@ class LiveStatusCounters:  # (LiveStatus):
                     self.rate[counter] = avg_rate
                     self.last_counters[counter] = self.counters[counter]
 
+    def register_gauge(self, name, function):
+        """
+        Registers an instant value, such as a queue depth, read through
+        `count()` by calling `function`.
+        """
+        self.gauges[name] = function
+
     def count(self, counter):
-        if counter in self.counters:
+        if counter in self.gauges:
+            return self.gauges[counter]()
+        elif counter in self.counters:
             return self.counters[counter]
         elif counter.endswith('_rate'):
             if counter[0:-5] in self.rate:
@@ -93,3 +122,13 @@ class LiveStatusCounters:  # (LiveStatus):
                 return 0.0
         else:
             return 0
+
+    def average(self, counter, divisor):
+        """
+        Returns the average value of `counter` per `divisor` event, for
+        instance the average number of operations per bulk write.
+        """
+        with self.lock:
+            if not self.counters.get(divisor):
+                return 0.0
+            return float(self.counters[counter]) / self.counters[divisor]
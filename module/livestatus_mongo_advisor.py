@@ -0,0 +1,389 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import hashlib
+
+from pymongo import IndexModel
+
+
+class QueryShape(object):
+    """
+    The attributes a query filters, sorts and groups a collection by
+
+    :param str collection: The queried collection
+    :param tuple equalities: The attributes compared to a value
+    :param tuple sort: The (attribute, direction) the results are sorted by
+    :param tuple ranges: The attributes compared to a range of values
+    :param tuple groups: The attributes the results are grouped by
+    :param dict sample: A filter on the shape attributes, from the last
+                        recorded query
+    """
+
+    def __init__(self, collection, equalities, sort, ranges, groups, sample):
+        self.collection = collection
+        self.equalities = equalities
+        self.sort = sort
+        self.ranges = ranges
+        self.groups = groups
+        self.sample = sample
+        self.key = (collection, equalities, sort, ranges, groups)
+
+    def get_index_keys(self):
+        """
+        Returns the keys of the index serving the shape, with the
+        equality attributes first, then the sort and the range ones
+        (Equality, Sort, Range rule), grouping attributes completing the
+        index so that it covers them
+
+        :rtype: list
+        :return: The (attribute, direction) of the index
+        """
+        keys = [(a, 1) for a in self.equalities]
+        keys.extend(self.sort)
+        keys.extend([(a, 1) for a in self.ranges])
+        keys.extend([(a, 1) for a in self.groups])
+        index = []
+        for attribute, direction in keys:
+            if attribute not in [a for a, _ in index]:
+                index.append((attribute, direction))
+        return index
+
+
+class IndexAdvisor(object):
+    """
+    Records the shapes of the executed queries, and suggests the compound
+    or partial indexes serving the most frequent ones
+
+    In managed mode, the most frequently used suggestions are created,
+    and the indexes the advisor created that are not used anymore are
+    dropped.
+
+    :param int maxsize: The maximum number of recorded shapes
+    """
+
+    # Name prefix of the indexes created by the advisor
+    prefix = "advisor_"
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # shape key -> [shape, count, {attribute: values}]
+            self.shapes = {}
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def get_shape(self, datamgr, table, query):
+        """
+        Extracts the shape of a compiled find or aggregation query. Only
+        the filters and sort applied to the collection documents before
+        any other stage may use an index.
+
+        :param DataManager datamgr: The data manager
+        :param str table: The queried table
+        :param dict/list query: The find parameters or pipeline
+        :rtype: QueryShape
+        :return: The query shape, or None if it can't use an index
+        """
+        collection = datamgr.get_table_collection(table)
+        groups = set()
+        sort = []
+        if isinstance(query, list):
+            stack = []
+            leading = True
+            for stage in query:
+                if leading and "$match" in stage:
+                    stack.append(stage["$match"])
+                    continue
+                elif leading and "$sort" in stage:
+                    sort = stage["$sort"].items()
+                leading = False
+                self.get_group_fields(stage, groups)
+        else:
+            stack = [query.get("filter", {})]
+            sort = query.get("sort", [])
+        equalities = {}
+        ranges = set()
+        for statement in datamgr.get_filter_conjuncts(stack):
+            if len(statement) != 1:
+                continue
+            attribute, condition = statement.items()[0]
+            if attribute.startswith("$"):
+                continue
+            if not isinstance(condition, dict):
+                if isinstance(condition, (bool, int, long, float, basestring)):
+                    equalities[attribute] = condition
+            elif "$eq" in condition or "$in" in condition:
+                equalities[attribute] = condition
+            elif [op for op in ("$gt", "$gte", "$lt", "$lte") if op in condition]:
+                ranges.add(attribute)
+        ranges.difference_update(equalities)
+        if not equalities and not ranges and not groups and \
+                [a for a, _ in sort] in ([], ["_id"]):
+            # Served by the _id index
+            return None
+        sample = dict(equalities)
+        sample.update([
+            (s.keys()[0], s.values()[0])
+            for s in datamgr.get_filter_conjuncts(stack)
+            if len(s) == 1 and s.keys()[0] in ranges
+        ])
+        return QueryShape(
+            collection,
+            tuple(sorted(equalities)),
+            tuple([(a, d) for a, d in sort]),
+            tuple(sorted(ranges)),
+            tuple(sorted(groups)),
+            sample
+        )
+
+    def get_group_fields(self, stage, fields):
+        """
+        Adds the attributes a $group stage, possibly in a $facet, groups
+        documents by
+        """
+        if "$facet" in stage:
+            for pipeline in stage["$facet"].values():
+                for sub_stage in pipeline:
+                    self.get_group_fields(sub_stage, fields)
+        elif "$group" in stage:
+            group_id = stage["$group"].get("_id")
+            if isinstance(group_id, dict):
+                fields.update([
+                    v.lstrip("$") for v in group_id.values()
+                    if isinstance(v, basestring) and v.startswith("$")
+                ])
+
+    def record(self, shape):
+        """
+        Records the execution of a query
+
+        :param QueryShape shape: The query shape
+        """
+        if shape is None or not self.enabled:
+            return
+        with self.lock:
+            entry = self.shapes.get(shape.key)
+            if entry is None:
+                if len(self.shapes) >= self.maxsize:
+                    return
+                entry = self.shapes[shape.key] = [shape, 0, {}]
+            entry[0] = shape
+            entry[1] += 1
+            values = entry[2]
+            for attribute, condition in shape.sample.items():
+                if attribute in shape.equalities:
+                    if isinstance(condition, dict):
+                        condition = condition.get("$eq", condition)
+                    if isinstance(condition, (bool, int, long, float, basestring)):
+                        values.setdefault(attribute, set()).add(condition)
+                    else:
+                        values[attribute] = None
+
+    def get_suggestions(self):
+        """
+        Returns the suggested indexes, most used first
+
+        Equality attributes always compared to the same boolean value are
+        moved from the index keys to its partial filter, when other keys
+        remain.
+
+        :rtype: list
+        :return: The suggestions dicts
+        """
+        with self.lock:
+            entries = [
+                (shape, count, dict(values))
+                for shape, count, values in self.shapes.values()
+            ]
+        suggestions = {}
+        for shape, count, values in entries:
+            keys = shape.get_index_keys()
+            partial = {}
+            for attribute in shape.equalities:
+                seen = list(values.get(attribute) or [])
+                if len(seen) == 1 and isinstance(seen[0], bool):
+                    partial[attribute] = seen[0]
+            if len(partial) < len(keys):
+                keys = [(a, d) for a, d in keys if a not in partial]
+            else:
+                partial = {}
+            name = self.get_index_name(keys, partial)
+            suggestion = suggestions.get((shape.collection, name))
+            if suggestion is None:
+                suggestion = suggestions[(shape.collection, name)] = {
+                    "collection": shape.collection,
+                    "name": name,
+                    "keys": keys,
+                    "partial": partial or None,
+                    "queries": 0,
+                    "sample": shape.sample,
+                }
+            suggestion["queries"] += count
+        return sorted(
+            suggestions.values(),
+            key=lambda s: (-s["queries"], s["collection"], s["name"])
+        )
+
+    def get_index_name(self, keys, partial):
+        digest = hashlib.md5(repr((keys, sorted(partial.items())))).hexdigest()
+        return "%s%s" % (self.prefix, digest[:12])
+
+    def is_served(self, keys, partial, indexes):
+        """
+        Tells if an existing index, whose keys start with the suggested
+        ones, serves a suggestion
+
+        :param list keys: The suggested index keys
+        :param dict partial: The suggested index partial filter
+        :param dict indexes: The collection index_information() output
+        :rtype: bool
+        """
+        for index in indexes.values():
+            existing = [(a, int(d)) for a, d in index["key"]]
+            if existing[:len(keys)] != keys:
+                continue
+            if index.get("partialFilterExpression", {}) in ({}, partial or {}):
+                return True
+        return False
+
+    def get_selectivity(self, collection, suggestion):
+        """
+        Estimates the ratio of the collection documents the suggested
+        index selects, using the last recorded query of the shape
+
+        :param Collection collection: The mongo collection
+        :param dict suggestion: The suggestion
+        :rtype: float
+        """
+        total = collection.estimated_document_count()
+        if not total:
+            return 0.0
+        sample = dict(suggestion["sample"])
+        sample.update(suggestion["partial"] or {})
+        matched = collection.count_documents(sample, limit=total)
+        return float(matched) / total
+
+    def get_index_stats(self, collection):
+        """
+        Returns the usage statistics of a collection indexes
+
+        :param Collection collection: The mongo collection
+        :rtype: list
+        """
+        stats = []
+        for index in collection.aggregate([{"$indexStats": {}}]):
+            stats.append({
+                "collection": collection.name,
+                "name": index["name"],
+                "key": index["key"].items(),
+                "ops": index.get("accesses", {}).get("ops", 0),
+                "since": index.get("accesses", {}).get("since"),
+                "managed": index["name"].startswith(self.prefix),
+            })
+        return sorted(stats, key=lambda s: s["name"])
+
+    def report(self, db):
+        """
+        Builds the indexes report: the suggested indexes, with their
+        estimated selectivity and whether an existing index serves them,
+        and the usage statistics of the existing indexes
+
+        :param Database db: The mongo database
+        :rtype: dict
+        """
+        suggestions = self.get_suggestions()
+        collections = sorted(set([s["collection"] for s in suggestions]))
+        for name in collections:
+            collection = getattr(db, name)
+            indexes = collection.index_information()
+            for suggestion in suggestions:
+                if suggestion["collection"] != name:
+                    continue
+                suggestion["existing"] = self.is_served(
+                    suggestion["keys"],
+                    suggestion["partial"],
+                    indexes
+                )
+                suggestion["selectivity"] = self.get_selectivity(
+                    collection,
+                    suggestion
+                )
+        index_stats = []
+        for name in collections:
+            index_stats.extend(self.get_index_stats(getattr(db, name)))
+        return {
+            "suggestions": suggestions,
+            "indexes": index_stats,
+        }
+
+    def manage(self, db, top):
+        """
+        Creates the `top` most used suggested indexes that don't exist
+        yet, and drops the indexes the advisor created that are neither
+        suggested anymore nor used
+
+        :param Database db: The mongo database
+        :param int top: The number of suggestions to create indexes for
+        :rtype: tuple
+        :return: The names of the created and dropped indexes
+        """
+        suggestions = self.get_suggestions()
+        with self.lock:
+            collections = set([
+                shape.collection for shape, _, _ in self.shapes.values()
+            ])
+        suggestions = suggestions[:top]
+        wanted = set([(s["collection"], s["name"]) for s in suggestions])
+        created = []
+        dropped = []
+        for name in sorted(collections):
+            collection = getattr(db, name)
+            indexes = collection.index_information()
+            models = [
+                IndexModel(
+                    s["keys"],
+                    name=s["name"],
+                    background=True,
+                    **({"partialFilterExpression": s["partial"]} if s["partial"] else {})
+                )
+                for s in suggestions
+                if s["collection"] == name and
+                not self.is_served(s["keys"], s["partial"], indexes)
+            ]
+            if models:
+                # A single createIndexes command per collection
+                created.extend(collection.create_indexes(models))
+            for index in self.get_index_stats(collection):
+                if index["managed"] and index["ops"] == 0 and \
+                        (name, index["name"]) not in wanted:
+                    collection.drop_index(index["name"])
+                    dropped.append(index["name"])
+        return created, dropped
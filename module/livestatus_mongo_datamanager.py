@@ -24,14 +24,29 @@
 # along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
 
 from shinken.util import safe_print
+from shinken.log import logger
 from shinken.misc.sorter import hst_srv_sort, last_state_change_earlier
 from shinken.misc.filter import only_related_to
-from mongo_mapping import table_class_map, register_datamgr
+from mongo_mapping import table_class_map, register_datamgr, linked_attributes
 from livestatus_query_error import LiveStatusQueryError
 from livestatus_timeperiod import timeperiods
+from livestatus_counters import LiveStatusCounters
+from livestatus_mongo_fingerprints import FingerprintCache
+from livestatus_mongo_links import LinksIndex
+from livestatus_mongo_states import StatesIndex
+from livestatus_mongo_plan_cache import QueryPlanCache
+from livestatus_mongo_overview import TacticalOverview
+from livestatus_mongo_advisor import IndexAdvisor
+from livestatus_mongo_filters import FilterOptimizer
 from log_line import Logline, LOGCLASS_INVALID
 from pprint import pprint
+from collections import OrderedDict
+from pymongo import ReplaceOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError, OperationFailure
 import pymongo
+import functools
+import datetime
 import time
 import re
 
@@ -39,12 +54,179 @@ class DataManager(object):
 
     mapping = table_class_map
 
+    # Collections holding documents derived from hosts and services. A
+    # same document may be upserted then deleted in a single batch, so
+    # operations on them have to be applied in order.
+    # Services embed their host attributes, updated after the services
+    # upserts when the host changes.
+    ordered_collections = ("comments", "downtimes", "problems", "services")
+
+    # Host attributes embedded in the services documents, as `__host__`
+    host_link_attributes = linked_attributes("services", "host")
+
+    # Indexed attributes, per collection
+    indexes = {
+        "hosts": (
+            "host_name",
+            "hostgroups",
+            "servicegroups",
+            "contacts",
+            "problem_has_been_acknowledged",
+            "active_checks_enabled",
+            "passive_checks_enabled",
+            "scheduled_downtime_depth",
+            "host_name__lower",
+        ),
+        "services": (
+            "host_name",
+            "service_description",
+            "host_name__lower",
+            "service_description__lower",
+            "hostgroups",
+            "servicegroups",
+            "contacts",
+            "problem_has_been_acknowledged",
+            "active_checks_enabled",
+            "passive_checks_enabled",
+            "scheduled_downtime_depth",
+            "__host__.state_id",
+        ),
+        "hostgroups": ("hostgroup_name",),
+        "servicegroups": ("servicegroup_name",),
+        "contacts": ("contact_name",),
+        "timeperiods": ("timeperiod_name",),
+        "commands": ("command_name",),
+        "schedulerlinks": ("scheduler_name",),
+        "brokerlinks": ("broker_name",),
+        "reactionnerlinks": ("reactionner_name",),
+        "pollerlinks": ("poller_name",),
+        "downtimes": ("is_service",),
+        "comments": ("is_service",),
+        "log": ("host_name", "service_description", "state", "state_type"),
+    }
+
+    # Attributes stored along with a lowercase copy, named
+    # <attribute>__lower, used by the case insensitive filters, per
+    # collection
+    lower_attributes = {
+        "hosts": ("host_name", "alias", "display_name", "address"),
+        "services": ("host_name", "service_description", "display_name"),
+        "hostgroups": ("hostgroup_name", "alias"),
+        "servicegroups": ("servicegroup_name", "alias"),
+        "contacts": ("contact_name", "alias"),
+    }
+
+    # Name of the collections initial broks are loaded into, before
+    # replacing the live collections content
+    staging_format = "%s__staging_%s"
+
+    # Error codes of an aggregation result document exceeding the BSON
+    # document size limit
+    document_size_errors = (10334, 16389)
+
     def __init__(self):
         self.db = None
         self.instances = {}
-
-    def load(self, db):
+        self.counters = LiveStatusCounters()
+        # Bulk write settings: pending operations are flushed when
+        # bulk_size operations are queued, or when the oldest one has
+        # been waiting for more than bulk_latency seconds
+        self.bulk_size = 1000
+        self.bulk_latency = 1.0
+        self.bulk_updates = {}
+        self.bulk_operations = {}
+        self.bulk_logs = []
+        self.bulk_pending = 0
+        self.bulk_since = None
+        # Log store retention: log lines older than log_retention seconds
+        # are removed by a TTL index, or the log collection is capped to
+        # log_capped_size bytes
+        self.log_retention = 0
+        self.log_capped_size = 0
+        # Attributes fingerprints of the written objects, used to only
+        # write attributes that changed
+        self.fingerprints = FingerprintCache()
+        # Hosts and services groups and contacts, used to maintain the
+        # groups and contacts links
+        self.links = LinksIndex()
+        # Services states counters of the hosts and groups
+        self.states = StatesIndex()
+        # Hosts attributes embedded in their services, and the ones that
+        # changed since the last flush
+        self.host_snapshots = {}
+        self.host_snapshots_changes = {}
+        # When set, called with the pending batch on flush instead of
+        # writing it inline (see livestatus_mongo_pipeline)
+        self.batch_writer = None
+        # Normalization functions, per brok value type
+        self.normalizers = {}
+        # When enabled, initial broks are loaded into staging collections,
+        # swapped in once all are received
+        self.bulk_load = False
+        # The (major, minor) MongoDB server version, read on first use
+        self.server_version = None
+        # Parsed and compiled queries, per normalized query text
+        self.query_plans = QueryPlanCache(self.counters)
+        # Hosts and services counters answering tactical overview queries
+        self.overview = TacticalOverview(self.counters)
+        # Queries shapes, and the indexes suggested to serve them. When
+        # managed_indexes is set, this number of suggested indexes are
+        # created
+        self.advisor = IndexAdvisor()
+        self.managed_indexes = 0
+        # Attributes known not to hold lists, per table
+        self.scalar_attributes = {}
+        # Responses are formatted by chunks of response_chunk_size rows,
+        # and spooled to a temporary file above response_spool_size bytes
+        # when their length is needed
+        self.response_chunk_size = 1000
+        self.response_spool_size = 10485760
+        # Compression level of the responses requesting it, responses
+        # smaller than response_compression_min_size bytes being stored
+        # in the compressed stream without being compressed
+        self.response_compression_level = 6
+        self.response_compression_min_size = 1024
+        # Instances being loaded -> names of the staged collections
+        self.staging = {}
+
+    def load(self, db, bulk_size=None, bulk_latency=None, fingerprints_size=None,
+             bulk_load=None, log_retention=None, log_capped_size=None,
+             query_plan_cache_size=None, tactical_overview=None,
+             index_advisor=None, managed_indexes=None,
+             response_chunk_size=None, response_spool_size=None,
+             response_compression_level=None,
+             response_compression_min_size=None):
         self.db = db
+        if response_compression_level is not None:
+            self.response_compression_level = int(response_compression_level)
+        if response_compression_min_size is not None:
+            self.response_compression_min_size = int(response_compression_min_size)
+        if response_chunk_size is not None:
+            self.response_chunk_size = max(1, int(response_chunk_size))
+        if response_spool_size is not None:
+            self.response_spool_size = int(response_spool_size)
+        if index_advisor is not None:
+            self.advisor.enabled = bool(index_advisor)
+        if managed_indexes is not None:
+            self.managed_indexes = int(managed_indexes)
+        if tactical_overview is not None:
+            self.overview.enabled = bool(tactical_overview)
+        if query_plan_cache_size is not None:
+            self.query_plans.maxsize = int(query_plan_cache_size)
+            self.query_plans.clear()
+        if log_retention is not None:
+            self.log_retention = int(log_retention)
+        if log_capped_size is not None:
+            self.log_capped_size = int(log_capped_size)
+        if bulk_load is not None:
+            self.bulk_load = bool(bulk_load)
+        if bulk_size is not None:
+            self.bulk_size = max(1, int(bulk_size))
+        if bulk_latency is not None:
+            self.bulk_latency = float(bulk_latency)
+        if fingerprints_size is not None:
+            self.fingerprints.maxsize = int(fingerprints_size)
+        self.create_log_store()
         self.create_indexes()
 
     def clear_db(self):
@@ -55,94 +237,165 @@ class DataManager(object):
         """
         for collection in self.db.collection_names():
             self.db.drop_collection(collection)
+        self.fingerprints.clear()
+        self.links.clear()
+        self.states.clear()
+        self.overview.clear()
+        self.overview.loading.clear()
+        self.host_snapshots.clear()
+        self.host_snapshots_changes.clear()
 
     def create_indexes(self):
         """
         Creates the necessary indexes to speed up queries
         """
-        # Hosts indexes
-        self.db.hosts.create_index("host_name", background=True)
-        self.db.hosts.create_index("hostgroups", background=True)
-        self.db.hosts.create_index("servicegroups", background=True)
-        self.db.hosts.create_index("contacts", background=True)
-        self.db.hosts.create_index("problem_has_been_acknowledged", background=True)
-        self.db.hosts.create_index("active_checks_enabled", background=True)
-        self.db.hosts.create_index("passive_checks_enabled", background=True)
-        self.db.hosts.create_index("scheduled_downtime_depth", background=True)
-
-        # Services indexes
-        self.db.services.create_index("host_name", background=True)
-        self.db.services.create_index("service_description", background=True)
-        self.db.services.create_index("hostgroups", background=True)
-        self.db.services.create_index("servicegroups", background=True)
-        self.db.services.create_index("contacts", background=True)
-        self.db.services.create_index("problem_has_been_acknowledged", background=True)
-        self.db.services.create_index("active_checks_enabled", background=True)
-        self.db.services.create_index("passive_checks_enabled", background=True)
-        self.db.services.create_index("scheduled_downtime_depth", background=True)
-
-        # Hostgroups indexes
-        self.db.hostgroups.create_index("hostgroup_name", background=True)
+        for collection in self.indexes:
+            self.create_collection_indexes(collection)
 
-        # Hostgroups indexes
-        self.db.servicegroups.create_index("servicegroup_name", background=True)
-
-        # Contacts indexes
-        self.db.contacts.create_index("contact_name", background=True)
-
-        # Timeperiods indexes
-        self.db.timeperiods.create_index("timeperiod_name", background=True)
+    def create_log_store(self):
+        """
+        Sets up the log collection retention, either as a capped collection
+        or with a TTL index on the log lines date
+        """
+        if self.log_capped_size:
+            if "log" not in self.db.collection_names():
+                self.db.create_collection(
+                    "log",
+                    capped=True,
+                    size=self.log_capped_size
+                )
+            elif not self.db.log.options().get("capped"):
+                logger.info(
+                    "[Livestatus Mongo] Converting log collection to a "
+                    "capped collection of %d bytes", self.log_capped_size)
+                self.db.command(
+                    "convertToCapped",
+                    "log",
+                    size=self.log_capped_size
+                )
+        elif self.log_retention:
+            try:
+                self.db.log.create_index(
+                    "date",
+                    expireAfterSeconds=self.log_retention,
+                    background=True
+                )
+            except OperationFailure:
+                # The index exists with a different retention
+                self.db.command(
+                    "collMod",
+                    "log",
+                    index={
+                        "keyPattern": {"date": 1},
+                        "expireAfterSeconds": self.log_retention,
+                    }
+                )
 
-        # Timeperiods indexes
-        self.db.commands.create_index("command_name", background=True)
+    def create_collection_indexes(self, collection, name=None, background=True):
+        """
+        Creates the indexes of a collection
 
-        # Schedulers indexes
-        self.db.schedulerlinks.create_index("scheduler_name", background=True)
+        :param str collection: The collection whose indexes are created
+        :param str name: The name of the collection to create the indexes
+                         into, if not the collection itself
+        :param bool background: Should the indexes be built in background
+        """
+        target = getattr(self.db, name or collection)
+        models = [
+            IndexModel(attribute, background=background)
+            for attribute in self.indexes.get(collection, ())
+        ]
+        if models:
+            # A single createIndexes command per collection
+            target.create_indexes(models)
 
-        # Brokers indexes
-        self.db.brokerlinks.create_index("broker_name", background=True)
+    def get_indexes_report(self):
+        """
+        Returns the indexes suggested from the executed queries, and the
+        existing indexes usage statistics
 
-        # Reactionners indexes
-        self.db.reactionnerlinks.create_index("reactionner_name", background=True)
+        :rtype: dict
+        """
+        return self.advisor.report(self.db)
 
-        # Pollers indexes
-        self.db.pollerlinks.create_index("poller_name", background=True)
+    def manage_indexes(self):
+        """
+        Creates the most used suggested indexes, and drops the ones that
+        are not used anymore, when managed indexes are enabled
+        """
+        if not self.managed_indexes:
+            return
+        created, dropped = self.advisor.manage(self.db, self.managed_indexes)
+        for name in created:
+            logger.info("[Livestatus Mongo] Created suggested index %s", name)
+        for name in dropped:
+            logger.info("[Livestatus Mongo] Dropped unused index %s", name)
 
-        # Downtimes indexes
-        self.db.downtimes.create_index("is_service", background=True)
+    def normalize(self, obj):
+        """
+        Converts a brok value into a value that may be stored in mongo
 
-        # Comments indexes
-        self.db.comments.create_index("is_service", background=True)
+        The conversion strategy is resolved once per type, then looked up
+        from the normalizers cache.
 
-        # Logs indexes
-        self.db.log.create_index("host_name", background=True)
-        self.db.log.create_index("service_description", background=True)
-        self.db.log.create_index("state", background=True)
-        self.db.log.create_index("state_type", background=True)
+        :param obj: The value to convert
+        """
+        try:
+            normalizer = self.normalizers[obj.__class__]
+        except KeyError:
+            normalizer = self.get_normalizer(obj)
+        return normalizer(obj)
 
+    def get_normalizer(self, obj):
+        """
+        Resolves the function used to normalize values of the same type as
+        `obj`, and stores it in the normalizers cache
 
-    def normalize(self, obj):
+        :param obj: The value whose type normalizer is wanted
+        :rtype: callable
+        """
         if hasattr(obj, "get_full_name"):
-            return obj.get_full_name()
+            normalizer = self.normalize_full_name
         elif hasattr(obj, "get_name"):
-            return obj.get_name()
+            normalizer = self.normalize_name
         elif hasattr(obj, "weekdays"):
-            return self.normalize_daterange(obj)
+            normalizer = self.normalize_daterange
         elif isinstance(obj, list):
-            return [self.normalize(o) for o in obj]
+            normalizer = self.normalize_list
         elif isinstance(obj, dict):
-            return dict([
-                (k, self.normalize(v)) for k, v in obj.items()
-            ])
+            normalizer = self.normalize_dict
         elif hasattr(obj, "properties"):
             properties = ["id"]
             properties.extend(getattr(obj, "properties", {}).keys())
             properties.extend(getattr(obj, "running_properties", {}).keys())
-            return dict([
-                (p, getattr(obj, p, "")) for p in properties
-            ])
+            normalizer = functools.partial(
+                self.normalize_properties,
+                properties=properties
+            )
         else:
-            return obj
+            normalizer = self.normalize_value
+        self.normalizers[obj.__class__] = normalizer
+        return normalizer
+
+    def normalize_full_name(self, obj):
+        return obj.get_full_name()
+
+    def normalize_name(self, obj):
+        return obj.get_name()
+
+    def normalize_list(self, obj):
+        normalize = self.normalize
+        return [normalize(o) for o in obj]
+
+    def normalize_dict(self, obj):
+        normalize = self.normalize
+        return dict([(k, normalize(v)) for k, v in obj.items()])
+
+    def normalize_properties(self, obj, properties):
+        return dict([(p, getattr(obj, p, "")) for p in properties])
+
+    def normalize_value(self, obj):
+        return obj
 
     def normalize_daterange(self, obj):
         """
@@ -168,23 +421,209 @@ class DataManager(object):
             )
         return daterange
 
-    def manage_brok(self, brok):
+    def want_brok(self, brok):
+        """
+        Tells if a brok is managed, the others may be dropped before being
+        sent to the module
+
+        :param Brok brok: The brok to check
+        :rtype: bool
+        """
+        return hasattr(self, "manage_%s_brok" % brok.type)
+
+    def manage_brok(self, brok, flush=True):
         """
         Manages a received brok
 
         :param Brok brok: The brok to manage
+        :param bool flush: Should the pending writes be flushed immediately,
+                           or wait for the batch to be full
         """
         handler_name = "manage_%s_brok" % brok.type
         handler = getattr(self, handler_name, None)
         if handler is not None:
             handler(brok)
+        self.counters.increment("broks")
+        if flush is True or self.bulk_pending >= self.bulk_size:
+            self.flush()
+
+    def manage_broks(self, broks):
+        """
+        Manages a list of received broks, grouping database writes into
+        bulk operations
+
+        :param list broks: The broks to manage
+        """
+        for brok in broks:
+            self.manage_brok(brok, flush=False)
+        self.flush_expired()
+
+    def queue_update(self, collection, object_id, data):
+        """
+        Queues an object upsert to be sent in the next bulk write
+
+        Several updates of a same object are coalesced into a single one,
+        the last written value of each attribute winning, so that only one
+        write per object reaches the database on each flush.
+
+        :param str collection: The collection name
+        :param str object_id: The updated object id
+        :param dict data: The attributes to set
+        """
+        updates = self.bulk_updates.setdefault(collection, OrderedDict())
+        pending = updates.get(object_id)
+        if pending is None:
+            updates[object_id] = dict(data)
+            self.bulk_pending += 1
+        else:
+            pending.update(data)
+        self.counters.increment("object_updates")
+        if self.bulk_since is None:
+            self.bulk_since = time.time()
+
+    def queue_operation(self, collection, operation):
+        """
+        Queues a write operation to be sent in the next bulk write
+
+        :param str collection: The collection name
+        :param operation: The pymongo write operation
+        """
+        self.bulk_operations.setdefault(collection, []).append(operation)
+        self.bulk_pending += 1
+        if self.bulk_since is None:
+            self.bulk_since = time.time()
+
+    def flush_expired(self):
+        """
+        Flushes pending write operations if the oldest one has been waiting
+        longer than the maximum allowed latency
+        """
+        if self.bulk_since is None:
+            return
+        if time.time() - self.bulk_since >= self.bulk_latency:
+            self.flush()
+
+    def flush(self, wait=False):
+        """
+        Sends all the pending write operations, one bulk write per collection
+
+        When a batch writer is set, the pending operations are handed to
+        it instead of being written inline.
+
+        :param bool wait: Should the call block until the operations are
+                          actually written, for instance before reading
+                          back from the database
+        """
+        self.queue_links()
+        self.queue_states()
+        self.queue_host_snapshots()
+        batch = self.take_batch()
+        if self.batch_writer is None:
+            self.write_batch(batch)
+        else:
+            self.batch_writer(batch, wait)
+
+    def take_batch(self):
+        """
+        Takes the pending write operations, leaving the queue empty
+
+        :rtype: tuple
+        :return: The (updates, operations, logs) pending batch
+        """
+        batch = (self.bulk_updates, self.bulk_operations, self.bulk_logs)
+        self.bulk_updates = {}
+        self.bulk_operations = {}
+        self.bulk_logs = []
+        self.bulk_pending = 0
+        self.bulk_since = None
+        return batch
+
+    def write_batch(self, batch):
+        """
+        Writes a batch taken by `take_batch()`, one bulk write per collection
+
+        :param tuple batch: The (updates, operations, logs) batch to write
+        :rtype: int
+        :return: The number of write operations sent
+        """
+        updates, operations, logs = batch
+        count = len(logs)
+        self.write_logs(logs)
+        for collection in set(updates.keys() + operations.keys()):
+            objects = updates.get(collection, {})
+            # Staged objects may already have been written by a previous
+            # flush, by a brok holding only some of their attributes
+            ops = [
+                UpdateOne({"_id": object_id}, {"$set": data}, upsert=True)
+                for object_id, data in objects.items()
+            ]
+            self.counters.increment("object_writes", len(ops))
+            ops.extend(operations.get(collection, []))
+            count += len(ops)
+            if not self.write_bulk(collection, ops):
+                # The written values are unknown, next updates have to
+                # be written in full
+                self.fingerprints.discard(collection, objects.keys())
+                base = collection.split("__staging_")[0]
+                if base in self.ordered_collections:
+                    self.fingerprints.discard_collection(base)
+        return count
+
+    def write_logs(self, logs):
+        """
+        Inserts log lines in the log collection
+
+        :param list logs: The log lines documents
+        """
+        if not logs:
+            return
+        start = time.time()
+        try:
+            self.db.log.insert_many(logs, ordered=False)
+        except BulkWriteError as exp:
+            logger.error(
+                "[Livestatus Mongo] Log lines insert failed: %s",
+                exp.details.get("writeErrors")
+            )
+        self.counters.increment("log_flushes")
+        self.counters.increment("log_flush_time", time.time() - start)
+
+    def write_bulk(self, collection, operations):
+        """
+        Executes a bulk write on a collection
+
+        :param str collection: The collection name
+        :param list operations: The pymongo write operations
+        :rtype: bool
+        :return: True if all the operations succeeded
+        """
+        if not operations:
+            return True
+        ordered = collection.split("__staging_")[0] in self.ordered_collections
+        success = True
+        try:
+            getattr(self.db, collection).bulk_write(operations, ordered=ordered)
+        except BulkWriteError as exp:
+            logger.error(
+                "[Livestatus Mongo] Bulk write on %s failed: %s",
+                collection,
+                exp.details.get("writeErrors")
+            )
+            success = False
+        self.counters.increment("bulk_writes")
+        self.counters.increment("bulk_operations", len(operations))
+        return success
 
     def manage_clean_all_my_instance_id_brok(self, brok):
         print("Brok: %s" % brok.type)
         pprint(brok.data)
         instance_id = brok.data["instance_id"]
         self.instances[instance_id] = int(time.time())
+        # The counters miss this instance objects until they are loaded
+        self.overview.loading.add(instance_id)
         timeperiods.clear()
+        if self.bulk_load:
+            self.start_staging(instance_id)
 
     def manage_program_status_brok(self, brok):
         """
@@ -197,11 +636,7 @@ class DataManager(object):
         }
         for name, value in brok.data.items():
             data[name] = self.normalize(value)
-        self.db.status.update(
-            {"_id": data["instance_id"]},
-            {"$set": data},
-            upsert=True
-        )
+        self.queue_update("status", data["instance_id"], data)
         return data
 
     def manage_initial_host_status_brok(self, brok):
@@ -337,156 +772,296 @@ class DataManager(object):
         """
         print("Brok: %s" % brok.type)
         pprint(brok.data)
-        self.cleanup_old_objects(brok.data["instance_id"])
-        self.update_hostgroups_links()
-        self.update_servicegroups_links()
-        self.update_contacts_links()
-
-    def update_hostgroups_links(self):
-        """
-        Adds the necessary attributes to to properly link hotsgroups to
-        hosts, services and contacts.
-        """
-        # Builds cross objects references
-        # Hostgroups -> hosts (members)
-        # Hostgroups -> services (members_hosts)
-        # Hostgroups -> services (members_services)
-        # Hostgroups -> contacts (contacts)
-        services_hg = {}
-        for hg in self.db.hostgroups.find(projection={'_id': 1}):
-            group_name = hg["_id"]
-            members = []
-            members_services = []
-            contacts = []
-            hosts = self.db.hosts.aggregate([
-                {"$match": {"hostgroups": {"$in": [group_name]}}},
-                {
-                    "$lookup": {
-                        "from": "services",
-                        "as": "services",
-                        "localField": "host_name",
-                        "foreignField": "host_name",
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 1,
-                        "contacts": 1,
-                        "host_name": 1,
-                        "services._id": 1,
-                        "services.contacts": 1,
-                    }
-                },
-            ])
+        # Links are computed from the database content, which has to be
+        # up to date
+        self.flush(wait=True)
+        instance_id = brok.data["instance_id"]
+        replaced = self.swap_staging(instance_id)
+        self.cleanup_old_objects(instance_id, skip=replaced)
+        self.overview.loading.discard(instance_id)
+        self.update_links()
 
-            for host in hosts:
-                members.append(host["_id"])
-                contacts.extend(host.get("contacts", []))
-                for service in host["services"]:
-                    svc_id = service["_id"]
-                    contacts.extend(service.get("contacts", []))
-                    # Registers hostgroup intto the service
-                    services_hg.setdefault(svc_id, []).append(group_name)
-            members_services = list(set(members_services))
-            contacts = list(set(contacts))
-            self.db.hostgroups.update(
-                {"_id": group_name},
-                {
-                    "$set": {
-                        "members": members,
-                        "contacts": contacts
+    def start_staging(self, instance_id):
+        """
+        Starts loading an instance objects into staging collections, the
+        live collections being left untouched until the load is complete
+
+        :param int instance_id: The loaded instance id
+        """
+        suffix = self.staging_format % ("", instance_id)
+        for name in self.db.collection_names():
+            if name.endswith(suffix):
+                # Left by an interrupted load
+                self.db.drop_collection(name)
+        self.staging[instance_id] = set()
+
+    def get_collection_name(self, collection, instance_id):
+        """
+        Returns the name of the collection objects of an instance have to
+        be written into, which is a staging collection while the instance
+        is being loaded
+
+        :param str collection: The live collection name
+        :param int instance_id: The objects instance id
+        :rtype: str
+        """
+        staged = self.staging.get(instance_id)
+        if staged is None:
+            return collection
+        staged.add(collection)
+        return self.staging_format % (collection, instance_id)
+
+    def is_staging_collection(self, collection):
+        return "__staging_" in collection
+
+    def swap_staging(self, instance_id):
+        """
+        Replaces the instance objects in the live collections by the loaded
+        ones
+
+        Indexes are built on the staging collection once loaded. When the
+        live collection only holds objects of this instance, it is replaced
+        at once by renaming the staging collection, after the managed
+        indexes of the live collection have been rebuilt on it. Otherwise,
+        the staged objects are merged into it, using a `$merge` stage on
+        MongoDB 4.2 or later, and bulk replacements on older servers.
+
+        :param int instance_id: The loaded instance id
+        :rtype: list
+        :return: The names of the live collections that have been replaced
+        """
+        staged = self.staging.pop(instance_id, None)
+        if staged is None:
+            return []
+        replaced = []
+        for collection in sorted(staged):
+            name = self.staging_format % (collection, instance_id)
+            self.create_collection_indexes(collection, name, background=False)
+            other = getattr(self.db, collection).find_one(
+                {"instance_id": {"$ne": instance_id}},
+                projection={"_id": 1}
+            )
+            if other is None:
+                self.copy_managed_indexes(collection, name)
+                getattr(self.db, name).rename(collection, dropTarget=True)
+                replaced.append(collection)
+            elif not self.has_merge():
+                self.merge_staging(name, collection)
+                self.db.drop_collection(name)
+            else:
+                getattr(self.db, name).aggregate([
+                    {
+                        "$merge": {
+                            "into": collection,
+                            "on": "_id",
+                            "whenMatched": "replace",
+                            "whenNotMatched": "insert",
+                        }
                     }
-                }
+                ])
+                self.db.drop_collection(name)
+        return replaced
+
+    def copy_managed_indexes(self, collection, name):
+        """
+        Creates the indexes managed by the index advisor on a live collection
+        into its staging collection, so that they survive its replacement
+
+        :param str collection: The live collection name
+        :param str name: The staging collection name
+        """
+        models = []
+        indexes = getattr(self.db, collection).index_information()
+        for index_name, index in indexes.items():
+            if not index_name.startswith(self.advisor.prefix):
+                continue
+            options = {"name": index_name, "background": False}
+            if "partialFilterExpression" in index:
+                options["partialFilterExpression"] = \
+                    index["partialFilterExpression"]
+            keys = [(key, int(order)) for key, order in index["key"]]
+            models.append(IndexModel(keys, **options))
+        if models:
+            getattr(self.db, name).create_indexes(models)
+
+    def has_merge(self):
+        """
+        Tells if the server supports the `$merge` aggregation stage, which
+        has been introduced by MongoDB 4.2
+
+        :rtype: bool
+        """
+        if self.server_version is None:
+            info = self.db.client.server_info()
+            self.server_version = tuple(info["versionArray"][:2])
+        return self.server_version >= (4, 2)
+
+    def merge_staging(self, name, collection):
+        """
+        Merges the staged objects into a live collection using bulk
+        replacements, when `$merge` is not available
+
+        :param str name: The staging collection name
+        :param str collection: The live collection name
+        """
+        ops = []
+        for document in getattr(self.db, name).find():
+            ops.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+            if len(ops) >= self.bulk_size:
+                self.write_bulk(collection, ops)
+                ops = []
+        self.write_bulk(collection, ops)
+
+    def update_links(self):
+        """
+        Rebuilds the links, states and tactical overview indexes in a single
+        pass over hosts and services, and writes the links of all the
+        groups, contacts, hosts and services, and the services states
+        counters of all the hosts and groups
+        """
+        self.links.clear()
+        self.states.clear()
+        self.overview.clear()
+        projection = {"_id": 1, "hostgroups": 1, "contacts": 1}
+        projection.update([(a, 1) for a in self.overview.dimensions["hosts"]])
+        hosts = self.db.hosts.find(projection=projection)
+        for host in hosts:
+            self.links.set_host(
+                host["_id"],
+                host.get("hostgroups"),
+                host.get("contacts")
             )
-        for svc_id, hostgroups in services_hg.items():
-            self.db.services.update(
-                {"_id": svc_id},
-                {"$set": {"hostgroups": list(set(hostgroups))}},
+            self.overview.set_object("hosts", host["_id"], host)
+        projection = {
+            "_id": 1,
+            "host_name": 1,
+            "servicegroups": 1,
+            "contacts": 1,
+            "state_type_id": 1,
+            "state_id": 1,
+            "state": 1,
+        }
+        projection.update([(a, 1) for a in self.overview.dimensions["services"]])
+        services = self.db.services.find(projection=projection)
+        for service in services:
+            self.links.set_service(
+                service["_id"],
+                service.get("host_name"),
+                service.get("servicegroups"),
+                service.get("contacts")
             )
+            self.update_service_states(service["_id"], service)
+            self.overview.set_object("services", service["_id"], service)
+        self.overview.complete = True
+        # Groups and contacts without any member have their links and
+        # counters reset
+        for collection in ("hostgroups", "servicegroups", "contacts"):
+            objects = getattr(self.db, collection).find(projection={"_id": 1})
+            names = [o["_id"] for o in objects]
+            self.links.touch(collection, names)
+            if collection in self.states.collections:
+                self.states.touch(collection, names)
+        self.states.touch("hosts", self.links.hosts.keys())
+        self.queue_links()
+        self.queue_states()
+
+    def get_state_containers(self, service):
+        """
+        Returns the objects counting a service state: its host, its host
+        groups and its service groups
+
+        :param str service: The service name
+        :rtype: frozenset
+        :return: The (collection, name) of the objects
+        """
+        host, servicegroups, _ = self.links.services[service]
+        containers = [("hosts", host)]
+        if host in self.links.hosts:
+            containers.extend([("hostgroups", g) for g in self.links.hosts[host][0]])
+        containers.extend([("servicegroups", g) for g in servicegroups])
+        return frozenset(containers)
+
+    def update_service_states(self, service, data):
+        """
+        Updates the counters of the objects counting a service state
+
+        :param str service: The service name
+        :param dict data: The service data
+        """
+        if service not in self.links.services:
+            return
+        self.states.set_service(
+            service,
+            self.get_state_containers(service),
+            (data.get("state_type_id"), data.get("state_id"), data.get("state"))
+        )
 
-    def update_servicegroups_links(self):
-        """
-        Adds the necessary attributes to to properly link servicegroups to
-        hosts, services and contacts.
-        """
-        # Servicegroups -> services (members)
-        # Servicegroups -> services (members_hosts)
-        # Servicegroups -> services (members_services)
-        # Servicegroups -> contacts (contacts)
-        hosts_sg = {}
-        for sg in self.db.servicegroups.find(projection={'_id': 1}):
-            group_name = sg["_id"]
-            members = []
-            members_hosts = []
-            contacts = []
-            services = self.db.services.aggregate([
-                {"$match": {"servicegroups": {"$in": [group_name]}}},
-                {
-                    "$lookup": {
-                        "from": "hosts",
-                        "as": "hosts",
-                        "localField": "host_name",
-                        "foreignField": "host_name",
-                    }
-                },
-                {
-                    "$project": {
-                        "_id": 1,
-                        "contacts": 1,
-                        "host_name": 1,
-                        "hosts.contacts": 1,
-                    }
-                },
-            ])
-            for service in services:
-                members.append(service["_id"])
-                contacts.extend(service.get("contacts", []))
-                members_hosts.append(service["host_name"])
-                hname = service["host_name"]
-                hosts_sg.setdefault(hname, []).append(group_name)
-                for host in service["hosts"]:
-                    contacts.extend(host.get("contacts", []))
-                    # Registers serviecgroup intto the host
-            members = list(set(members))
-            contacts = list(set(contacts))
-            self.db.servicegroups.update(
-                {"_id": group_name},
-                {
-                    "$set": {
-                        "members": members,
-                        "contacts": contacts,
-                    },
-                }
+    def queue_states(self):
+        """
+        Queues the writes of the services states counters that changed
+        since the last call
+        """
+        for collection, name, counters in self.states.pop_dirty():
+            self.queue_operation(
+                collection,
+                UpdateOne({"_id": name}, {"$set": {"__services_states__": counters}})
             )
-        for hst_id, servicegroups in hosts_sg.items():
-            self.db.hosts.update(
-                {"_id": hst_id},
-                {"$set": {"servicegroups": list(set(servicegroups))}},
+
+    def queue_links(self):
+        """
+        Queues the writes of the links that changed since the last call
+        """
+        for collection, name, links in self.links.pop_dirty():
+            self.queue_operation(
+                collection,
+                UpdateOne({"_id": name}, {"$set": links})
             )
 
-    def update_contacts_links(self):
-        """
-        Adds the necessary attributes to to properly link contacts to
-        hosts and services.
-        """
-        contacts = {}
-        for host in self.db.hosts.find(projection={"_id": 1, "contacts": 1}):
-            for contact in host.get("contacts", []):
-                contacts.setdefault(contact, {"hosts": [], "services": []})
-                contacts[contact]["hosts"].append(host["_id"])
-        for srevice in self.db.srevices.find(projection={"_id": 1, "contacts": 1}):
-            for contact in srevice.get("contacts", []):
-                contacts.setdefault(contact, {"hosts": [], "services": []})
-                contacts[contact]["srevices"].append(srevice["_id"])
-        for contact, links in contacts.items():
-            self.db.contacts.update(
-                {"_id": contact},
-                {"$set": links},
+    def update_host_snapshot(self, host_name, data, initial=False):
+        """
+        Updates the host attributes embedded in its services
+
+        Changes are written to the services on the next flush, except for
+        initial broks: the services initial broks follow, and embed the
+        whole snapshot.
+
+        :param str host_name: The host name
+        :param dict data: The host brok data
+        :param bool initial: Is the brok an initial one
+        """
+        snapshot = self.host_snapshots.setdefault(host_name, {})
+        changes = {}
+        for name in self.host_link_attributes:
+            if name in data and snapshot.get(name) != data[name]:
+                snapshot[name] = changes[name] = data[name]
+        if changes and not initial:
+            self.host_snapshots_changes.setdefault(host_name, {}).update(changes)
+
+    def queue_host_snapshots(self):
+        """
+        Queues the writes of the host attributes that changed since the last
+        call to their services
+        """
+        changes, self.host_snapshots_changes = self.host_snapshots_changes, {}
+        for host_name, attributes in changes.items():
+            self.queue_operation(
+                "services",
+                UpdateMany(
+                    {"host_name": host_name},
+                    {"$set": dict([
+                        ("__host__.%s" % name, value)
+                        for name, value in attributes.items()
+                    ])}
+                )
             )
 
-    def cleanup_old_objects(self, instance_id):
+    def cleanup_old_objects(self, instance_id, skip=()):
         """
         Removes previous versions of objects for a given instance
+
+        :param int instance_id: The instance id
+        :param list skip: The collections known to only hold up to date
+                          objects
         """
         collections = [
             "hosts",
@@ -507,7 +1082,10 @@ class DataManager(object):
             "problems",
         ]
         instance_version = self.instances[instance_id]
+        self.fingerprints.expire(instance_id, instance_version)
         for name in collections:
+            if name in skip:
+                continue
             collection = getattr(self.db, name)
             collection.delete_many(
                 {
@@ -641,7 +1219,14 @@ class DataManager(object):
                 log['host_name'],
                 log['service_description']
             )
-        self.db.log.insert_one(log)
+        if isinstance(log.get('time'), (int, long)):
+            # Used by the retention TTL index
+            log['date'] = datetime.datetime.utcfromtimestamp(log['time'])
+        self.bulk_logs.append(log)
+        self.bulk_pending += 1
+        if self.bulk_since is None:
+            self.bulk_since = time.time()
+        self.counters.increment("log_message")
 
     def update_object(self, object_type, brok):
         """
@@ -677,34 +1262,125 @@ class DataManager(object):
             object_name = data["%s_name" % object_type]
         data["_id"] = object_name
 
+        for name in self.lower_attributes.get("%ss" % object_type, ()):
+            value = data.get(name)
+            if isinstance(value, basestring):
+                data["%s__lower" % name] = self.get_lower_value(value)
+
         # Manages downtimes, comments and problems
         if object_type in ("host", "service"):
-            if "comments" in data:
-                self.add_comments(data, "downtimes")
-                self.cleanup_comments(data, "comments")
-            if "downtimes" in data:
-                self.add_comments(data, "comments")
-                self.cleanup_comments(data, "downtimes")
+            for kind in ("comments", "downtimes"):
+                if kind in data:
+                    self.update_comments(data, kind)
             if "is_problem" in data:
-                self.add_problems(data)
-
-        collection = getattr(self.db, "%ss" % object_type)
-        collection.update(
-            {"_id": object_name},
-            {"$set": data},
-            upsert=True
+                self.update_problems(data)
+            # Initial broks links are computed once all are received
+            initial = brok.type.startswith("initial_")
+            if not initial:
+                if object_type == "host":
+                    groups = self.links.hosts.get(object_name)
+                    self.links.update_host(object_name, data)
+                    if self.links.hosts.get(object_name) != groups:
+                        # The host services are counted in other groups
+                        for service in self.links.host_services.get(object_name, ()):
+                            self.update_service_states(service, {})
+                else:
+                    self.links.update_service(object_name, data)
+                    self.update_service_states(object_name, data)
+                self.overview.set_object("%ss" % object_type, object_name, data)
+            if object_type == "host":
+                self.update_host_snapshot(object_name, data, initial)
+            elif initial and data["host_name"] in self.host_snapshots:
+                # Services are created by their initial brok
+                data["__host__"] = dict(self.host_snapshots[data["host_name"]])
+
+        collection = self.get_collection_name(
+            "%ss" % object_type,
+            data["instance_id"]
+        )
+        if self.is_staging_collection(collection):
+            # Staging collections are filled from scratch
+            self.queue_update(collection, object_name, data)
+            return data
+
+        # Only write attributes that changed since the last write
+        changed = self.fingerprints.diff(
+            collection,
+            object_name,
+            data,
+            data["instance_id"],
+            data["instance_version"]
         )
+        if changed:
+            self.queue_update(collection, object_name, changed)
+        else:
+            self.counters.increment("object_skips")
         return data
 
-    def add_comments(self, data, kind):
+    def side_changed(self, collection, data, digest):
+        """
+        Tells if the documents an object holds in a side collection
+        (comments, downtimes or problems) changed since they were last
+        written, comparing a digest of their source data
+
+        The instance version is part of the digest, so that the documents
+        are rewritten with the new version when the instance re-syncs,
+        instead of being removed by the old versions cleanup.
+
+        :param str collection: The side collection name
+        :param dict data: The object data
+        :param digest: The side documents source data
+        :rtype: bool
+        """
+        name = self.get_collection_name(collection, data["instance_id"])
+        if self.is_staging_collection(name):
+            # Staging collections are filled from scratch
+            return True
+        changed = self.fingerprints.diff(
+            collection,
+            data["_id"],
+            {"digest": (digest, data["instance_version"])},
+            data["instance_id"],
+            data["instance_version"]
+        )
+        if not changed:
+            self.counters.increment("side_skips")
+        return bool(changed)
+
+    def update_comments(self, data, kind):
+        """
+        Updates an object comment or downtime ids, and writes them to their
+        collection if they changed
+
+        :param dict data: The brok data
+        :param str kind: Is this a comment or a downtime ?
+        """
+        write = self.side_changed(kind, data, data[kind])
+        self.add_comments(data, kind, write=write)
+        if write is True:
+            self.cleanup_comments(data, kind)
+
+    def update_problems(self, data):
+        """
+        Writes an object problem if it changed
+
+        :param dict data: The brok data
+        """
+        digest = (data["is_problem"], data.get("impacts"), data.get("contacts"))
+        if self.side_changed("problems", data, digest):
+            self.add_problems(data)
+
+    def add_comments(self, data, kind, write=True):
         """
         Add separate comment or downtime objects from data
 
         :param dict data: The brok data
+        :param str kind: Is this a comment or a downtime ?
+        :param bool write: Should the comment objects be written, or only
+                           the parent object data be updated
         :rtype: dict
         :retun: The modified data
         """
-        collection = getattr(self.db, kind)
         kind_with_info = "%s_with_info" % kind
         data[kind_with_info] = []
         for i, item in enumerate(data[kind]):
@@ -722,11 +1398,11 @@ class DataManager(object):
             item["instance_id"] = data["instance_id"]
             item["instance_version"] = data["instance_version"]
             # Adds item
-            collection.update(
-                {"_id": item["id"]},
-                {"$set": item},
-                upsert=True
-            )
+            if write is True:
+                self.queue_operation(
+                    self.get_collection_name(kind, data["instance_id"]),
+                    UpdateOne({"_id": item["id"]}, {"$set": item}, upsert=True)
+                )
             # Update parent object
             data[kind][i] = item["id"]
             data[kind_with_info].append(
@@ -742,7 +1418,6 @@ class DataManager(object):
         :rtype: dict
         :retun: The modified data
         """
-        collection = getattr(self.db, kind)
         if "service_description" in data:
             service_id = "%s/%s" % (
                 data["host_name"],
@@ -759,7 +1434,10 @@ class DataManager(object):
             }
         if data[kind]:
             query["_id"] = {"$nin": data[kind]}
-        collection.delete_many(query)
+        self.queue_operation(
+            self.get_collection_name(kind, data["instance_id"]),
+            DeleteMany(query)
+        )
         return data
 
     def add_problems(self, data):
@@ -788,14 +1466,14 @@ class DataManager(object):
                 "instance_id": data["instance_id"],
                 "instance_version": data["instance_version"],
             }
-            self.db.problems.update(
-                {"_id": data["_id"]},
-                {"$set": problem},
-                upsert=True
+            self.queue_operation(
+                self.get_collection_name("problems", data["instance_id"]),
+                UpdateOne({"_id": data["_id"]}, {"$set": problem}, upsert=True)
             )
         else:
-            self.db.problems.delete_one(
-                {"_id": data["_id"]}
+            self.queue_operation(
+                self.get_collection_name("problems", data["instance_id"]),
+                DeleteOne({"_id": data["_id"]})
             )
 
     def make_stack(self):
@@ -839,6 +1517,91 @@ class DataManager(object):
         """
         return self.mapping[table][attribute].get("datatype")
 
+    def get_lower_attribute(self, table, attrname):
+        """
+        Returns the name of the lowercase copy of an attribute, if the
+        table collection has one
+
+        :param str table: The table the attribute is in
+        :param str attrname: The attribute name
+        :rtype: str
+        :return: The lowercase copy name, or None
+        """
+        if attrname in self.lower_attributes.get(self.get_table_collection(table), ()):
+            return "%s__lower" % attrname
+        return None
+
+    def get_lower_value(self, value):
+        """
+        Returns the lowercase form of a value, as written to the lowercase
+        copies: byte strings are decoded from UTF-8 first, so that non
+        ASCII characters are lowercased too
+
+        :param value: The value
+        :rtype: unicode
+        """
+        if isinstance(value, str):
+            value = value.decode("utf-8", "replace")
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        return value.lower()
+
+    def get_regex_prefix(self, reg):
+        """
+        Returns the literal prefix a regular expression is anchored to,
+        such as `web-` for `^web-[0-9]+`
+
+        :param str reg: The regular expression
+        :rtype: str
+        :return: The literal prefix, empty if there is none
+        """
+        if not reg.startswith("^") or "|" in reg:
+            return ""
+        prefix = []
+        for char in reg[1:]:
+            if char in ".^$*+?{}[]()\\":
+                if char in "*?{" and prefix:
+                    # The last character is optional
+                    prefix.pop()
+                break
+            prefix.append(char)
+        return "".join(prefix)
+
+    def get_prefix_filter(self, range_attrname, attrname, reg, regex):
+        """
+        Builds a regular expression filter. If the expression is anchored
+        to a literal prefix, the filter is completed by an index friendly
+        range on `range_attrname`, the regular expression only being
+        applied to the documents in the range.
+
+        :param str range_attrname: The attribute to apply the range to
+        :param str attrname: The attribute to match against `regex`
+        :param str reg: The regular expression source
+        :param regex: The compiled regular expression
+        :rtype: dict
+        :return: The filter statement
+        """
+        if isinstance(reg, str):
+            try:
+                reg = reg.decode("utf-8")
+            except UnicodeDecodeError:
+                return {attrname: regex}
+        prefix = self.get_regex_prefix(reg)
+        # Strings are compared by code point, the upper bound is the
+        # prefix with its last character incremented. Surrogates (non BMP
+        # characters on narrow builds) can't be incremented.
+        if not prefix or u"\ud800" <= prefix[-1] <= u"\udfff" or \
+                prefix[-1] == u"\uffff":
+            return {attrname: regex}
+        upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        return {
+            "$and": [
+                {range_attrname: {"$gte": prefix}},
+                {range_attrname: {"$lt": upper}},
+                {attrname: regex},
+            ]
+        }
+
     def add_filter_eq(self, stack, table, attribute, reference):
         """
         Transposes an equalitiy operator filter into a mongo query
@@ -910,8 +1673,14 @@ class DataManager(object):
         attrtype = self.get_column_datatype(table, attribute)
         if attrtype is list:
             raise LiveStatusQueryError(450, 'operator not available for lists')
+        lower_attrname = self.get_lower_attribute(table, attrname)
+        if lower_attrname is not None:
+            stack.append({
+                lower_attrname: {"$eq": self.get_lower_value(reference)}
+            })
+            return
         # Builds regular expression
-        reg = "^%s$" % reference
+        reg = u"^%s$" % re.escape(self.get_lower_value(reference))
         stack.append({
             attrname: re.compile(reg, re.IGNORECASE)
         })
@@ -936,9 +1705,12 @@ class DataManager(object):
                 }
             })
         else:
-            stack.append({
-                attrname: re.compile(reg)
-            })
+            stack.append(self.get_prefix_filter(
+                attrname,
+                attrname,
+                reg,
+                re.compile(reg)
+            ))
 
     def add_filter_reg_ci(self, stack, table, attribute, reference):
         """
@@ -963,9 +1735,18 @@ class DataManager(object):
                 }
             })
         else:
-            stack.append({
-                attrname: re.compile(reg, re.IGNORECASE)
-            })
+            lower_attrname = self.get_lower_attribute(table, attrname)
+            if lower_attrname is None:
+                stack.append({
+                    attrname: re.compile(reg, re.IGNORECASE)
+                })
+            else:
+                stack.append(self.get_prefix_filter(
+                    lower_attrname,
+                    attrname,
+                    self.get_lower_value(reg),
+                    re.compile(reg, re.IGNORECASE)
+                ))
 
     def add_filter_lt(self, stack, table, attribute, reference):
         """
@@ -1137,8 +1918,14 @@ class DataManager(object):
         attrtype = self.get_column_datatype(table, attribute)
         if attrtype is list:
             raise LiveStatusQueryError(452, 'operator not available for lists')
+        lower_attrname = self.get_lower_attribute(table, attrname)
+        if lower_attrname is not None:
+            stack.append({
+                lower_attrname: {"$ne": self.get_lower_value(reference)}
+            })
+            return
         # Builds regular expression
-        reg = "^%s$" % reference
+        reg = u"^%s$" % re.escape(self.get_lower_value(reference))
         stack.append({
             attrname: {
                 "$not": re.compile(reg, re.IGNORECASE)
@@ -1480,98 +2267,65 @@ class DataManager(object):
         del stack[-count:]
         stack.append(or_filter)
 
-    def stack_filter_negate(self, stack, count, wrap=True):
+    def stack_filter_negate(self, stack, count):
         """
         Inverts the logic of the previous filters stack
 
         As there's no global $not operator in MongoDB query ($not can only
-        be applied to an attribute), we're forced to negate by inverting
-        the query logic itself.
+        be applied to an attribute), the statements are negated by a $nor.
+        The filters optimization pushes the negation down to the
+        statements having an exact negation.
 
         :param list stack: The stack to append filter to
         :param int count: The number of statements to negate
-        :param bool wrap: Should the result be wrapped in an "$or"
         """
         if not count:
             count = len(stack)
         if len(stack) < count:
             raise LiveStatusQueryError(452, 'No enough filters to stack into `negate`')
-        # Negates each element in the stack
-        for i in range(len(stack)-count, len(stack)):
-            statement = stack[i]
+        statements = stack[-count:]
+        for statement in statements:
             if isinstance(statement, list):
                 raise LiveStatusQueryError(452, 'Cannot negate aggregation stats')
-            stack[i] = self.stack_filter_negate_statement(statement)
-        if wrap is True:
-            reversed_stack = list(stack[-count:])
-            del stack[-count:]
-            stack.append({
-                "$or": reversed_stack
-            })
+        del stack[-count:]
+        stack.append({
+            "$nor": [self.make_filter_query(statements)]
+        })
         return stack
 
-    def stack_filter_negate_statement(self, statement):
+    def get_scalar_attributes(self, table):
         """
-        Inverts the logic of a single statement
+        Returns the attributes of a table known not to hold lists
 
-        As there's no global $not operator in MongoDB query ($not can only
-        be applied to an attribute), we're forced to negate by inverting
-        the query logic itself.
+        :param str table: The table name
+        :rtype: set
+        """
+        attributes = self.scalar_attributes.get(table)
+        if attributes is None:
+            attributes = set()
+            for column, mapping in self.mapping[table].items():
+                datatype = mapping.get("datatype")
+                if datatype is None or datatype is list or \
+                        mapping.get("filters") == {}:
+                    continue
+                attrname = mapping.get("filters", {}).get("attr", column)
+                attributes.add(attrname)
+                attributes.add("%s__lower" % attrname)
+            self.scalar_attributes[table] = attributes
+        return attributes
 
-        :param dict statement: The statement to negate
-        :rtype: dict
-        :return: The negated statement
-        """
-        reversed_operators = {
-            "$eq": "$ne",
-            "$ne": "$eq",
-            "$gt": "$le",
-            "$le": "$gt",
-            "$ge": "$lt",
-            "$lt": "$ge",
-            "$in": "$nin",
-            "$nin": "$in",
-            "$or": "$and",
-            "$and": "$or",
-        }
-        for attribute, comparator in list(statement.items()):
-            if attribute in ("$and", "$or"):
-                # Manages $and, $or, and other grouping statements
-                # Statement has pattern: {"$or": [...]} or {"$and": [...]}
-                # $or becomes $and and conversely
-                reversed_operator = reversed_operators[attribute]
-                stack = list(statement[attribute])
-                # There can't both $and or $or with another operartor
-                # Returning the value directly
-                return {
-                    reversed_operator: self.stack_filter_negate(
-                        stack=stack,
-                        count=len(stack),
-                        wrap=False
-                    )
-                }
-            # Statement has pattern: {field: comparator}
-            if isinstance(comparator, dict):
-                # Statement has pattern: {field: {"$eq": value}}
-                # {"$eq": value} becomes {"$ne": value} and so on...
-                for operator, value in list(comparator.items()):
-                    if operator == "$not":
-                        # Statement has pattern: {field: {"$not": value}}
-                        # {field: {"$not": value}} becomes {field: value}
-                        statement[attribute] = value
-                        break
-                    if operator not in reversed_operators:
-                        raise LiveStatusQueryError(452, 'Cannot negate statement %s' % statement)
-                    reversed_operator = reversed_operators[operator]
-                    del comparator[operator]
-                    comparator[reversed_operator] = value
-            else:
-                # Statement has pattern: {field: value}
-                # {field: value} becomes {field: {"$not": value}}
-                statement[attribute] = {
-                    "$not": statement[attribute]
-                }
-        return statement
+    def optimize_filters(self, table, stack):
+        """
+        Simplifies a filters stack before it is compiled into a query
+
+        :param str table: The table name
+        :param list stack: The filters stack
+        :rtype: list
+        :return: The optimized filters stack, or None if no object can
+                 match the filters
+        """
+        optimizer = FilterOptimizer(self.get_scalar_attributes(table))
+        return optimizer.optimize_stack(stack)
 
     def get_mongo_column_projection(self, table, column):
         """
@@ -1665,24 +2419,8 @@ class DataManager(object):
         """
         # If at least one attribtue from the service is requested, add
         # the $lookup pipeline stage
+        # Host attributes are embedded in the services documents
         lookup = []
-        if not projection or any([p.startswith("__host__.") for p in projection]):
-            lookup.extend([
-                {
-                    "$lookup": {
-                        "from": "hosts",
-                        "localField": "host_name",
-                        "foreignField": "host_name",
-                        "as": "__host__",
-                    },
-                },
-                {
-                    "$unwind": {
-                        "path": "$__host__",
-                        "preserveNullAndEmptyArrays": True
-                    }
-                }
-            ])
         if not projection or any([p.startswith("__host_services__.") for p in projection]):
             lookup.append(
                 {
@@ -1842,23 +2580,6 @@ class DataManager(object):
                     }
             }
         ]
-        if not projection or any([p.startswith("__host__.") for p in projection]):
-            lookup.extend([
-                {
-                    "$lookup": {
-                        "from": "hosts",
-                        "localField": "host_name",
-                        "foreignField": "host_name",
-                        "as": "__host__",
-                    }
-                },
-                {
-                    "$unwind": {
-                        "path": "__$host__",
-                        "preserveNullAndEmptyArrays": True
-                    }
-                }
-            ])
         if not projection or any([p.startswith("__servicegroup__.") for p in projection]):
             lookup.extend([
                 {
@@ -1914,23 +2635,6 @@ class DataManager(object):
                     }
             }
         ]
-        if not projection or any([p.startswith("__host__.") for p in projection]):
-            lookup.extend([
-                {
-                    "$lookup": {
-                        "from": "hosts",
-                        "localField": "host_name",
-                        "foreignField": "host_name",
-                        "as": "__host__",
-                    }
-                },
-                {
-                    "$unwind": {
-                        "path": "$__host__",
-                        "preserveNullAndEmptyArrays": True
-                    }
-                }
-            ])
         if not projection or any([p.startswith("__hostgroup__.") for p in projection]):
             lookup.extend([
                 {
@@ -2171,6 +2875,81 @@ class DataManager(object):
             )
         return lookup
 
+    def get_filter_conjuncts(self, stack):
+        """
+        Splits a filters stack into the list of statements that must all
+        match, flattening the $and statements
+
+        :param list stack: The filters stack
+        :rtype: list
+        :return: The statements
+        """
+        conjuncts = []
+        for statement in stack:
+            if len(statement) == 1 and "$and" in statement:
+                conjuncts.extend(self.get_filter_conjuncts(statement["$and"]))
+            elif statement:
+                conjuncts.append(statement)
+        return conjuncts
+
+    def get_filter_fields(self, statement, fields=None):
+        """
+        Returns the attributes a filter statement refers to
+
+        :param dict statement: The filter statement
+        :param set fields: The set to add attributes to
+        :rtype: set
+        :return: The attributes names
+        """
+        if fields is None:
+            fields = set()
+        for attribute, comparator in statement.items():
+            if not attribute.startswith("$"):
+                fields.add(attribute)
+            elif isinstance(comparator, list):
+                for sub_statement in comparator:
+                    if isinstance(sub_statement, dict):
+                        self.get_filter_fields(sub_statement, fields)
+            elif isinstance(comparator, dict):
+                self.get_filter_fields(comparator, fields)
+        return fields
+
+    def get_joined_fields(self, table):
+        """
+        Returns the names of the attributes added or modified by the table
+        $lookup and $unwind stages
+
+        :param str table: The table name
+        :rtype: set
+        :return: The joined attributes names
+        """
+        get_expand_fct = getattr(self, "get_mongo_expand_%s" % table, None)
+        if get_expand_fct is None:
+            return set()
+        joined = set()
+        # An empty projection returns all the possible stages
+        for stage in get_expand_fct(table, []):
+            if "$lookup" in stage:
+                joined.add(stage["$lookup"]["as"])
+            elif "$unwind" in stage:
+                joined.add(stage["$unwind"]["path"].lstrip("$"))
+        return joined
+
+    def make_filter_query(self, conjuncts):
+        """
+        Builds a filter query matching all the statements
+
+        :param list conjuncts: The filter statements
+        :rtype: dict
+        :return: The filter query
+        """
+        if len(conjuncts) > 1:
+            return {"$and": conjuncts}
+        elif conjuncts:
+            return conjuncts[0]
+        else:
+            return {}
+
     def get_filter_query(self, table, stack, columns=None, limit=None, sort=None, query_format=None):
         """
         Generates the final filter query from the list of queries in
@@ -2185,14 +2964,6 @@ class DataManager(object):
         :rtype: dict/list
         :return: The filter query
         """
-        if stack:
-            if len(stack) > 1:
-                query = {"$and": stack}
-            else:
-                query = stack[0]
-        else:
-            query = {}
-
         columns = self.filter_query_columns(table, columns)
         projection = self.get_mongo_columns_projection(table, columns)
         groupby = self.grouping_tables.get(table)
@@ -2209,28 +2980,46 @@ class DataManager(object):
         get_expand_fct_name = "get_mongo_expand_%s" % table
         get_expand_fct = getattr(self, get_expand_fct_name, None)
 
+        # Filter statements only referring to the collection own attributes
+        # are matched before joining other collections, so that only the
+        # matching documents are joined. The others are matched once the
+        # attributes they refer to are joined.
+        pre_filters = []
+        post_filters = []
+        post_fields = set()
+        joined = self.get_joined_fields(table)
+        for statement in self.get_filter_conjuncts(stack):
+            fields = self.get_filter_fields(statement)
+            if any([f.split(".")[0] in joined for f in fields]):
+                post_filters.append(statement)
+                post_fields.update(fields)
+            else:
+                pre_filters.append(statement)
+
         # Builds lookup cross collection links
-        # pre lookups are used to initially filter columns where a filter
-        # is allowed, post lookups are used to link other non filterable
-        # collections
+        # pre lookups are needed by the post join filters, post lookups
+        # are used to link the collections the displayed columns need
         lookup = {}
         if get_expand_fct:
+            if post_fields:
+                lookup["pre"] = get_expand_fct(table, list(post_fields))
             for section in projection:
-                stages = get_expand_fct(table, projection[section])
-                if stages:
-                    lookup[section] = stages
+                for stage in get_expand_fct(table, projection[section]):
+                    if stage not in lookup.get("pre", []) and \
+                            stage not in lookup.get("post", []):
+                        lookup.setdefault("post", []).append(stage)
 
         # If another collection $lookup is necessary, use an aggregation
         # rather than a search
         if lookup or query_format == "aggregation":
-            pipeline = []
-            # As an optimization, we dissociate projection attributes where
-            # a columns had a filter from those that only have to be displayed
-            # This allows to limit the number or link cross collections
-            pipeline.extend(lookup.get("pre", []))
-            pipeline.append(
-                {"$match": query}
-            )
+            pipeline = [
+                {"$match": self.make_filter_query(pre_filters)}
+            ]
+            if post_filters:
+                pipeline.extend(lookup.get("pre", []))
+                pipeline.append(
+                    {"$match": self.make_filter_query(post_filters)}
+                )
             pipeline.extend(lookup.get("post", []))
             # Skip the $project stage if query_format is `aggregation` because
             # it's done in the calling method
@@ -2257,7 +3046,7 @@ class DataManager(object):
             return pipeline
         else:
             parms = {
-                "filter": query,
+                "filter": self.make_filter_query(pre_filters + post_filters),
                 "projection": full_projection,
             }
             if sort is None:
@@ -2268,17 +3057,27 @@ class DataManager(object):
                 parms["limit"] = limit
             return parms
 
-    def get_aggregation_query(self, table, filter_stack, query, columns=None):
+    def get_stats_query(self, table, filter_stack, stats, columns=None):
         """
-        Generates the final aggregation query from the list of queries in
-        mongo_stats_filters
+        Generates a single aggregation query computing all the stats of
+        a query in one pass over the matching documents
+
+        Each stat is computed by a `$facet` sub-pipeline, results of the
+        stat at index `i` being found in the `s<i>` attribute of the
+        single returned document. Stats filters are applied in their
+        sub-pipeline, using the same query language as the filters.
+
+        The returned document is subject to the 16MB BSON document size
+        limit, which stats grouped by columns may exceed: the query has
+        then to be run by `aggregate_stats()`.
 
         :param str table: The table name
-        :param dict filter_query: The initial filter query limitting the
-                                  aggregation scope
-        :param list,dict query: The aggregation/stats query
+        :param list filter_stack: The filters limitting the stats scope
+        :param list stats: The aggregation/stats queries
+        :param list columns: The columns to group stats by
         :rtype: list
-        :return: The aggregation query
+        :return: The aggregation query, or None if no stat can match any
+                 document
         """
         groupby = self.grouping_tables.get(table)
 
@@ -2287,18 +3086,49 @@ class DataManager(object):
         elif columns is None:
             columns = []
 
-        if isinstance(query, list):
-            pipeline = self.get_filter_query(table, filter_stack, columns, query_format="aggregation")
-            pipeline.extend(query)
-        else:
-            # The query is a stat filter, and needs to be enclosed in a count
-            # aggregation
-            stack = list(filter_stack)
-            stack.append(query)
-            pipeline = self.get_filter_query(table, stack, columns, query_format="aggregation")
-            stack = []
-            self.add_aggregation_count(stack, table, columns=columns)
-            pipeline.extend(stack.pop(0))
+        pipeline = self.get_filter_query(table, filter_stack, columns, query_format="aggregation")
+        # Documents order does not matter to groups
+        pipeline = [stage for stage in pipeline if "$sort" not in stage]
+
+        facets = {}
+        fields = set()
+        for i, query in enumerate(stats):
+            if isinstance(query, list):
+                facet = list(query)
+                for stage in query:
+                    for accumulator in stage.get("$group", {}).values():
+                        if isinstance(accumulator, dict):
+                            for expr in accumulator.values():
+                                if isinstance(expr, basestring):
+                                    fields.add(expr.lstrip("$"))
+            else:
+                # The query is a stat filter, and needs to be enclosed in
+                # a count aggregation
+                query = FilterOptimizer(
+                    self.get_scalar_attributes(table)).optimize(query)
+                if query is None:
+                    # No document can match, the stat is 0
+                    continue
+                facet = [{"$match": query}]
+                self.get_filter_fields(query, fields)
+                count = []
+                self.add_aggregation_count(count, table, columns=columns)
+                facet.extend(count.pop(0))
+            facets["s%d" % i] = facet
+
+        # Links the collections the stats need
+        get_expand_fct = getattr(self, "get_mongo_expand_%s" % table, None)
+        joined = self.get_joined_fields(table)
+        fields = [f for f in fields if f.split(".")[0] in joined]
+        if get_expand_fct is not None and fields:
+            for stage in get_expand_fct(table, fields):
+                if stage not in pipeline:
+                    pipeline.append(stage)
+
+        if not facets:
+            # None of the stats can match a document
+            return None
+        pipeline.append({"$facet": facets})
         return pipeline
 
     def filter_query_columns(self, table, columns):
@@ -2324,12 +3154,20 @@ class DataManager(object):
 
         :param str table: The table name
         """
+        return getattr(self.db, self.get_table_collection(table))
+
+    def get_table_collection(self, table):
+        """
+        Returns the name of the collection holding a table objects
+
+        :param str table: The table name
+        :rtype: str
+        """
         match = re.match("^([a-z]+)by([a-z]+)$", table)
         if match is not None:
-            collection = match.group(1)
+            return match.group(1)
         else:
-            collection = table
-        return getattr(self.db, collection)
+            return table
 
     def find(self, table, query):
         """
@@ -2344,6 +3182,26 @@ class DataManager(object):
         else:
             return collection.find(**query)
 
+    def explain(self, table, query):
+        """
+        Returns the mongo explain output of a find or aggregate query,
+        with its execution statistics
+
+        :param str table: The queried table
+        :param dict/list query: The find parameters or pipeline
+        :rtype: dict
+        :return: The explain output
+        """
+        collection = self.get_collection(table)
+        if isinstance(query, list):
+            return self.db.command(
+                "explain",
+                {"aggregate": collection.name, "pipeline": query, "cursor": {}},
+                verbosity="executionStats"
+            )
+        else:
+            return collection.find(**query).explain()
+
     def count(self, table, query):
         """
         General purpose MongoDB count() query
@@ -2364,6 +3222,46 @@ class DataManager(object):
         collection = self.get_collection(table)
         return collection.aggregate(query)
 
+    def aggregate_stats(self, table, query):
+        """
+        Runs a stats query generated by `get_stats_query()`
+
+        When the `$facet` results of all the stats exceed the BSON document
+        size limit, which may happen with many groups, each stat is run by
+        its own pipeline instead.
+
+        :param str table: The table name
+        :param list query: The stats query
+        :rtype: iterator
+        :return: The documents holding the stats results in their s<i>
+                 attribute
+        """
+        try:
+            return list(self.aggregate(table, query))
+        except OperationFailure as exp:
+            if exp.code not in self.document_size_errors:
+                raise
+        logger.info(
+            "[Livestatus Mongo] Stats results on %s exceed the document "
+            "size limit, running one pipeline per stat" % table
+        )
+        return self.iter_stats_facets(table, query)
+
+    def iter_stats_facets(self, table, query):
+        """
+        Runs each `$facet` sub-pipeline of a stats query separately
+
+        :param str table: The table name
+        :param list query: The stats query
+        :rtype: generator
+        :return: One document per stat result, holding it in its s<i>
+                 attribute
+        """
+        pipeline = query[:-1]
+        for name, facet in sorted(query[-1]["$facet"].items()):
+            for result in self.aggregate(table, pipeline + facet):
+                yield {name: [result]}
+
     def is_timeperiod_active(self, timeperiod_name, raise_error=True):
         """
         Checks if a timeperiod is currently active or not
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+from cStringIO import StringIO
+
+# The fastest available json backend
+try:
+    from ujson import dumps, loads
+except ImportError:
+    try:
+        from simplejson import dumps, loads, JSONEncoder
+        # ujson's dumps() cannot handle a separator parameter, which is
+        # needed to avoid unnecessary spaces in the json output
+        # That's why simplejson and json manipulate the encoder class
+        JSONEncoder.item_separator = ','
+        JSONEncoder.key_separator = ':'
+    except ImportError:
+        from json import dumps, loads, JSONEncoder
+        JSONEncoder.item_separator = ','
+        JSONEncoder.key_separator = ':'
+
+# The binary output formats are only available with msgpack
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+binary_formats = ("msgpack", "msgpack_columns")
+
+
+class ListEncoder(object):
+    """
+    Encodes chunks of rows into a list, the concatenated chunks forming
+    the whole output
+
+    The rows of a chunk are encoded by a single call to the `dump`
+    backend, the list brackets of the chunk being replaced by the
+    separators joining it to the previous and next chunks.
+
+    :param Separators separators: The response separators
+    """
+
+    # Separator between two rows
+    separator = ","
+    # Function encoding a list of rows, including its brackets
+    dump = staticmethod(dumps)
+
+    def __init__(self, separators):
+        self.separators = separators
+
+    def encode(self, rows, first=True, last=True):
+        """
+        Encodes a chunk of rows
+
+        :param list rows: The rows
+        :param bool first: True if this is the first chunk of the output
+        :param bool last: True if this is the last chunk of the output
+        :rtype: str
+        """
+        if rows:
+            body = self.dump(rows)[1:-1]
+        else:
+            body = ""
+        if first:
+            prefix = "["
+        elif body:
+            prefix = self.separator
+        else:
+            prefix = ""
+        if last:
+            return "%s%s]" % (prefix, body)
+        return "%s%s" % (prefix, body)
+
+
+class JsonEncoder(ListEncoder):
+    """
+    Encodes rows in json, using the fastest available backend
+    """
+
+
+class PythonEncoder(ListEncoder):
+    """
+    Encodes rows as a python list representation
+    """
+
+    separator = ", "
+    dump = staticmethod(repr)
+
+
+class CsvEncoder(object):
+    """
+    Encodes rows in csv, using the response field and line separators
+
+    The values must already be strings. The rows are written to a buffer
+    reused from one chunk to the next.
+
+    :param Separators separators: The response separators
+    """
+
+    def __init__(self, separators):
+        self.separators = separators
+        self.buffer = StringIO()
+        self.writer = csv.writer(
+            self.buffer,
+            delimiter=separators.field,
+            lineterminator=separators.line
+        )
+
+    def encode(self, rows, first=True, last=True):
+        """
+        Encodes a chunk of rows
+
+        :param list rows: The rows
+        :param bool first: True if this is the first chunk of the output
+        :param bool last: True if this is the last chunk of the output
+        :rtype: str
+        """
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerows(rows)
+        return self.buffer.getvalue()
+
+
+class MsgpackEncoder(object):
+    """
+    Encodes rows as a stream of msgpack arrays, one per row, keeping the
+    values types. Clients read the rows with a msgpack Unpacker.
+
+    :param Separators separators: The response separators
+    """
+
+    def __init__(self, separators):
+        self.separators = separators
+        self.packer = msgpack.Packer(use_bin_type=False)
+
+    def encode(self, rows, first=True, last=True):
+        """
+        Encodes a chunk of rows
+
+        :param list rows: The rows
+        :param bool first: True if this is the first chunk of the output
+        :param bool last: True if this is the last chunk of the output
+        :rtype: str
+        """
+        if not rows:
+            return ""
+        # The rows are packed by a single call as an array, whose header
+        # is then skipped
+        return self.packer.pack(rows)[self.get_array_header_size(rows):]
+
+    def get_array_header_size(self, values):
+        if len(values) < 16:
+            return 1
+        elif len(values) < 65536:
+            return 3
+        else:
+            return 5
+
+
+class MsgpackColumnsEncoder(MsgpackEncoder):
+    """
+    Encodes rows as a stream of msgpack column blocks, one per chunk:
+    an array holding an array of values per column, that may be loaded
+    as is into numpy arrays. The header row, if any, is sent first as an
+    array of its own.
+
+    :param Separators separators: The response separators
+    :param bool headers: True if the first row is the header row
+    """
+
+    def __init__(self, separators, headers=False):
+        super(MsgpackColumnsEncoder, self).__init__(separators)
+        self.headers = headers
+
+    def encode(self, rows, first=True, last=True):
+        data = ""
+        if first and self.headers and rows:
+            data = self.packer.pack(rows[0])
+            rows = rows[1:]
+        if rows:
+            data += self.packer.pack([list(c) for c in zip(*rows)])
+        return data
+
+
+def get_encoder(outputformat, separators, headers=False):
+    """
+    Returns the encoder of an output format
+
+    :param str outputformat: The response output format
+    :param Separators separators: The response separators
+    :param bool headers: True if the first encoded row is the header row
+    """
+    if outputformat == "json":
+        return JsonEncoder(separators)
+    elif outputformat == "msgpack":
+        return MsgpackEncoder(separators)
+    elif outputformat == "msgpack_columns":
+        return MsgpackColumnsEncoder(separators, headers)
+    elif outputformat.startswith("python"):
+        return PythonEncoder(separators)
+    else:
+        return CsvEncoder(separators)
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+# Type of the compiled regular expressions
+RegexType = type(re.compile(""))
+
+
+class FilterOptimizer(object):
+    """
+    Simplifies the filter statements built from the LQL filters stacks
+
+    The optimization flattens nested $and and $or statements, removes
+    duplicated statements, merges equalities on a same attribute in a $or
+    into a $in (and inequalities in an $and into a $nin), and pushes $nor
+    negations down to the statements having an exact negation.
+
+    Statements matching all documents are simplified to `{}`, and the
+    ones matching no document to None, so that the query does not need to
+    be executed.
+
+    :param set scalar_attributes: The attributes known not to hold lists,
+                                  which can't be equal to two different
+                                  values
+    """
+
+    negated_operators = {
+        "$eq": "$ne",
+        "$ne": "$eq",
+        "$in": "$nin",
+        "$nin": "$in",
+    }
+
+    def __init__(self, scalar_attributes=()):
+        self.scalar_attributes = scalar_attributes
+
+    def optimize_stack(self, stack):
+        """
+        Optimizes a filters stack, whose statements must all match
+
+        :param list stack: The filters stack
+        :rtype: list
+        :return: The optimized stack, or None if no document can match
+        """
+        statement = self.optimize({"$and": list(stack)})
+        if statement is None:
+            return None
+        elif not statement:
+            return []
+        elif statement.keys() == ["$and"]:
+            return statement["$and"]
+        else:
+            return [statement]
+
+    def optimize(self, statement):
+        """
+        Optimizes a filter statement
+
+        :param dict statement: The statement
+        :rtype: dict
+        :return: The optimized statement, `{}` if it matches all documents,
+                 or None if it matches none
+        """
+        if not statement:
+            return {}
+        if len(statement) > 1:
+            # Implicit $and
+            return self.optimize({
+                "$and": [{k: v} for k, v in sorted(statement.items())]
+            })
+        key, value = statement.items()[0]
+        if key == "$and":
+            return self.optimize_and(value)
+        elif key == "$or":
+            return self.optimize_or(value)
+        elif key == "$nor":
+            return self.optimize_nor(value)
+        elif isinstance(value, dict):
+            if value.get("$in", None) == [] and len(value) == 1:
+                return None
+            if value.get("$nin", None) == [] and len(value) == 1:
+                return {}
+        return statement
+
+    def optimize_and(self, statements):
+        conjuncts = []
+        for statement in statements:
+            statement = self.optimize(statement)
+            if statement is None:
+                return None
+            elif not statement:
+                continue
+            elif statement.keys() == ["$and"]:
+                conjuncts.extend(statement["$and"])
+            else:
+                conjuncts.append(statement)
+        conjuncts = self.merge(conjuncts, "$ne", "$nin")
+        if self.is_contradiction(conjuncts):
+            return None
+        return self.make_statement("$and", conjuncts, {})
+
+    def optimize_or(self, statements):
+        disjuncts = []
+        for statement in statements:
+            statement = self.optimize(statement)
+            if statement is None:
+                continue
+            elif not statement:
+                return {}
+            elif statement.keys() == ["$or"]:
+                disjuncts.extend(statement["$or"])
+            else:
+                disjuncts.append(statement)
+        disjuncts = self.merge(disjuncts, "$eq", "$in")
+        if self.is_tautology(disjuncts):
+            return {}
+        return self.make_statement("$or", disjuncts, None)
+
+    def optimize_nor(self, statements):
+        statement = self.optimize_or(statements)
+        if statement is None:
+            return {}
+        elif not statement:
+            return None
+        return self.negate(statement)
+
+    def negate(self, statement):
+        """
+        Negates an optimized statement, using the negated operator if it
+        has an exact negation, or a $nor otherwise
+        """
+        key, value = statement.items()[0]
+        if key == "$or":
+            return {"$nor": value}
+        elif key == "$nor":
+            return self.make_statement("$or", value, None)
+        elif not key.startswith("$"):
+            comparison = self.get_comparison(statement)
+            if comparison is not None:
+                attribute, operator, reference = comparison
+                return {
+                    attribute: {self.negated_operators[operator]: reference}
+                }
+        return {"$nor": [statement]}
+
+    def make_statement(self, operator, statements, empty):
+        if not statements:
+            return empty
+        elif len(statements) == 1:
+            return statements[0]
+        return {operator: statements}
+
+    def get_comparison(self, statement):
+        """
+        Returns the (attribute, operator, reference) of a statement
+        comparing an attribute with the $eq, $ne, $in or $nin operators
+
+        :rtype: tuple
+        :return: The comparison, or None if the statement is not a
+                 comparison
+        """
+        if len(statement) != 1:
+            return None
+        attribute, condition = statement.items()[0]
+        if attribute.startswith("$"):
+            return None
+        if isinstance(condition, dict):
+            if len(condition) != 1:
+                return None
+            operator, reference = condition.items()[0]
+            if operator in ("$eq", "$ne") and self.is_scalar(reference):
+                return attribute, operator, reference
+            elif operator in ("$in", "$nin") and isinstance(reference, list) \
+                    and all([self.is_scalar(r) for r in reference]):
+                return attribute, operator, reference
+        elif self.is_scalar(condition):
+            return attribute, "$eq", condition
+        return None
+
+    def is_scalar(self, value):
+        return value is None or \
+            isinstance(value, (bool, int, long, float, basestring))
+
+    def get_key(self, value):
+        """
+        Returns a hashable key identifying a statement or a value
+
+        Values are equal when MongoDB considers them equal: numbers are
+        compared by value whatever their type (`1`, `1L` and `1.0` are
+        equal), and strings by their text whether they are `str` (UTF-8
+        encoded) or `unicode` (`'x'` and `u'x'` are equal). Booleans are
+        only equal to booleans (`True` is not `1`), and values of other
+        types are only equal to values of the same type.
+        """
+        if isinstance(value, dict):
+            return tuple(sorted([
+                (k, self.get_key(v)) for k, v in value.items()
+            ]))
+        elif isinstance(value, (list, tuple)):
+            return ("list", tuple([self.get_key(v) for v in value]))
+        elif isinstance(value, RegexType):
+            return ("regex", value.pattern, value.flags)
+        elif isinstance(value, bool):
+            return ("bool", value)
+        elif isinstance(value, (int, long, float)):
+            return ("number", value)
+        elif isinstance(value, str):
+            return ("string", value.decode("utf-8", "replace"))
+        elif isinstance(value, unicode):
+            return ("string", value)
+        else:
+            return (type(value).__name__, value)
+
+    def merge(self, statements, operator, list_operator):
+        """
+        Removes duplicated statements, and merges the `operator` and
+        `list_operator` comparisons on a same attribute into a single
+        `list_operator` comparison
+
+        :param list statements: The statements
+        :param str operator: The single value operator ($eq or $ne)
+        :param str list_operator: The values list operator ($in or $nin)
+        :rtype: list
+        :return: The merged statements
+        """
+        merged = []
+        seen = set()
+        values = {}
+        for statement in statements:
+            key = self.get_key(statement)
+            if key in seen:
+                continue
+            seen.add(key)
+            comparison = self.get_comparison(statement)
+            if comparison is not None and \
+                    comparison[1] in (operator, list_operator):
+                attribute, op, reference = comparison
+                if attribute not in values:
+                    values[attribute] = []
+                    # Keeps the position of the first comparison
+                    merged.append(attribute)
+                if op == operator:
+                    reference = [reference]
+                for value in reference:
+                    if self.get_key(value) not in \
+                            [self.get_key(v) for v in values[attribute]]:
+                        values[attribute].append(value)
+            else:
+                merged.append(statement)
+        statements = []
+        for statement in merged:
+            if not isinstance(statement, basestring):
+                statements.append(statement)
+            elif len(values[statement]) == 1:
+                statements.append({statement: {operator: values[statement][0]}})
+            else:
+                statements.append({statement: {list_operator: values[statement]}})
+        return statements
+
+    def get_comparisons(self, statements):
+        """
+        Returns the merged comparisons of the statements, per attribute
+        and operator
+        """
+        comparisons = {}
+        for statement in statements:
+            comparison = self.get_comparison(statement)
+            if comparison is not None:
+                attribute, operator, reference = comparison
+                if operator in ("$eq", "$ne"):
+                    reference = [reference]
+                comparisons.setdefault(attribute, {}).setdefault(
+                    operator, []).extend(reference)
+        return comparisons
+
+    def is_contradiction(self, conjuncts):
+        """
+        Tells if statements can't all match a same document: an attribute
+        equal and not equal to a same value, or a scalar attribute equal to
+        different values
+        """
+        for attribute, operators in self.get_comparisons(conjuncts).items():
+            equal = [self.get_key(v) for v in operators.get("$eq", [])]
+            included = [self.get_key(v) for v in operators.get("$in", [])]
+            excluded = [
+                self.get_key(v) for v in
+                operators.get("$ne", []) + operators.get("$nin", [])
+            ]
+            if [v for v in equal if v in excluded]:
+                return True
+            if attribute not in self.scalar_attributes:
+                continue
+            if len(set(equal)) > 1:
+                return True
+            if "$in" in operators:
+                candidates = set(included) - set(excluded)
+                if equal:
+                    candidates &= set(equal)
+                if not candidates:
+                    return True
+        return False
+
+    def is_tautology(self, disjuncts):
+        """
+        Tells if one of the statements matches every document: an attribute
+        equal or not equal to a same value
+        """
+        for attribute, operators in self.get_comparisons(disjuncts).items():
+            equal = [
+                self.get_key(v) for v in
+                operators.get("$eq", []) + operators.get("$in", [])
+            ]
+            different = [self.get_key(v) for v in operators.get("$ne", [])]
+            if [v for v in different if v in equal]:
+                return True
+        return False
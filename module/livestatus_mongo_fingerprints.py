@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from array import array
+from collections import OrderedDict
+
+
+class FingerprintCache(object):
+    """
+    Keeps a fingerprint of each attribute of the objects written to the
+    database, in order to only write attributes whose value changed.
+
+    Fingerprints are stored as arrays of integers, attributes being
+    mapped to a slot shared by all the objects of a collection. The number
+    of objects is bounded, the least recently written ones being evicted
+    first. An evicted object is simply written in full on its next update.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.slots = {}
+            self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fingerprint(self, value):
+        """
+        Computes an attribute value fingerprint
+
+        The value class is part of the fingerprint so that True and 1, or
+        1 and 1.0 are not considered equal.
+
+        :param mixed value: The attribute value
+        :rtype: int
+        :return: The value fingerprint
+        """
+        try:
+            return hash((value.__class__, value))
+        except TypeError:
+            # Lists and dicts
+            return hash((value.__class__, repr(value)))
+
+    def diff(self, collection, object_id, data, instance_id=None,
+             instance_version=None):
+        """
+        Returns the attributes whose value changed since the object was
+        last written, and records the new values fingerprints.
+
+        All the attributes are returned for an unknown object.
+
+        :param str collection: The object collection
+        :param str object_id: The object id
+        :param dict data: The object attributes to write
+        :param int instance_id: The scheduler instance the object belongs to
+        :param int instance_version: The instance configuration version
+        :rtype: dict
+        :return: The changed attributes
+        """
+        if not self.maxsize:
+            return data
+        key = (collection, object_id)
+        with self.lock:
+            slots = self.slots.setdefault(collection, {})
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                fingerprints = array('l')
+                changed = data
+            else:
+                fingerprints = entry[2]
+                changed = {}
+            for name, value in data.iteritems():
+                slot = slots.get(name)
+                if slot is None:
+                    slot = slots[name] = len(slots)
+                if slot >= len(fingerprints):
+                    fingerprints.extend([0] * (len(slots) - len(fingerprints)))
+                fingerprint = self.fingerprint(value)
+                if fingerprints[slot] != fingerprint:
+                    fingerprints[slot] = fingerprint
+                    if entry is not None:
+                        changed[name] = value
+            self.entries[key] = (instance_id, instance_version, fingerprints)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return changed
+
+    def discard(self, collection, object_ids):
+        """
+        Forgets objects, for instance because their write failed
+
+        :param str collection: The objects collection
+        :param list object_ids: The objects ids
+        """
+        with self.lock:
+            for object_id in object_ids:
+                self.entries.pop((collection, object_id), None)
+
+    def discard_collection(self, collection):
+        """
+        Forgets all the objects of a collection
+
+        :param str collection: The objects collection
+        """
+        with self.lock:
+            for key in self.entries.keys():
+                if key[0] == collection:
+                    del self.entries[key]
+
+    def expire(self, instance_id, instance_version):
+        """
+        Forgets the objects of an instance that have not been written since
+        the instance configuration changed. They are removed from the
+        database by the instance cleanup.
+
+        :param int instance_id: The scheduler instance id
+        :param int instance_version: The current instance version
+        """
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry[0] == instance_id and entry[1] != instance_version:
+                    del self.entries[key]
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class LinksIndex(object):
+    """
+    In memory index of the hosts and services groups and contacts, used to
+    compute the links between groups, contacts, hosts and services.
+
+    Links are derived as follow:
+
+    * hostgroups: members are the hosts in the group, contacts are those
+      of the member hosts and of their services
+    * servicegroups: members are the services in the group, contacts are
+      those of the member services and of their hosts
+    * hosts: servicegroups are the groups of the host services
+    * services: hostgroups are the groups of the service host
+    * contacts: hosts and services are those having the contact
+
+    Each change marks the objects whose links depend on it as dirty, so
+    that only their links are recomputed and written.
+    """
+
+    collections = ("hosts", "services", "hostgroups", "servicegroups", "contacts")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # host -> (hostgroups, contacts)
+        self.hosts = {}
+        # service -> (host, servicegroups, contacts)
+        self.services = {}
+        # Reverse indexes
+        self.host_services = {}
+        self.hostgroup_hosts = {}
+        self.servicegroup_services = {}
+        self.contact_hosts = {}
+        self.contact_services = {}
+        self.dirty = dict([(c, set()) for c in self.collections])
+
+    def touch(self, collection, names):
+        """
+        Marks objects links to be recomputed
+
+        :param str collection: The objects collection
+        :param iterable names: The objects names
+        """
+        self.dirty[collection].update(names)
+
+    def update_reverse(self, index, item, old, new):
+        for key in old - new:
+            items = index[key]
+            items.discard(item)
+            if not items:
+                del index[key]
+        for key in new - old:
+            index.setdefault(key, set()).add(item)
+
+    def set_host(self, host, hostgroups, contacts):
+        """
+        Sets a host groups and contacts
+
+        :param str host: The host name
+        :param list hostgroups: The host groups names
+        :param list contacts: The host contacts names
+        """
+        entry = (frozenset(hostgroups or ()), frozenset(contacts or ()))
+        old = self.hosts.get(host)
+        if old == entry:
+            return
+        if old is None:
+            old = (frozenset(), frozenset())
+        self.hosts[host] = entry
+        self.update_reverse(self.hostgroup_hosts, host, old[0], entry[0])
+        self.update_reverse(self.contact_hosts, host, old[1], entry[1])
+        services = self.host_services.get(host, ())
+        self.touch("hostgroups", old[0] | entry[0])
+        self.touch("contacts", old[1] ^ entry[1])
+        if old[0] != entry[0]:
+            self.touch("services", services)
+        if old[1] != entry[1]:
+            for service in services:
+                self.touch("servicegroups", self.services[service][1])
+
+    def set_service(self, service, host, servicegroups, contacts):
+        """
+        Sets a service host, groups and contacts
+
+        :param str service: The service name, as host_name/description
+        :param str host: The service host name
+        :param list servicegroups: The service groups names
+        :param list contacts: The service contacts names
+        """
+        entry = (host, frozenset(servicegroups or ()), frozenset(contacts or ()))
+        old = self.services.get(service)
+        if old == entry:
+            return
+        if old is None:
+            old = (None, frozenset(), frozenset())
+        self.services[service] = entry
+        if old[0] != host:
+            if old[0] is not None:
+                self.update_reverse(self.host_services, service, set([old[0]]), set())
+            self.update_reverse(self.host_services, service, set(), set([host]))
+            self.touch("services", [service])
+        self.update_reverse(self.servicegroup_services, service, old[1], entry[1])
+        self.update_reverse(self.contact_services, service, old[2], entry[2])
+        self.touch("servicegroups", old[1] | entry[1])
+        self.touch("contacts", old[2] ^ entry[2])
+        for name in set([old[0], host]):
+            if name in self.hosts:
+                self.touch("hosts", [name])
+                self.touch("hostgroups", self.hosts[name][0])
+
+    def update_host(self, host, data):
+        """
+        Updates an already known host from a status brok data
+
+        :param str host: The host name
+        :param dict data: The normalized brok data
+        """
+        entry = self.hosts.get(host)
+        if entry is not None:
+            self.set_host(
+                host,
+                data.get("hostgroups", entry[0]),
+                data.get("contacts", entry[1])
+            )
+
+    def update_service(self, service, data):
+        """
+        Updates an already known service from a status brok data
+
+        :param str service: The service name
+        :param dict data: The normalized brok data
+        """
+        entry = self.services.get(service)
+        if entry is not None:
+            self.set_service(
+                service,
+                data.get("host_name", entry[0]),
+                data.get("servicegroups", entry[1]),
+                data.get("contacts", entry[2])
+            )
+
+    def get_links(self, collection, name):
+        """
+        Computes an object links
+
+        :param str collection: The object collection
+        :param str name: The object name
+        :rtype: dict
+        :return: The links attributes to set on the object
+        """
+        if collection == "hostgroups":
+            hosts = self.hostgroup_hosts.get(name, ())
+            contacts = set()
+            for host in hosts:
+                contacts.update(self.hosts[host][1])
+                for service in self.host_services.get(host, ()):
+                    contacts.update(self.services[service][2])
+            return {"members": sorted(hosts), "contacts": sorted(contacts)}
+        elif collection == "servicegroups":
+            services = self.servicegroup_services.get(name, ())
+            contacts = set()
+            for service in services:
+                host, _, service_contacts = self.services[service]
+                contacts.update(service_contacts)
+                if host in self.hosts:
+                    contacts.update(self.hosts[host][1])
+            return {"members": sorted(services), "contacts": sorted(contacts)}
+        elif collection == "hosts":
+            servicegroups = set()
+            for service in self.host_services.get(name, ()):
+                servicegroups.update(self.services[service][1])
+            return {"servicegroups": sorted(servicegroups)}
+        elif collection == "services":
+            host = self.services[name][0] if name in self.services else None
+            hostgroups = self.hosts[host][0] if host in self.hosts else ()
+            return {"hostgroups": sorted(hostgroups)}
+        elif collection == "contacts":
+            return {
+                "hosts": sorted(self.contact_hosts.get(name, ())),
+                "services": sorted(self.contact_services.get(name, ())),
+            }
+
+    def pop_dirty(self):
+        """
+        Computes the links of the objects marked as dirty
+
+        :rtype: list
+        :return: The (collection, name, links) tuples to write
+        """
+        links = []
+        for collection in self.collections:
+            for name in self.dirty[collection]:
+                links.append((collection, name, self.get_links(collection, name)))
+            self.dirty[collection] = set()
+        return links
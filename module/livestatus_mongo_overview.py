@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import operator
+
+
+class UnsupportedStatement(Exception):
+    """
+    Raised when a filter statement can't be evaluated from the counters
+    """
+    pass
+
+
+class TacticalOverview(object):
+    """
+    In memory hosts and services counters, answering the tactical overview
+    like Stats queries without querying mongo
+
+    Objects are counted by the values of a few attributes (the matrix
+    dimensions). A count Stats query whose filters and stats only use
+    these attributes is answered by evaluating its statements against
+    each combination of values, and summing the matching counts. Any
+    other query returns None, and has to be answered by an aggregation.
+    """
+
+    # Counted attributes, per table
+    dimensions = {
+        "hosts": (
+            "state_id",
+            "state_type_id",
+            "problem_has_been_acknowledged",
+            "scheduled_downtime_depth",
+            "active_checks_enabled",
+            "passive_checks_enabled",
+            "notifications_enabled",
+            "has_been_checked",
+            "is_flapping",
+        ),
+        "services": (
+            "state_id",
+            "state_type_id",
+            "problem_has_been_acknowledged",
+            "scheduled_downtime_depth",
+            "active_checks_enabled",
+            "passive_checks_enabled",
+            "notifications_enabled",
+            "has_been_checked",
+            "is_flapping",
+        ),
+    }
+
+    comparisons = {
+        "$gt": operator.gt,
+        "$gte": operator.ge,
+        "$lt": operator.lt,
+        "$lte": operator.le,
+    }
+
+    def __init__(self, counters):
+        self.counters = counters
+        self.enabled = True
+        self.lock = threading.Lock()
+        # Instances whose initial broks are being received
+        self.loading = set()
+        self.clear()
+
+    def clear(self):
+        # table -> {object name: values}
+        self.objects = dict([(table, {}) for table in self.dimensions])
+        # table -> {values: count}
+        self.matrix = dict([(table, {}) for table in self.dimensions])
+        # Set once the counters have been built from the database content
+        self.complete = False
+
+    def is_ready(self):
+        return self.enabled and self.complete and not self.loading
+
+    def set_object(self, table, name, data):
+        """
+        Sets an object counted values
+
+        :param str table: The object table
+        :param str name: The object name
+        :param dict data: The object data, missing attributes keeping
+                          their previous value
+        """
+        if table not in self.dimensions:
+            return
+        with self.lock:
+            objects = self.objects[table]
+            matrix = self.matrix[table]
+            old = objects.get(name)
+            if old is None:
+                values = tuple([data.get(a) for a in self.dimensions[table]])
+            else:
+                values = tuple([
+                    data.get(a, old_value)
+                    for a, old_value in zip(self.dimensions[table], old)
+                ])
+                if values == old:
+                    return
+                count = matrix[old] - 1
+                if count:
+                    matrix[old] = count
+                else:
+                    del matrix[old]
+            objects[name] = values
+            matrix[values] = matrix.get(values, 0) + 1
+
+    def answer(self, table, filters, stats, columns=None):
+        """
+        Answers a Stats query from the counters
+
+        :param str table: The queried table
+        :param list filters: The query filters statements
+        :param list stats: The query stats statements
+        :param list columns: The columns stats are grouped by
+        :rtype: list
+        :return: The query result rows, or None if the query has to be
+                 answered by an aggregation
+        """
+        if table not in self.dimensions:
+            return None
+        if not self.is_ready() or columns or \
+                [s for s in stats if not isinstance(s, dict)]:
+            # Grouped stats and min, max, sum and avg are not supported
+            self.counters.increment("overview_fallbacks")
+            return None
+        dimensions = self.dimensions[table]
+        with self.lock:
+            cells = [
+                (dict(zip(dimensions, values)), count)
+                for values, count in self.matrix[table].items()
+            ]
+        try:
+            cells = [
+                (cell, count) for cell, count in cells
+                if all([self.match(s, cell) for s in filters])
+            ]
+            result = [
+                sum([count for cell, count in cells if self.match(s, cell)])
+                for s in stats
+            ]
+        except UnsupportedStatement:
+            self.counters.increment("overview_fallbacks")
+            return None
+        self.counters.increment("overview_hits")
+        if not any(result):
+            # Same as the aggregation, which returns no group at all
+            return []
+        return [result]
+
+    def match(self, statement, cell):
+        """
+        Evaluates a filter statement against a combination of values
+
+        :param dict statement: The mongo filter statement
+        :param dict cell: The attributes values
+        :rtype: bool
+        """
+        for key, condition in statement.items():
+            if key == "$and":
+                matched = all([self.match(s, cell) for s in condition])
+            elif key == "$or":
+                matched = any([self.match(s, cell) for s in condition])
+            elif key == "$nor":
+                matched = not any([self.match(s, cell) for s in condition])
+            elif key.startswith("$") or key not in cell:
+                raise UnsupportedStatement(key)
+            elif isinstance(condition, dict):
+                matched = all([
+                    self.compare(op, cell[key], reference)
+                    for op, reference in condition.items()
+                ])
+            else:
+                matched = self.compare("$eq", cell[key], condition)
+            if not matched:
+                return False
+        return True
+
+    def get_type_order(self, value):
+        """
+        Returns the value type rank, mongo only comparing values of the
+        same type
+        """
+        if value is None:
+            return 0
+        elif isinstance(value, bool):
+            return 2
+        elif isinstance(value, (int, long, float)):
+            return 1
+        elif isinstance(value, basestring):
+            return 3
+        raise UnsupportedStatement(repr(value))
+
+    def compare(self, op, value, reference):
+        if op in ("$in", "$nin"):
+            if not isinstance(reference, list):
+                raise UnsupportedStatement(op)
+            matched = any([self.compare("$eq", value, r) for r in reference])
+            return matched if op == "$in" else not matched
+        same_type = self.get_type_order(value) == self.get_type_order(reference)
+        if op == "$eq":
+            return same_type and value == reference
+        elif op == "$ne":
+            return not (same_type and value == reference)
+        elif op in self.comparisons:
+            return same_type and self.comparisons[op](value, reference)
+        raise UnsupportedStatement(op)
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2014:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Staged brok ingestion pipeline
+
+Broks are processed by three threads linked by bounded queues:
+
+* decode: un-serializes the broks and forwards them to internal modules
+* normalize: turns broks into coalesced pending writes (the data manager
+  brok handlers)
+* write: sends the pending batches to mongo as bulk writes
+
+A full queue blocks the previous stage, up to the broker queue, so that a
+slow database slows down brok reading instead of growing memory usage.
+"""
+
+from shinken.log import logger
+import threading
+import Queue
+
+
+class PipelineStage(threading.Thread):
+    """
+    A pipeline thread, processing items read from its bounded input queue
+
+    `process` is called with each item, or with None when no item was
+    received within `timeout` seconds. It returns the number of processed
+    elements, added to the `counter` counter.
+    """
+
+    def __init__(self, name, process, counters, counter, queue_size,
+                 timeout=1):
+        threading.Thread.__init__(self, name="livestatus-%s" % name)
+        self.daemon = True
+        self.process = process
+        self.counters = counters
+        self.counter = counter
+        self.timeout = timeout
+        self.queue = Queue.Queue(queue_size)
+        self.stop_requested = False
+        counters.register_gauge("pipeline_%s_queue" % name, self.queue.qsize)
+
+    def put(self, item):
+        """
+        Queues an item, blocking while the queue is full
+
+        :param item: The item to process
+        """
+        try:
+            self.queue.put(item, False)
+        except Queue.Full:
+            self.counters.increment("pipeline_stalls")
+            self.queue.put(item)
+
+    def join_queue(self):
+        """
+        Waits until all the queued items have been processed
+        """
+        self.queue.join()
+
+    def request_stop(self):
+        self.stop_requested = True
+
+    def run(self):
+        while not self.stop_requested:
+            try:
+                item = self.queue.get(True, self.timeout)
+            except Queue.Empty:
+                item = None
+            try:
+                count = self.process(item)
+                if count:
+                    self.counters.increment(self.counter, count)
+            except Exception as err:
+                logger.exception(
+                    "[Livestatus Mongo] %s stage failed: %s", self.name, err)
+            finally:
+                if item is not None:
+                    self.queue.task_done()
+
+
+class IngestionPipeline(object):
+    """
+    Brok ingestion pipeline feeding a data manager
+
+    :param DataManager datamgr: The data manager to feed
+    :param callable decode: Called with each received broks list to
+                            un-serialize them
+    :param int queue_size: The maximum number of items in each stage queue
+    """
+
+    def __init__(self, datamgr, decode, queue_size=10):
+        self.datamgr = datamgr
+        self.decode = decode
+        counters = datamgr.counters
+        self.writer = PipelineStage(
+            "write", self.write, counters, "pipeline_written", queue_size)
+        self.normalizer = PipelineStage(
+            "normalize", self.normalize, counters, "pipeline_normalized",
+            queue_size, timeout=max(0.1, min(1, datamgr.bulk_latency)))
+        self.decoder = PipelineStage(
+            "decode", self.decode_broks, counters, "pipeline_decoded",
+            queue_size)
+        # In processing order
+        self.stages = (self.decoder, self.normalizer, self.writer)
+
+    def start(self):
+        self.datamgr.batch_writer = self.queue_batch
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        """
+        Stops the pipeline once all the queued broks have been written
+        """
+        for stage in self.stages:
+            if stage is self.writer:
+                # The normalize stage is stopped, the last pending writes
+                # can be queued from here
+                self.datamgr.flush()
+            stage.join_queue()
+            stage.request_stop()
+            stage.join()
+        self.datamgr.batch_writer = None
+
+    def put(self, broks):
+        """
+        Queues a list of broks received from the broker, blocking while
+        the pipeline is full
+
+        :param list broks: The received broks
+        """
+        self.decoder.put(broks)
+
+    def queue_batch(self, batch, wait=False):
+        """
+        Data manager batch writer, queues a batch to the write stage
+
+        :param tuple batch: The batch to write
+        :param bool wait: Should the call block until the batch is written
+        """
+        updates, operations, logs = batch
+        if updates or operations or logs:
+            self.writer.put(batch)
+        if wait is True:
+            self.writer.join_queue()
+
+    def decode_broks(self, broks):
+        if broks is None:
+            return 0
+        self.decode(broks)
+        self.normalizer.put(broks)
+        return len(broks)
+
+    def normalize(self, broks):
+        if broks is None:
+            # Nothing received, pending writes may have waited too long
+            self.datamgr.flush_expired()
+            return 0
+        self.datamgr.manage_broks(broks)
+        return len(broks)
+
+    def write(self, batch):
+        if batch is None:
+            return 0
+        return self.datamgr.write_batch(batch)
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from collections import OrderedDict
+
+
+class QueryPlan(object):
+    """
+    The parsed form of a query, and its compiled mongo queries
+
+    The mongo queries (find parameters or aggregation pipelines) and the
+    row formatter are compiled on the first execution, and reused by the
+    following queries sharing the same plan.
+    """
+
+    # Response attributes set by the query headers
+    response_attributes = (
+        "responseheader",
+        "outputformat",
+        "keepalive",
+        "columnheaders",
+        "separators",
+        "compression",
+    )
+
+    def __init__(self, query):
+        self.table = query.table
+        self.columns = query.columns
+        self.limit = query.limit
+        self.stats_query = query.stats_query
+        self.filters_stack = query.filters_stack
+        self.aggregations_stack = query.aggregations_stack
+        self.response = dict([
+            (name, getattr(query.response, name))
+            for name in self.response_attributes
+        ])
+        # table -> find parameters, pipeline, or list of stats pipelines
+        self.queries = {}
+        # table -> query shape recorded by the index advisor
+        self.shapes = {}
+        self.formatter = None
+
+    def apply(self, query):
+        """
+        Sets the parsed query attributes on a new query
+
+        :param LiveStatusQuery query: The query to set attributes on
+        """
+        query.table = self.table
+        query.columns = self.columns
+        query.limit = self.limit
+        query.stats_query = self.stats_query
+        query.filters_stack = self.filters_stack
+        query.aggregations_stack = self.aggregations_stack
+        for name, value in self.response.items():
+            setattr(query.response, name, value)
+        query.plan = self
+
+
+class QueryPlanCache(object):
+    """
+    Least recently used cache of query plans, keyed by the normalized query
+    text
+
+    Lines whose value changes from one request to the other without
+    changing the query itself, such as `Localtime`, are not part of the key.
+
+    :param LiveStatusCounters counters: The counters to report hits and
+                                        misses to
+    :param int maxsize: The maximum number of plans, 0 disables the cache
+    """
+
+    # Explain reuses the plan of the explained query
+    volatile_keywords = ("Localtime", "Explain")
+
+    def __init__(self, counters, maxsize=500):
+        self.counters = counters
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.plans = OrderedDict()
+
+    def __len__(self):
+        return len(self.plans)
+
+    def get(self, key):
+        """
+        Returns the plan matching a query, or None if it is unknown
+
+        :param str key: The normalized query text
+        :rtype: QueryPlan
+        :return: The query plan
+        """
+        if not self.maxsize:
+            return None
+        with self.lock:
+            plan = self.plans.pop(key, None)
+            if plan is not None:
+                self.plans[key] = plan
+        if plan is None:
+            self.counters.increment("query_plan_misses")
+        else:
+            self.counters.increment("query_plan_hits")
+        return plan
+
+    def put(self, key, plan):
+        """
+        Stores a query plan, evicting the least recently used ones if the
+        cache is full
+
+        :param str key: The normalized query text
+        :param QueryPlan plan: The query plan
+        """
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.plans[key] = plan
+            while len(self.plans) > self.maxsize:
+                self.plans.popitem(last=False)
@@ -26,12 +26,16 @@ import os
 import re
 import time
 import copy
+import json
 import pymongo
 import bson
+from bson import json_util
 
 from shinken.log import logger
 from livestatus_mongo_response import LiveStatusResponse
 from livestatus_mongo_response import Separators
+from livestatus_mongo_encoders import binary_formats, msgpack
+from livestatus_mongo_plan_cache import QueryPlan
 from livestatus_query_error import LiveStatusQueryError
 
 #############################################################################
@@ -65,6 +69,16 @@ class LiveStatusQuery(object):
         # the class behind a queries table
         self.filters_stack = self.datamgr.make_stack()
         self.aggregations_stack = self.datamgr.make_stack()
+        # The parsed and compiled form of the query, shared by identical
+        # queries
+        self.plan = None
+        # When set by the `Explain` header, the query plan, mongo queries
+        # and timings ("on"), or the indexes report ("indexes") are
+        # returned instead of the rows
+        self.explain = None
+        self.cached_plan = False
+        self.explained = []
+        self.timings = {}
 
         self.objects_get_handlers = {
             'hosts':                self.get_filtered_livedata,
@@ -86,7 +100,7 @@ class LiveStatusQuery(object):
             'servicesbyhostgroup':  self.get_filtered_livedata,
             'problems':             self.get_filtered_livedata,
             'log':                  self.get_filtered_livedata,
-            'status':               self.get_status_livedata,
+            'status':               self.get_filtered_livedata,
             'columns':              self.get_columns_livedata,
         }
         self.operator_mapping = {
@@ -171,10 +185,44 @@ class LiveStatusQuery(object):
         """
         Parse the lines of a livestatus request.
 
+        The plan of an identical previous request is reused if it is still
+        in the plans cache, only the volatile lines are parsed in this case.
+        """
+        tic = time.time()
+        plans = self.datamgr.query_plans
+        lines = []
+        volatile_lines = []
+        for line in data.splitlines():
+            line = line.strip()
+            if ':' in line and not ' ' in line:
+                line = line.replace(':', ': ')
+            keyword = line.split(' ')[0].rstrip(':')
+            if not line:
+                continue
+            elif keyword in plans.volatile_keywords:
+                volatile_lines.append(line)
+            else:
+                lines.append(line)
+        key = "\n".join(lines)
+        plan = plans.get(key)
+        if plan is None:
+            self.parse_lines(lines)
+            self.plan = QueryPlan(self)
+            plans.put(key, self.plan)
+        else:
+            plan.apply(self)
+            self.cached_plan = True
+        self.parse_lines(volatile_lines)
+        self.timings["parse"] = time.time() - tic
+
+    def parse_lines(self, lines):
+        """
+        Parse the lines of a livestatus request.
+
         This function looks for keywords in input lines and
         sets the attributes of the request object
         """
-        for line in data.splitlines():
+        for line in lines:
             line = line.strip()
             # Tools like NagVis send KEYWORK:option, and we prefer to have
             # a space following the:
@@ -193,6 +241,9 @@ class LiveStatusQuery(object):
                 self.response.responseheader = responseheader
             elif keyword == 'OutputFormat':
                 _, outputformat = self.split_option(line)
+                if outputformat in binary_formats and msgpack is None:
+                    # The binary output formats require msgpack
+                    raise LiveStatusQueryError(452, line)
                 self.response.outputformat = outputformat
             elif keyword == 'KeepAlive':
                 _, keepalive = self.split_option(line)
@@ -290,20 +341,117 @@ class LiveStatusQuery(object):
                     self.aggregations_stack,
                     notnum
                 )
+            elif keyword == 'Compression':
+                _, compression = self.split_option(line)
+                if compression in self.response.compressions:
+                    self.response.compression = compression
+                elif compression == 'off':
+                    self.response.compression = None
+                else:
+                    raise LiveStatusQueryError(452, line)
             elif keyword == 'Separators':
                 separators = map(lambda sep: chr(int(sep)), line.split(' ', 5)[1:])
                 self.response.separators = Separators(*separators)
             elif keyword == 'Localtime':
                 _, self.client_localtime = self.split_option(line)
+            elif keyword == 'Explain':
+                _, explain = self.split_option(line)
+                if explain in ('on', '1'):
+                    self.explain = 'on'
+                elif explain == 'indexes':
+                    self.explain = 'indexes'
+                else:
+                    self.explain = None
             else:
                 # This line is not valid or not implemented
                 logger.error("[Livestatus Query] Received a line of input which i can't handle: '%s'" % line)
 
     def process_query(self):
+        """
+        Executes the query and returns its response
+
+        Responses larger than a chunk are streamed: the rows of the next
+        chunks are formatted while the response is sent, after its status
+        code. A formatting error raised by them makes the client thread
+        close the connection instead of reporting it, unless the response
+        has a fixed16 header.
+
+        :rtype: tuple
+        :return: The response output, and the keepalive flag
+        """
+        if self.explain == 'on':
+            return self.explain_query()
+        elif self.explain == 'indexes':
+            return self.explain_indexes()
         result = self.launch_query()
         self.response.format_live_data(result, self.columns)
         return self.response.respond()
 
+    def explain_query(self):
+        """
+        Executes the query, and responds with the mongo queries it ran,
+        their explain output, and a timing breakdown of the query
+        processing instead of its result
+
+        The timings are those of the query parsing, the mongo queries
+        compilation (`plan`, close to 0 when the plan was cached), their
+        execution, the rows formatting, and the response rendering (the
+        rows are not sent).
+        """
+        self.timings["plan"] = 0.0
+        tic = time.time()
+        result = list(self.launch_query())
+        self.timings["execute"] = time.time() - tic - self.timings["plan"]
+        tic = time.time()
+        self.response.format_live_data(result, self.columns)
+        if isinstance(self.response.output, list):
+            # Streamed output chunks are otherwise formatted while sent
+            self.response.output = "".join(self.response.output)
+        self.timings["format"] = time.time() - tic
+        tic = time.time()
+        self.response.respond()
+        self.timings["respond"] = time.time() - tic
+
+        queries = []
+        for table, kind, query in self.explained:
+            if query is None:
+                # Answered from the overview counters, or not executed
+                # as the filters can't match any object
+                queries.append({"table": table, kind: True})
+                continue
+            queries.append({
+                "table": table,
+                "method": "aggregate" if isinstance(query, list) else "find",
+                "query": query,
+                "explain": self.datamgr.explain(table, query),
+            })
+        return self.respond_document({
+            "table": self.table,
+            "cached_plan": self.cached_plan,
+            "rows": len(result),
+            "queries": queries,
+            "timings": self.timings,
+        })
+
+    def explain_indexes(self):
+        """
+        Responds with the indexes suggested from the recorded queries, and
+        the existing indexes usage statistics, instead of the query result
+        """
+        self.response.load(self)
+        return self.respond_document(self.datamgr.get_indexes_report())
+
+    def respond_document(self, document):
+        """
+        Responds with a document in place of the query rows
+        """
+        document = json.loads(json_util.dumps(document))
+        if self.response.outputformat.startswith("python"):
+            self.response.output = repr(document)
+        else:
+            self.response.output = json.dumps(document, indent=2, sort_keys=True)
+        return self.response.respond()
+
     def launch_query(self):
         """ Prepare the request object's filter stacks """
 
@@ -330,12 +478,15 @@ class LiveStatusQuery(object):
         """
         if table is None:
             table = self.table
-        query = self.datamgr.get_filter_query(
-            table,
-            self.filters_stack,
-            self.columns,
-            self.limit,
-        )
+        query = self.get_compiled_query(table)
+        if query is None:
+            # The filters can't match any object
+            if self.explain == 'on':
+                self.explained.append((table, "empty", None))
+            return []
+        self.record_query_shape(table, query)
+        if self.explain == 'on':
+            self.explained.append((table, "query", query))
         logger.debug("executing mongo filter query against table: %s" % table)
         logger.debug(query)
         return self.datamgr.find(table, query)
@@ -346,32 +497,53 @@ class LiveStatusQuery(object):
         """
         if table is None:
             table = self.table
+        # Tactical overview like queries are answered from memory
+        rows = self.datamgr.overview.answer(
+            table,
+            self.filters_stack,
+            self.aggregations_stack,
+            self.columns
+        )
+        if rows is not None:
+            if self.explain == 'on':
+                self.explained.append((table, "overview", None))
+            return rows
         results = {}
-        # If no aggregation has been
-        for i, query in enumerate(self.aggregations_stack):
-            query = self.datamgr.get_aggregation_query(table, self.filters_stack, query, self.columns)
-            logger.debug(
-                "executing mongo aggregation query agains table: %s" % table
-            )
-            logger.debug(query)
-            logger.debug("aggregation result")
-            for result in self.datamgr.aggregate(table, query):
-                logger.debug(result)
-                if result["group"] is None:
-                    group = results.setdefault(
-                        None,
-                        {"group": None, "stats": {}}
-                    )
-                else:
-                    key = "".join([
-                        "%s%s" % (k, v)
-                        for k, v in sorted(result["group"].items())
-                    ])
-                    group = results.setdefault(
-                        key,
-                        {"group": result["group"], "stats": {}}
-                    )
-                group["stats"][i] = result["result"]
+        query = self.get_compiled_query(table)
+        if query is None:
+            # The filters can't match any object
+            if self.explain == 'on':
+                self.explained.append((table, "empty", None))
+            return []
+        self.record_query_shape(table, query)
+        if self.explain == 'on':
+            self.explained.append((table, "query", query))
+        logger.debug(
+            "executing mongo aggregation query agains table: %s" % table
+        )
+        logger.debug(query)
+        logger.debug("aggregation result")
+        # All the stats are computed by a single query, returning a single
+        # document holding each stat results in its s<i> attribute
+        for facets in self.datamgr.aggregate_stats(table, query):
+            for i in range(len(self.aggregations_stack)):
+                for result in facets.get("s%d" % i, []):
+                    logger.debug(result)
+                    if result["group"] is None:
+                        group = results.setdefault(
+                            None,
+                            {"group": None, "stats": {}}
+                        )
+                    else:
+                        key = "".join([
+                            "%s%s" % (k, v)
+                            for k, v in sorted(result["group"].items())
+                        ])
+                        group = results.setdefault(
+                            key,
+                            {"group": result["group"], "stats": {}}
+                        )
+                    group["stats"][i] = result["result"]
         rows = []
         for key, stats in sorted(results.items(), key=lambda r: r[0]):
             row = []
@@ -394,6 +566,77 @@ class LiveStatusQuery(object):
             rows.append(row)
         return rows
 
+    def get_compiled_query(self, table):
+        """
+        Returns the mongo queries for the table, compiled once per plan
+
+        :param str table: The table to query
+        :rtype: dict/list
+        :return: The find parameters or pipeline for filter queries, the
+                 stats pipeline for aggregation queries, None if the
+                 filters can't match any object
+        """
+        if self.plan is not None and table in self.plan.queries:
+            return self.plan.queries[table]
+        tic = time.time()
+        filters = self.datamgr.optimize_filters(table, self.filters_stack)
+        if filters is None:
+            query = None
+        elif self.aggregations_stack:
+            query = self.datamgr.get_stats_query(
+                table,
+                filters,
+                self.aggregations_stack,
+                self.columns
+            )
+        else:
+            query = self.datamgr.get_filter_query(
+                table,
+                filters,
+                self.columns,
+                self.limit,
+            )
+        if self.plan is not None:
+            self.plan.queries[table] = query
+        self.timings["plan"] = self.timings.get("plan", 0) + time.time() - tic
+        return query
+
+    def record_query_shape(self, table, query):
+        """
+        Records the query execution in the index advisor, the query shape
+        being extracted once per plan
+
+        :param str table: The queried table
+        :param dict/list query: The compiled query
+        """
+        advisor = self.datamgr.advisor
+        if not advisor.enabled:
+            return
+        if self.plan is not None and table in self.plan.shapes:
+            shape = self.plan.shapes[table]
+        else:
+            shape = advisor.get_shape(self.datamgr, table, query)
+            if self.plan is not None:
+                self.plan.shapes[table] = shape
+        advisor.record(shape)
+
+    def get_formatter(self, columns):
+        """
+        Returns the response row formatter, compiled once per plan and
+        columns
+
+        :param list columns: The requested columns
+        :rtype: RowFormatter
+        :return: The compiled formatter
+        """
+        if self.plan is not None and self.plan.formatter is not None:
+            if self.plan.formatter.columns == list(columns):
+                return self.plan.formatter
+        formatter = self.response.compile_formatter(columns)
+        if self.plan is not None:
+            self.plan.formatter = formatter
+        return formatter
+
     def get_filtered_livedata(self, table=None):
         """
         Retrieves direct hosts or services from the mongo database
@@ -501,9 +744,6 @@ class LiveStatusQuery(object):
         # Then return
         return problems
 
-    def get_status_livedata(self, cs):
-        return [c for c in self.get_table("configs").values()]
-
     def get_columns_livedata(self, cs):
         result = []
         # The first 5 lines must be hard-coded
@@ -23,33 +23,20 @@
 # along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from types import GeneratorType
 from collections import namedtuple
 
-import csv
-import json
-from StringIO import StringIO
+import time
+import zlib
+import tempfile
 import traceback
 
-try:
-    from ujson import dumps, loads
-except ImportError:
-    try:
-        from simplejson import dumps, loads, JSONEncoder
-        # ujson's dumps() cannot handle a separator parameter, which is
-        # needed to avoid unnecessary spaces in the json output
-        # That's why simplejson and json manipulate the encoder class
-        JSONEncoder.item_separator = ','
-        JSONEncoder.key_separator = ':'
-    except ImportError:
-        from json import dumps, loads, JSONEncoder
-        JSONEncoder.item_separator = ','
-        JSONEncoder.key_separator = ':'
-
 #############################################################################
 
 from shinken.log import logger
 from livestatus_query_error import LiveStatusQueryError
+from livestatus_response import LiveStatusListResponse
+from livestatus_mongo_encoders import get_encoder, CsvEncoder
+from livestatus_mongo_encoders import binary_formats
 
 #############################################################################
 
@@ -57,49 +44,143 @@ Separators = namedtuple('Separators',
                         ('line', 'field', 'list', 'pipe')) # pipe is used within livestatus_broker.mapping
 
 
-class LiveStatusListResponse(list):
-    ''' A class to be able to recognize list of data/bytes to be sent vs plain data/bytes. '''
+def format_json_python_value(value):
+    """
+    Coerces a value for the json and python output formats
 
-    def __iter__(self):
-        '''Iter over the values and eventual sub-values. This so also
-recursively iter of the values of eventual sub-LiveStatusListResponse. '''
-        for value in super(LiveStatusListResponse, self).__iter__():
-            if isinstance(value, (LiveStatusListResponse, GeneratorType)):
-                for v2 in value:
-                    yield v2
-            else:
-                yield value
+    :param value: The value to coerce
+    :return: The value, booleans as 1 or 0
+    """
+    if isinstance(value, bool):
+        return 1 if value else 0
+    else:
+        return value
 
-    def total_len(self):
-        '''
-        :return: The total "len" of what's contained in this LiveStatusListResponse instance.
-If this instance contains others LiveStatusListResponse instances then their total_len() will also be summed
-If this instance contains generators then they will be exhausted and their generated data will replace the
-generator value at its index in this list.
-        '''
-        tot = 0
-        for idx in range(len(self)):
-            value = self[idx]
-            if isinstance(value, GeneratorType):
-                newlist = LiveStatusListResponse()
-                for generated_data in value:
-                    newlist.append(generated_data)
-                    tot += len(generated_data)
-                self[idx] = newlist
-            elif isinstance(value, LiveStatusListResponse):
-                tot += value.total_len()
-            else:
-                tot += len(value)
-        return tot
 
-    def clean(self):
-        idx = len(self) - 1
-        while idx >= 0:
-            v = self[idx]
-            if isinstance(v, LiveStatusListResponse):
-                v.clean()
-            idx -= 1
-        del self[:]
+def format_csv_value(value, separators):
+    """
+    Coerces a value for the csv output format
+
+    :param value: The value to coerce
+    :param Separators separators: The response separators
+    :rtype: str
+    :return: The value as a string
+    """
+    if isinstance(value, list):
+        return separators.list.join(str(x) for x in value)
+    elif isinstance(value, bool):
+        return '1' if value else '0'
+    else:
+        try:
+            return str(value)
+        except UnicodeEncodeError as err:
+            logger.warning('UnicodeEncodeError on str() of: %r : %s' % (value, err))
+            return value.encode('utf-8', 'replace')
+        except Exception as err:
+            logger.warning('Unexpected error on str() of: %r : %s' % (value, err))
+            return ''
+
+
+class RowFormatter(object):
+    """
+    Formats items into rows of the requested columns
+
+    The formatter is compiled once per query plan: each column value is
+    read by a getter specialized for its mapping, so that the rows loop
+    neither looks the mapping up nor instantiates the datatype defaults
+    for each cell. The getters also coerce the values for the output
+    format: booleans to 1 or 0, and for csv, any value to a string. The
+    binary output formats keep the values types.
+
+    The formatter keeps no reference to the response it has been compiled
+    for, as it outlives it in the query plans cache.
+
+    :param LiveStatusResponse response: The response to format rows for
+    :param list columns: The requested columns
+    """
+
+    def __init__(self, response, columns):
+        self.table = response.query.table
+        self.columns = list(columns)
+        table_mapping = response.query.mapping[self.table]
+        separators = response.separators
+        if response.outputformat in binary_formats:
+            as_csv = False
+            coerce = None
+        elif response.outputformat == "json" or \
+                response.outputformat.startswith("python"):
+            as_csv = False
+            coerce = format_json_python_value
+        else:
+            as_csv = True
+            coerce = lambda value: format_csv_value(value, separators)
+        self.getters = tuple([
+            self.compile_getter(column, table_mapping[column], coerce, as_csv,
+                                separators)
+            for column in columns
+        ])
+
+    def __call__(self, item):
+        try:
+            return [getter(item) for getter in self.getters]
+        except Exception:
+            # Finds out the failing column
+            for column, getter in zip(self.columns, self.getters):
+                try:
+                    getter(item)
+                except Exception as e:
+                    logger.debug(traceback.format_exc())
+                    raise LiveStatusQueryError(
+                        500,
+                        "failed to map value %s/%s: %s" %
+                        (self.table, column, e)
+                    )
+            raise
+
+    def compile_getter(self, column, mapping, coerce, as_csv, separators):
+        """
+        Returns the function reading a column value from an item
+
+        :param str column: The column name
+        :param dict mapping: The column mapping
+        :param function coerce: The output format value coercion, if any
+        :param bool as_csv: True if the values are output as csv
+        :param Separators separators: The response separators
+        :rtype: function
+        """
+        attr = mapping.get('filters', {}).get('attr', column)
+        if "function" in mapping:
+            getter = mapping["function"]
+        elif "datatype" in mapping:
+            datatype = mapping["datatype"]
+            default = datatype()
+            if datatype is bool and coerce is not None:
+                if as_csv:
+                    return lambda item: '1' if item.get(attr, default) else '0'
+                return lambda item: 1 if item.get(attr, default) else 0
+            elif as_csv:
+                if datatype in (int, long, float):
+                    return lambda item: str(datatype(item.get(attr, default)))
+                elif datatype is list:
+                    join = separators.list.join
+                    return lambda item: join(
+                        [str(x) for x in item.get(attr, default)]
+                    )
+
+            def getter(item):
+                value = item.get(attr, default)
+                if value.__class__ is datatype:
+                    return value
+                return datatype(value)
+
+            if not as_csv:
+                # Values of a datatype other than bool need no coercion
+                return getter
+        else:
+            getter = lambda item: item.get(attr, "")
+        if coerce is None:
+            return getter
+        return lambda item: coerce(getter(item))
 
 
 class LiveStatusResponse(object):
@@ -114,6 +195,23 @@ class LiveStatusResponse(object):
 
     separators = Separators('\n', ';', ',', '|')
 
+    # Number of rows formatted at once. Responses holding more rows are
+    # streamed, the next chunks being read from the cursor and formatted
+    # while the previous ones are sent
+    chunk_size = 1000
+    # Streamed responses sent with a fixed16 header are spooled to get
+    # their length, in memory up to spool_size bytes, then to a temporary
+    # file
+    spool_size = 10485760
+    spool_block_size = 65536
+    # Supported compressions, and their zlib window bits
+    compressions = {
+        'zlib': zlib.MAX_WBITS,
+        'gzip': zlib.MAX_WBITS | 16,
+    }
+    compression_level = 6
+    compression_min_size = 1024
+
     def __init__(self,responseheader='off', outputformat='csv', keepalive='off', columnheaders='off', separators=separators):
         self.responseheader = responseheader
         self.outputformat = outputformat
@@ -121,6 +219,7 @@ class LiveStatusResponse(object):
         self.columnheaders = columnheaders
         self.separators = separators
         self.statuscode = 200
+        self.compression = None
         self.output = LiveStatusListResponse()
 
     def set_error(self, statuscode, data):
@@ -130,68 +229,111 @@ class LiveStatusResponse(object):
 
     def load(self, query):
         self.query = query
+        self.chunk_size = query.datamgr.response_chunk_size
+        self.spool_size = query.datamgr.response_spool_size
+        self.compression_level = query.datamgr.response_compression_level
+        self.compression_min_size = query.datamgr.response_compression_min_size
 
     def respond(self):
+        if self.compression is not None:
+            self.output = self.compress(self.output)
         if self.responseheader == 'fixed16':
-            responselength = 1 + len(self.output) # 1 for the final '\n'
-            self.output = '%3d %11d\n%s' % (
-                self.statuscode,
-                responselength,
-                self.output
-            )
+            if isinstance(self.output, LiveStatusListResponse):
+                length, output = self.spool(self.output)
+            else:
+                length, output = len(self.output), self.output
+            responselength = 1 + length # 1 for the final '\n'
+            header = '%3d %11d\n' % (self.statuscode, responselength)
+            if self.compression is not None or \
+                    self.outputformat in binary_formats:
+                # The final '\n' counted in the length follows the
+                # compressed or binary stream
+                if isinstance(output, basestring):
+                    output += '\n'
+                else:
+                    output = LiveStatusListResponse([output, '\n'])
+            if isinstance(output, basestring):
+                self.output = header + output
+            else:
+                self.output = LiveStatusListResponse([header, output])
         return self.output, self.keepalive
 
+    def compress(self, output):
+        """
+        Compresses the output with the requested compression
+
+        Outputs smaller than compression_min_size bytes are stored in the
+        compressed stream without being compressed, so that small
+        responses stay cheap while the client always gets the compressed
+        stream it asked for. Streamed outputs are compressed chunk by
+        chunk as they are sent.
+
+        :param str/LiveStatusListResponse output: The output
+        :rtype: str/LiveStatusListResponse
+        :return: The compressed output
+        """
+        level = self.compression_level
+        if isinstance(output, basestring) and \
+                len(output) < self.compression_min_size:
+            level = 0
+        compressor = zlib.compressobj(
+            level,
+            zlib.DEFLATED,
+            self.compressions[self.compression]
+        )
+        if isinstance(output, basestring):
+            return compressor.compress(output) + compressor.flush()
+        return LiveStatusListResponse([self.iter_compressed(output, compressor)])
+
+    def iter_compressed(self, output, compressor):
+        for data in output:
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def spool(self, output):
+        """
+        Writes a streamed output to a spooled temporary file, to know its
+        length before sending it
+
+        :param LiveStatusListResponse output: The streamed output
+        :rtype: tuple
+        :return: The output length, and a generator reading it back
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        length = 0
+        for data in output:
+            spool.write(data)
+            length += len(data)
+        spool.seek(0)
+        return length, self.read_spool(spool)
+
+    def read_spool(self, spool):
+        try:
+            while True:
+                data = spool.read(self.spool_block_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            spool.close()
+
     def _format_json_python_value(self, value):
-        if isinstance(value, bool):
-            return 1 if value else 0
-        else:
-            return value
+        return format_json_python_value(value)
 
     def _format_csv_value(self, value):
-        if isinstance(value, list):
-            return self.separators.list.join(str(x) for x in value)
-        elif isinstance(value, bool):
-            return '1' if value else '0'
-        else:
-            try:
-                return str(value)
-            except UnicodeEncodeError as err:
-                logger.warning('UnicodeEncodeError on str() of: %r : %s' % (value, err))
-                return value.encode('utf-8', 'replace')
-            except Exception as err:
-                logger.warning('Unexpected error on str() of: %r : %s' % (value, err))
-                return ''
-
-    def _csv_end_row(self, row, line_nr=0):
-        f = StringIO()
-        writer = csv.writer(f, delimiter=self.separators.field, lineterminator=self.separators.line)
-        writer.writerow(row)
-        res = f.getvalue()[:-1]
-        return '%s%s' % (
-            self.separators.line if line_nr else '',
-            res)
-
-    def _json_end_row(self, row, line_nr=0):
-        return (',' if line_nr else '') + dumps(row)
-
-    def _python_end_row(self, row, line_nr=0):
-        ret = [',' if line_nr else '']
-        ret.append('[')
-        for item in row:
-            if isinstance(item, unicode):
-                item = item.encode('UTF-8')
-            ret.append(repr(item))
-            ret.append(', ')
-        if row:
-            del ret[-1] # skip last ','
-        ret.append(']')
-        return ''.join(ret)
-
-    _format_2_value_handler = {
-        'csv':      (_csv_end_row, _format_csv_value),
-        'json':     (_json_end_row, _format_json_python_value),
-        'python':   (_python_end_row, _format_json_python_value)
-    }
+        return format_csv_value(value, self.separators)
+
+    def compile_formatter(self, columns):
+        """
+        Compiles the formatter of the rows of the requested columns
+
+        :param list columns: The requested columns
+        :rtype: RowFormatter
+        :return: The formatter to format rows with
+        """
+        return RowFormatter(self, columns)
 
     def format_item(self, item, columns):
         """
@@ -202,29 +344,19 @@ class LiveStatusResponse(object):
         :rtype: list
         :return: The object's columns
         """
-        row = []
-        for column in columns:
-            try:
-                mapping = self.query.mapping[self.query.table][column]
-                attr = mapping.get('filters', {}).get('attr', column)
-                if "function" in mapping:
-                    value = mapping["function"](item)
-                elif "datatype" in mapping:
-                        datatype = mapping["datatype"]
-                        default = datatype()
-                        value = item.get(attr, default)
-                        value = datatype(value)
-                else:
-                    value = item.get(attr, "")
-                row.append(value)
-            except Exception as e:
-                logger.debug(traceback.format_exc())
-                raise LiveStatusQueryError(
-                    500,
-                    "failed to map value %s/%s: %s" %
-                    (self.query.table, column, e)
-                )
-        return row
+        return self.format_row(item, self.compile_formatter(columns))
+
+    def format_row(self, item, formatter):
+        """
+        Format an item using a compiled formatter
+
+        :param dict item: The item to format
+        :param RowFormatter formatter: The formatter returned by
+                                       compile_formatter
+        :rtype: list
+        :return: The object's columns
+        """
+        return formatter(item)
 
     def format_live_data_items(self, results, columns):
         if columns is None:
@@ -241,37 +373,102 @@ class LiveStatusResponse(object):
                 results and self.columnheaders == 'on'
                 or (not results and (self.columnheaders != 'off' or not columns)))
 
-        rows = []
-        if showheader:
-            rows.append(headers)
-        for item in results:
-            rows.append(self.format_item(item, columns))
-        if self.outputformat == "json":
-            return json.dumps(rows)
-        if self.outputformat.startswith("python"):
-            return repr(rows)
-        else:
-            f = StringIO()
-            writer = csv.writer(f,
-                delimiter=self.separators.field,
-                lineterminator=self.separators.line
+        formatter = self.query.get_formatter(columns)
+        encoder = get_encoder(
+            self.outputformat,
+            self.separators,
+            bool(showheader)
+        )
+        chunks = self.iter_chunks(
+            results,
+            formatter,
+            encoder,
+            headers if showheader else None
+        )
+        first = next(chunks)
+        second = next(chunks, None)
+        if second is None:
+            # The whole response fits in a single chunk
+            return first
+        return LiveStatusListResponse([first, second, chunks])
+
+    def iter_chunks(self, results, formatter, encoder, headers=None):
+        """
+        Formats the results rows by chunks of chunk_size rows, reading
+        the results as the chunks are consumed, so that a whole cursor
+        never has to be held in memory
+
+        :param iterable results: The items to format
+        :param RowFormatter formatter: The formatter returned by
+                                       compile_formatter
+        :param encoder: The output format encoder
+        :param list headers: The header row, if any
+        :rtype: generator
+        :return: The encoded chunks, the last one closing the output
+
+        Only the first two chunks are formatted before the response is
+        returned, the next ones are formatted while it is being sent. Unless
+        the response has a fixed16 header, in which case it is spooled
+        before being sent, errors raised by those chunks can't be reported
+        with a status code anymore: they are raised as 500 query errors, on
+        which the client thread closes the connection, so that the client
+        knows the response is incomplete.
+
+        The rows formatting time, which includes reading them from the
+        cursor, is counted chunk by chunk, so that the chunks formatted
+        while the response is sent are accounted for.
+        """
+        counters = self.query.datamgr.counters
+        rows = [] if headers is None else [headers]
+        header = len(rows)
+        first = True
+        chunk_size = self.chunk_size
+        tic = time.time()
+        try:
+            for item in results:
+                rows.append(formatter(item))
+                if len(rows) >= chunk_size:
+                    chunk = encoder.encode(rows, first, False)
+                    self.count_chunk(counters, len(rows) - header, tic)
+                    yield chunk
+                    tic = time.time()
+                    first = False
+                    header = 0
+                    rows = []
+            chunk = encoder.encode(rows, first, True)
+            self.count_chunk(counters, len(rows) - header, tic)
+        except LiveStatusQueryError:
+            counters.increment("response_errors")
+            raise
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            counters.increment("response_errors")
+            raise LiveStatusQueryError(
+                500,
+                "failed to format the response: %s" % e
             )
-            writer.writerow(rows)
-            return f.getvalue()
+        yield chunk
+
+    def count_chunk(self, counters, rows, tic):
+        """
+        Counts a formatted chunk of rows, and the time spent formatting it
+
+        :param LiveStatusCounters counters: The counters to increment
+        :param int rows: The number of rows in the chunk
+        :param float tic: The chunk formatting start time
+        """
+        counters.increment("response_chunks")
+        counters.increment("response_rows", rows)
+        counters.increment("response_format_time", time.time() - tic)
 
     def format_live_data_stats(self, result, columns):
-        if self.outputformat == "json":
-            return json.dumps(result)
-        elif self.outputformat.startswith("python"):
-            return repr(result)
-        else:
-            f = StringIO()
-            writer = csv.writer(f,
-                delimiter=self.separators.field,
-                lineterminator=self.separators.line
-            )
-            writer.writerow(result)
-            return f.getvalue()
+        encoder = get_encoder(self.outputformat, self.separators)
+        if isinstance(encoder, CsvEncoder):
+            result = [
+                [self._format_csv_value(value) for value in row]
+                for row in result
+            ]
+        return encoder.encode(result)
 
     def format_live_data(self, results, columns):
         '''
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+class StatesIndex(object):
+    """
+    Services states counters of the hosts, hostgroups and servicegroups
+
+    Each service is counted in its host, its host groups and its service
+    groups counters, keyed by its (state_type_id, state_id, state) state.
+    Counters are updated when a service state or groups change, the
+    objects whose counters changed being marked as dirty, so that only
+    their counters are written.
+    """
+
+    collections = ("hosts", "hostgroups", "servicegroups")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # service -> (state, containers)
+        self.services = {}
+        # (collection, name) -> {state key: count}
+        self.counters = {}
+        self.dirty = set()
+
+    def touch(self, collection, names):
+        """
+        Marks objects counters to be written
+
+        :param str collection: The objects collection
+        :param iterable names: The objects names
+        """
+        self.dirty.update([(collection, name) for name in names])
+
+    def update_counters(self, containers, key, increment):
+        for container in containers:
+            counters = self.counters.setdefault(container, {})
+            count = counters.get(key, 0) + increment
+            if count:
+                counters[key] = count
+            else:
+                del counters[key]
+            self.dirty.add(container)
+
+    def set_service(self, service, containers, state=(None, None, None)):
+        """
+        Sets a service state and the objects counting it
+
+        :param str service: The service name
+        :param frozenset containers: The (collection, name) of the service
+                                     host, host groups and service groups
+        :param tuple state: The service (state_type_id, state_id, state),
+                            None elements keeping their previous value
+        """
+        old = self.services.get(service)
+        if old is None:
+            old_state = (0, 0, "PENDING")
+            old_containers = frozenset()
+        else:
+            old_state, old_containers = old
+        state = tuple([
+            old_value if value is None else value
+            for value, old_value in zip(state, old_state)
+        ])
+        if old == (state, containers):
+            return
+        self.services[service] = (state, containers)
+        if old is not None:
+            self.update_counters(old_containers, "%s_%s_%s" % old_state, -1)
+        self.update_counters(containers, "%s_%s_%s" % state, 1)
+
+    def pop_dirty(self):
+        """
+        Returns the counters of the objects marked as dirty
+
+        :rtype: list
+        :return: The (collection, name, counters) tuples to write
+        """
+        counters = [
+            (collection, name, dict(self.counters.get((collection, name), {})))
+            for collection, name in self.dirty
+        ]
+        self.dirty = set()
+        return counters
@@ -73,6 +73,7 @@ from .livestatus_obj import LiveStatus
 from .livestatus_regenerator import LiveStatusRegenerator
 from .livestatus_query_cache import LiveStatusQueryCache
 from .livestatus_client_thread import LiveStatusClientThread
+from .livestatus_mongo_pipeline import IngestionPipeline
 
 # actually "sub-"imported by logstore_sqlite or some others
 # until they are corrected to import from the good place we need them here:
@@ -134,13 +135,64 @@ class LiveStatus_broker(BaseModule, Daemon):
             self.group_authorization_strict = False
         self.backend = getattr(modconf, "backend", "mongo")
         self.backend_uri = getattr(modconf, "backend_uri", "mongodb://localhost")
+        # Mongo writes are grouped into bulk writes of at most bulk_size
+        # operations, sent at most bulk_max_latency seconds after the
+        # first operation was queued
+        self.bulk_size = int(getattr(modconf, "bulk_size", "1000"))
+        self.bulk_max_latency = float(getattr(modconf, "bulk_max_latency", "1"))
+        # Maximum number of objects whose attributes fingerprints are kept
+        # to only write changed attributes, 0 disables it
+        self.fingerprints_size = int(getattr(modconf, "fingerprints_size", "100000"))
+        # Initial broks may be loaded into staging collections, replacing
+        # the live ones once all are received
+        self.bulk_load = (getattr(modconf, "bulk_load", "0") == "1")
+        # Log store retention, either a maximum age in seconds or a maximum
+        # size in bytes (capped collection), 0 keeps all log messages
+        self.log_retention = int(getattr(modconf, "log_retention", "0"))
+        self.log_capped_size = int(getattr(modconf, "log_capped_size", "0"))
+        # Broks may be decoded, normalized and written by dedicated threads
+        # linked by queues holding at most pipeline_queue_size items
+        self.ingestion_pipeline = (getattr(modconf, "ingestion_pipeline", "0") == "1")
+        self.pipeline_queue_size = int(getattr(modconf, "pipeline_queue_size", "10"))
+        self.pipeline = None
+        # Maximum number of parsed and compiled queries kept to answer
+        # identical queries, 0 disables the plans cache
+        self.query_plan_cache_size = int(getattr(modconf, "query_plan_cache_size", "500"))
+        # Hosts and services count Stats queries may be answered from in
+        # memory counters instead of mongo aggregations
+        self.tactical_overview = (getattr(modconf, "tactical_overview", "1") == "1")
+        # Queries shapes are recorded to suggest indexes. When
+        # managed_indexes is set, this number of the most used suggested
+        # indexes are created every index_advisor_interval seconds
+        self.index_advisor = (getattr(modconf, "index_advisor", "1") == "1")
+        self.managed_indexes = int(getattr(modconf, "managed_indexes", "0"))
+        self.index_advisor_interval = int(getattr(modconf, "index_advisor_interval", "3600"))
+        # Responses are streamed by chunks of response_chunk_size rows.
+        # Streamed responses needing a fixed16 header are spooled to a
+        # temporary file above response_spool_size bytes
+        self.response_chunk_size = int(getattr(modconf, "response_chunk_size", "1000"))
+        self.response_spool_size = int(getattr(modconf, "response_spool_size", "10485760"))
+        # Responses requesting compression are compressed at this level,
+        # unless smaller than response_compression_min_size bytes
+        self.response_compression_level = int(getattr(modconf, "response_compression_level", "6"))
+        self.response_compression_min_size = int(getattr(modconf, "response_compression_min_size", "1024"))
+
+        # Queries are answered from mongo, the in memory objects graph
+        # built by the regenerator can be dropped by enabling mongo_only.
+        # On the 5r_100h_2000s test configuration, the regenerator holds
+        # about 84000 objects (10MB RSS) and takes 0.65s of CPU time to
+        # ingest the initial broks
+        self.mongo_only = (getattr(modconf, "mongo_only", "0") == "1")
 
         # We need to have our regenerator now because it will need to load
         # data from scheduler before main() if in scheduler of course
-        self.rg = LiveStatusRegenerator(
-            self.service_authorization_strict,
-            self.group_authorization_strict
-        )
+        if self.mongo_only:
+            self.rg = None
+        else:
+            self.rg = LiveStatusRegenerator(
+                self.service_authorization_strict,
+                self.group_authorization_strict
+            )
 
         self.client_connections = {}  # keys will be socket of client,
         # values are LiveStatusClientThread instances
@@ -162,7 +214,28 @@ class LiveStatus_broker(BaseModule, Daemon):
             import pymongo
             self.datamgr = datamgr
             self.mongo_client = pymongo.MongoClient(self.backend_uri)
-            self.datamgr.load(self.mongo_client.livestatus)
+            self.datamgr.load(
+                self.mongo_client.livestatus,
+                bulk_size=self.bulk_size,
+                bulk_latency=self.bulk_max_latency,
+                fingerprints_size=self.fingerprints_size,
+                bulk_load=self.bulk_load,
+                log_retention=self.log_retention,
+                log_capped_size=self.log_capped_size,
+                query_plan_cache_size=self.query_plan_cache_size,
+                tactical_overview=self.tactical_overview,
+                index_advisor=self.index_advisor,
+                managed_indexes=self.managed_indexes,
+                response_chunk_size=self.response_chunk_size,
+                response_spool_size=self.response_spool_size,
+                response_compression_level=self.response_compression_level,
+                response_compression_min_size=self.response_compression_min_size
+            )
+            if self.rg is not None:
+                self.query_cache = LiveStatusQueryCache()
+                if not self.use_query_cache:
+                    self.query_cache.disable()
+                self.rg.register_cache(self.query_cache)
         elif self.backend ==  "memory" and False:
             from shinken.misc.datamanager import datamgr
             self.datamgr = datamgr
@@ -182,11 +255,19 @@ class LiveStatus_broker(BaseModule, Daemon):
     # if need)
     def hook_pre_scheduler_mod_start(self, sched):
         logger.info("[Livestatus Broker] pre_scheduler_mod_start: %s", sched.__dict__)
-        self.rg.load_from_scheduler(sched)
+        if self.rg is not None:
+            self.rg.load_from_scheduler(sched)
 
     # In a scheduler we will have a filter of what we really want as a brok
     def want_brok(self, b):
-        return self.rg.want_brok(b)
+        if self.rg is not None:
+            return self.rg.want_brok(b)
+        # Without regenerator, objects are not loaded from the scheduler,
+        # initial broks have to be kept to fill the database
+        datamgr = getattr(self, "datamgr", None)
+        if datamgr is None:
+            return True
+        return datamgr.want_brok(b)
 
     def set_debug(self):
         fdtemp = os.open(self.debug, os.O_CREAT | os.O_WRONLY | os.O_APPEND)
@@ -241,6 +322,27 @@ class LiveStatus_broker(BaseModule, Daemon):
         brok.prepare()
         self.datamgr.manage_brok(brok)
 
+    def decode_broks(self, broks):
+        """
+        Un-serializes received broks and forwards them to the regenerator
+        and internal modules
+
+        :param list broks: The received broks
+        """
+        for b in broks:
+            b.prepare()  # Un-serialize the brok data
+            if self.rg is not None:
+                self.rg.manage_brok(b)
+            for mod in self.modules_manager.get_internal_instances():
+                try:
+                    mod.manage_brok(b)
+                except Exception as err:
+                    logger.exception(
+                        "[%s] Warning: The mod %s raise an exception: %s,"
+                        "I'm tagging it to restart later",
+                        self.name, mod.get_name(), err)
+                    self.modules_manager.set_to_restart(mod)
+
     def do_stop(self):
         logger.info("[Livestatus Broker] So I quit")
         # client threads could be stopped and joined by the listening_thread..
@@ -326,39 +428,60 @@ class LiveStatus_broker(BaseModule, Daemon):
     def main_thread_run(self):
         logger.info("[Livestatus Broker] Livestatus query thread started")
         # This is the main object of this broker where the action takes place
-        self.livestatus = LiveStatus(self.datamgr, self.from_q)
+        self.livestatus = LiveStatus(
+            self.datamgr,
+            self.from_q,
+            counters=self.datamgr.counters
+        )
         self.create_listeners()
         self._listening_thread.start()
-
+        if self.ingestion_pipeline:
+            self.pipeline = IngestionPipeline(
+                self.datamgr,
+                self.decode_broks,
+                queue_size=self.pipeline_queue_size
+            )
+            self.pipeline.start()
+
+        last_index_management = time.time()
         while not self.interrupted:
             now = time.time()
 
             self.livestatus.counters.calc_rate()
 
+            if self.managed_indexes and \
+                    now - last_index_management > self.index_advisor_interval:
+                last_index_management = now
+                try:
+                    self.datamgr.manage_indexes()
+                except Exception as err:
+                    logger.error(
+                        "[Livestatus Broker] Indexes management failed: %s", err)
+
             try:
-                l = self.to_q.get(True, 1)
+                l = self.to_q.get(True, min(1, self.bulk_max_latency))
             except IOError as err:
                 if err.errno != os.errno.EINTR:
                     raise
             except Queue.Empty:
-                pass
+                # Nothing new, but pending writes may have waited too long
+                if self.pipeline is None:
+                    self.datamgr.flush_expired()
             else:
-                for b in l:
-                    b.prepare()  # Un-serialize the brok data
-                    self.rg.manage_brok(b)
-                    for mod in self.modules_manager.get_internal_instances():
-                        try:
-                            mod.manage_brok(b)
-                        except Exception as err:
-                            logger.exception(
-                                "[%s] Warning: The mod %s raise an exception: %s,"
-                                "I'm tagging it to restart later",
-                                self.name, mod.get_name(), err)
-                            self.modules_manager.set_to_restart(mod)
+                if self.pipeline is not None:
+                    # Blocks while the pipeline is full
+                    self.pipeline.put(l)
+                    continue
+                self.decode_broks(l)
+                self.datamgr.manage_broks(l)
 
                 # just to have eventually more broks accumulated
                 # in our input queue:
                 time.sleep(0.1)
 
         # end: while not self.interrupted:
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        else:
+            self.datamgr.flush()
         self.do_stop()
@@ -52,6 +52,32 @@ def modified_attributes_names(modified_attributes):
     return sorted(names_list)
 
 
+def state_histogram(item, table):
+    """
+    Returns the states of the objects linked to an item, and their count
+
+    Services states of hosts and groups are materialized in their
+    `__services_states__` attribute, others are read from the linked
+    objects.
+
+    :param dict item: The item to get linked objects states for
+    :param str table: The linked objects table
+    :rtype: list
+    :return: The (state_type_id, state_id, state, count) tuples
+    """
+    counters = item.get("__%s_states__" % table)
+    if counters is not None:
+        histogram = []
+        for key, count in counters.items():
+            state_type_id, state_id, state = key.split("_", 2)
+            histogram.append((int(state_type_id), int(state_id), state, count))
+        return histogram
+    return [
+        (s["state_type_id"], s["state_id"], s["state"], 1)
+        for s in item.get("__%s__" % table, [])
+    ]
+
+
 def state_count(item, table, state_type_id=None, state_id=None):
     """
     Returns the number of services having state_type_id and state_id matching
@@ -64,35 +90,16 @@ def state_count(item, table, state_type_id=None, state_id=None):
     :rtype: int
     :return: The number of matching services
     """
-    link = "__%s__" % table
-    if state_type_id is not None and state_id is not None:
-        if isinstance(state_id, int):
-            return len([
-                s for s in item[link]
-                if s["state_type_id"] == state_type_id
-                and s["state_id"] == state_id
-            ])
-        else:
-            return len([
-                s for s in item[link]
-                if s["state_type_id"] == state_type_id
-                and s["state"] == state
-            ])
-    elif state_type_id is not None:
-        return len([
-            s for s in item[link] if s["state_type_id"] == state_id
-        ])
-    elif state_id is not None:
-        if isinstance(state_id, int):
-            return len([
-                s for s in item[link] if s["state_id"] == state_id
-            ])
-        else:
-            return len([
-                s for s in item[link] if s["state"] == state_id
-            ])
-    else:
-        return len(item[link])
+    count = 0
+    for s_type_id, s_id, s_state, s_count in state_histogram(item, table):
+        if state_type_id is not None and s_type_id != state_type_id:
+            continue
+        if isinstance(state_id, int) and s_id != state_id:
+            continue
+        if isinstance(state_id, basestring) and s_state != state_id:
+            continue
+        count += s_count
+    return count
 
 
 def state_worst(item, table, state_type_id=None):
@@ -106,16 +113,10 @@ def state_worst(item, table, state_type_id=None):
     :rtype: int
     :return: The worst service state id
     """
-    link = "__%s__" % table
-    if state_type_id is not None:
-        states = [
-            s["state_id"] for s in item[link]
-            if s["state_type_id"] == state_type_id
-        ]
-    else:
-        states = [
-            s["state_id"] for s in item[link]
-        ]
+    states = [
+        s_id for s_type_id, s_id, _, _ in state_histogram(item, table)
+        if state_type_id is None or s_type_id == state_type_id
+    ]
     if table.endswith("services") and 2 in states:
         return 2
     elif table.endswith("hosts") and 1 in states:
@@ -2701,129 +2702,85 @@ livestatus_attribute_map = {
     'ServicesLink': {
         'num_services': {
             'description': 'The total number of services of the host',
-            'function': lambda item: len(item["__services__"]),
-            'projection': ['__services__.service_description'],
+            'function': lambda item: state_count(item, "services"),
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_crit': {
             'description': 'The number of the host\'s services with the soft state CRIT',
             'function': lambda item: state_count(item, "services", 0, 2),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_hard_crit': {
             'description': 'The number of the host\'s services with the hard state CRIT',
             'function': lambda item: state_count(item, "services", 1, 2),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_hard_ok': {
             'description': 'The number of the host\'s services with the hard state OK',
             'function': lambda item: state_count(item, "services", 1, 0),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_hard_unknown': {
             'description': 'The number of the host\'s services with the hard state UNKNOWN',
             'function': lambda item: state_count(item, "services", 1, 3),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_hard_warn': {
             'description': 'The number of the host\'s services with the hard state WARN',
             'function': lambda item: state_count(item, "services", 1, 1),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_ok': {
             'description': 'The number of the host\'s services with the soft state OK',
             'function': lambda item: state_count(item, "services", 0, 0),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_pending': {
             'description': 'The number of the host\'s services which have not been checked yet (pending)',
             'function': lambda item: state_count(item, "services", state_id="PENDING"),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_unknown': {
             'description': 'The number of the host\'s services with the soft state UNKNOWN',
             'function': lambda item: state_count(item, "services", 0, 3),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'num_services_warn': {
             'description': 'The number of the host\'s services with the soft state WARN',
             'function': lambda item: state_count(item, "services", 0, 1),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'worst_service_hard_state': {
             'description': 'The worst state of all services that belong to a host of this group (OK <= WARN <= UNKNOWN <= CRIT)',
             'function': lambda item: state_worst(item, "services", 1),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
         'worst_service_state': {
             'description': 'The worst state of all services that belong to a host of this group (OK <= WARN <= UNKNOWN <= CRIT)',
             'function': lambda item: state_worst(item, "services", 0),
             'datatype': int,
-            'projection': [
-                '__services__.state',
-                '__services__.state_id',
-                '__services__.state_type_id'
-            ],
+            'projection': ['__services_states__'],
             'filters': {},
         },
     },
@@ -4217,6 +4174,188 @@ livestatus_attribute_map = {
             'description': 'Whether passive service checks are activated in general (0/1)',
             'datatype': bool,
         },
+        'broks': {
+            'description': 'The number of broks ingested into the database since program start',
+            'function': lambda item: datamgr.counters.count('broks'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'broks_rate': {
+            'description': 'The averaged number of broks ingested per second',
+            'function': lambda item: datamgr.counters.count('broks_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'bulk_writes': {
+            'description': 'The number of bulk writes sent to the database since program start',
+            'function': lambda item: datamgr.counters.count('bulk_writes'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'bulk_writes_rate': {
+            'description': 'The averaged number of bulk writes sent to the database per second',
+            'function': lambda item: datamgr.counters.count('bulk_writes_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'bulk_batch_size': {
+            'description': 'The average number of operations per bulk write',
+            'function': lambda item: datamgr.counters.average('bulk_operations', 'bulk_writes'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'bulk_coalescing_ratio': {
+            'description': 'The average number of object updates merged into a single database write',
+            'function': lambda item: datamgr.counters.average('object_updates', 'object_writes'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'pipeline_decode_queue': {
+            'description': 'The number of broks lists waiting to be decoded by the ingestion pipeline',
+            'function': lambda item: datamgr.counters.count('pipeline_decode_queue'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'pipeline_decoded_rate': {
+            'description': 'The averaged number of broks decoded by the ingestion pipeline per second',
+            'function': lambda item: datamgr.counters.count('pipeline_decoded_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'pipeline_normalize_queue': {
+            'description': 'The number of broks lists waiting to be normalized by the ingestion pipeline',
+            'function': lambda item: datamgr.counters.count('pipeline_normalize_queue'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'pipeline_normalized_rate': {
+            'description': 'The averaged number of broks normalized by the ingestion pipeline per second',
+            'function': lambda item: datamgr.counters.count('pipeline_normalized_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'pipeline_write_queue': {
+            'description': 'The number of write batches waiting to be sent to the database by the ingestion pipeline',
+            'function': lambda item: datamgr.counters.count('pipeline_write_queue'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'pipeline_written_rate': {
+            'description': 'The averaged number of write operations sent by the ingestion pipeline per second',
+            'function': lambda item: datamgr.counters.count('pipeline_written_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'pipeline_stalls': {
+            'description': 'The number of times an ingestion pipeline stage waited for the next one to process its queue',
+            'function': lambda item: datamgr.counters.count('pipeline_stalls'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'query_plan_hits': {
+            'description': 'The number of queries answered with a cached query plan',
+            'function': lambda item: datamgr.counters.count('query_plan_hits'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'query_plan_hits_rate': {
+            'description': 'The averaged number of queries answered with a cached query plan per second',
+            'function': lambda item: datamgr.counters.count('query_plan_hits_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'query_plan_misses': {
+            'description': 'The number of queries that had to be parsed and compiled',
+            'function': lambda item: datamgr.counters.count('query_plan_misses'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'query_plan_misses_rate': {
+            'description': 'The averaged number of queries that had to be parsed and compiled per second',
+            'function': lambda item: datamgr.counters.count('query_plan_misses_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'overview_hits': {
+            'description': 'The number of queries answered from the in memory tactical overview counters',
+            'function': lambda item: datamgr.counters.count('overview_hits'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'overview_hits_rate': {
+            'description': 'The averaged number of queries answered from the in memory tactical overview counters per second',
+            'function': lambda item: datamgr.counters.count('overview_hits_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'overview_fallbacks': {
+            'description': 'The number of hosts and services Stats queries that had to be answered by an aggregation',
+            'function': lambda item: datamgr.counters.count('overview_fallbacks'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'overview_fallbacks_rate': {
+            'description': 'The averaged number of hosts and services Stats queries that had to be answered by an aggregation per second',
+            'function': lambda item: datamgr.counters.count('overview_fallbacks_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'response_rows': {
+            'description': 'The number of rows formatted in query responses',
+            'function': lambda item: datamgr.counters.count('response_rows'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'response_rows_rate': {
+            'description': 'The averaged number of rows formatted in query responses per second',
+            'function': lambda item: datamgr.counters.count('response_rows_rate'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'response_format_latency': {
+            'description': 'The average time in seconds spent reading and formatting a chunk of response rows',
+            'function': lambda item: datamgr.counters.average('response_format_time', 'response_chunks'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
+        'response_errors': {
+            'description': 'The number of query responses whose rows formatting failed',
+            'function': lambda item: datamgr.counters.count('response_errors'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
+        'cached_query_plans': {
+            'description': 'The current number of query plans kept in the plans cache',
+            'function': lambda item: len(datamgr.query_plans),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
+        },
         'cached_log_messages': {
             'description': 'The current number of log messages MK Livestatus keeps in memory',
             'function': lambda item: 0,  # No message cache
@@ -4323,15 +4462,26 @@ livestatus_attribute_map = {
             'description': 'The version of the MK Livestatus module',
             'function': lambda item: '2.0-shinken',
         },
+        'log_flush_latency': {
+            'description': 'The average time in seconds spent inserting a batch of log messages in the log store',
+            'function': lambda item: datamgr.counters.average('log_flush_time', 'log_flushes'),
+            'datatype': float,
+            'projection': [],
+            'filters': {},
+        },
         'log_messages': {
             'description': 'The number of new log messages since program start',
-            'function': lambda item: 0,  # REPAIRME
-            'datatype': float,
+            'function': lambda item: datamgr.counters.count('log_message'),
+            'datatype': int,
+            'projection': [],
+            'filters': {},
         },
         'log_messages_rate': {
             'description': 'The averaged number of log messages per second',
-            'function': lambda item: 0,  # REPAIRME
+            'function': lambda item: datamgr.counters.count('log_message_rate'),
             'datatype': float,
+            'projection': [],
+            'filters': {},
         },
         'nagios_pid': {
             'description': 'The process ID of the Nagios main process',
@@ -4516,3 +4666,26 @@ table_class_map = {
     'problems': livestatus_attribute_map['Problem'],
     'columns': livestatus_attribute_map['Config'],
 }
+
+
+def linked_attributes(table, link):
+    """
+    Returns the attributes of a linked object the table columns read,
+    either as projected or as filtered attributes
+
+    :param str table: The table name
+    :param str link: The linked object name, as used with `linked_attr`
+    :rtype: tuple
+    :return: The linked object attributes names
+    """
+    prefix = "__%s__." % link
+    attributes = set()
+    for mapping in table_class_map[table].values():
+        projection = mapping.get("projection", [])
+        if not isinstance(projection, list):
+            projection = [projection]
+        filter_attr = mapping.get("filters", {}).get("attr")
+        for attr in projection + [filter_attr]:
+            if attr and attr.startswith(prefix):
+                attributes.add(attr[len(prefix):])
+    return tuple(sorted(attributes))
@@ -54,15 +54,17 @@ LiveStatus = livestatus_broker.LiveStatus
 class LivestatusTestBase(ShinkenTest):
 
     cfg_file = 'etc/shinken_5r_10h_200s.cfg'
+    # Additional module configuration parameters
+    modconf_options = {}
 
     def init_livestatus(self):
-        modconf = Module({'module_name': 'LiveStatus2',
+        modconf = Module(dict({'module_name': 'LiveStatus2',
             'module_type': 'livestatus2',
             'port': str(50000 + os.getpid()),
             'host': '127.0.0.1',
             'socket': 'live',
             'name': 'test'
-        })
+        }.items() + self.modconf_options.items()))
 
         self.livestatus_broker = LiveStatus_broker(modconf)
         self.livestatus_broker.log = logger
@@ -116,6 +118,9 @@ class LivestatusTestBase(ShinkenTest):
         print("Query:")
         print(query)
         response, _ = self.livestatus_broker.livestatus.handle_request(query)
+        if isinstance(response, list):
+            # Streamed response
+            response = "".join(response)
         print("Response")
         print(response)
         pyresponse = eval(response)
@@ -12,7 +12,18 @@ for filename in \
 	test_modified_attributes.py \
 	test_problems.py \
 	test_timeperiods.py \
-	test_log.py
+	test_log.py \
+	test_bulk_write.py \
+	test_mongo_only.py \
+	test_normalize.py \
+	test_links.py \
+	test_bulk_load.py \
+	test_query_plans.py \
+	test_tactical_overview.py \
+	test_index_advisor.py \
+	test_response_streaming.py \
+	test_row_formatter.py \
+	test_response_encoders.py
 do
 	echo "==============================================================================="
 	echo "|"
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the initial broks loading through staging
+# collections.
+#
+
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    def test_bulk_load(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        self.sched.brokers['Default-Broker'] = {'broks' : [], 'has_full_broks' : False}
+        self.sched.fill_initial_broks('Default-Broker')
+        broks = self.sched.brokers['Default-Broker']['broks']
+        self.sched.brokers['Default-Broker']['broks'] = []
+        self.assertEqual(broks[-1].type, 'initial_broks_done')
+        instance_id = broks[-1].data['instance_id']
+        staging = datamgr.staging_format % ("hosts", instance_id)
+
+        query = """GET hosts
+Columns: name
+Filter: name = test_host_005
+OutputFormat: python
+"""
+        # An index created by the index advisor
+        datamgr.db.hosts.create_index(
+            [("state", 1)],
+            name="%sstate" % datamgr.advisor.prefix
+        )
+        datamgr.bulk_load = True
+        try:
+            for brok in broks[:-1]:
+                brok.prepare()
+                datamgr.manage_brok(brok)
+            # The live collections are untouched until the load is done
+            self.assertIn(staging, datamgr.db.collection_names())
+            self.assertEqual(
+                getattr(datamgr.db, staging).count(),
+                len(self.sched.hosts)
+            )
+            self.assertEqual(
+                datamgr.db.hosts.count({"instance_version": datamgr.instances[instance_id]}),
+                0
+            )
+            self.execute_and_assert(query, [['test_host_005']])
+
+            broks[-1].prepare()
+            datamgr.manage_brok(broks[-1])
+        finally:
+            datamgr.bulk_load = False
+
+        self.assertNotIn(staging, datamgr.db.collection_names())
+        self.assertEqual(datamgr.staging, {})
+        self.assertEqual(datamgr.db.hosts.count(), len(self.sched.hosts))
+        self.assertEqual(datamgr.db.services.count(), len(self.sched.services))
+        self.assertIn("host_name_1", datamgr.db.hosts.index_information())
+        self.assertIn(
+            "%sstate" % datamgr.advisor.prefix,
+            datamgr.db.hosts.index_information()
+        )
+        self.execute_and_assert(query, [['test_host_005']])
+
+        # Links are computed from the swapped in collections
+        service = datamgr.db.services.find_one(
+            {"_id": "test_host_005/test_ok_00"},
+            projection={"hostgroups": 1}
+        )
+        self.assertEqual(service["hostgroups"], ["flap", "hostgroup_01"])
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
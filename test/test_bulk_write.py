@@ -0,0 +1,203 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test brok ingestion through bulk writes.
+#
+
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase, livestatus_broker
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    def update_broker_bulk(self):
+        """
+        Sends the pending broks to the data manager as a single batch, as
+        the broker main loop does
+        """
+        broks = self.sched.brokers['Default-Broker']['broks']
+        for brok in broks:
+            brok.prepare()
+        self.livestatus_broker.datamgr.manage_broks(broks)
+        self.livestatus_broker.datamgr.flush()
+        self.sched.brokers['Default-Broker']['broks'] = []
+
+    def test_bulk_write(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 0, 'UP'])
+        for service in self.sched.services:
+            objlist.append([service, 0, 'OK'])
+        self.scheduler_loop(1, objlist)
+        self.update_broker_bulk()
+
+        svc1 = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_ok_00")
+        svc2 = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_ok_01")
+        self.scheduler_loop(3, [[svc1, 1, 'W'], [svc2, 2, 'C']])
+
+        writes = datamgr.counters.count('bulk_writes')
+        self.update_broker_bulk()
+        # Broks are grouped, there are much less writes than broks
+        self.assertGreater(datamgr.counters.average('bulk_operations', 'bulk_writes'), 1)
+        self.assertGreater(datamgr.counters.count('bulk_writes'), writes)
+
+        query = """GET services
+Columns: host_name description state state_type
+Filter: host_name = test_host_005
+Filter: description = test_ok_00
+Filter: description = test_ok_01
+Or: 2
+OutputFormat: python
+"""
+        expected_result = [
+            ['test_host_005', 'test_ok_00', 1, 1],
+            ['test_host_005', 'test_ok_01', 2, 1],
+        ]
+        self.execute_and_assert(query, expected_result)
+
+    def test_coalescing(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_ok_00")
+        self.scheduler_loop(3, [[svc, 2, 'C']])
+
+        updates = datamgr.counters.count('object_updates')
+        writes = datamgr.counters.count('object_writes')
+        self.update_broker_bulk()
+        updates = datamgr.counters.count('object_updates') - updates
+        writes = datamgr.counters.count('object_writes') - writes
+        # Each check produces several broks for the same service, which
+        # are merged into a single write
+        self.assertGreater(updates, writes)
+
+        query = """GET services
+Columns: host_name description state state_type
+Filter: host_name = test_host_005
+Filter: description = test_ok_00
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [['test_host_005', 'test_ok_00', 2, 1]])
+
+    def test_unchanged_attributes(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        host = self.sched.hosts.find_by_name("test_host_005")
+        self.scheduler_loop(1, [[host, 1, 'DOWN']])
+        broks = [
+            b for b in self.sched.brokers['Default-Broker']['broks']
+            if b.type == 'update_host_status'
+        ]
+        self.update_broker()
+        self.assertTrue(broks)
+
+        # The same brok does not change anything, no write is sent
+        skips = datamgr.counters.count('object_skips')
+        self.livestatus_broker.manage_brok(broks[-1])
+        self.assertEqual(datamgr.counters.count('object_skips'), skips + 1)
+
+        # Only the changed attribute is written
+        changed = datamgr.fingerprints.diff(
+            'hosts',
+            'test_host_005',
+            {'_id': 'test_host_005', 'state_id': 1, 'output': 'changed'}
+        )
+        self.assertEqual(changed, {'output': 'changed'})
+
+    def test_bulk_latency(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        host = self.sched.hosts.find_by_name("test_host_005")
+        self.scheduler_loop(1, [[host, 1, 'DOWN']])
+
+        bulk_size, bulk_latency = datamgr.bulk_size, datamgr.bulk_latency
+        datamgr.bulk_size = 100000
+        datamgr.bulk_latency = 3600
+        try:
+            broks = self.sched.brokers['Default-Broker']['broks']
+            for brok in broks:
+                brok.prepare()
+            datamgr.manage_broks(broks)
+            self.sched.brokers['Default-Broker']['broks'] = []
+            # Neither the batch size nor the latency are reached
+            self.assertGreater(datamgr.bulk_pending, 0)
+            datamgr.bulk_latency = 0
+            datamgr.flush_expired()
+            self.assertEqual(datamgr.bulk_pending, 0)
+        finally:
+            datamgr.bulk_size, datamgr.bulk_latency = bulk_size, bulk_latency
+
+        query = """GET hosts
+Columns: name state
+Filter: name = test_host_005
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [['test_host_005', 1]])
+
+    def test_ingestion_pipeline(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+
+        def decode(broks):
+            for brok in broks:
+                brok.prepare()
+
+        pipeline = livestatus_broker.IngestionPipeline(datamgr, decode, queue_size=1)
+        pipeline.start()
+        try:
+            host = self.sched.hosts.find_by_name("test_host_005")
+            svc = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_ok_00")
+            self.scheduler_loop(1, [[host, 1, 'DOWN'], [svc, 2, 'C']])
+            broks = self.sched.brokers['Default-Broker']['broks']
+            self.sched.brokers['Default-Broker']['broks'] = []
+            # Small lists to fill the queues
+            for i in range(0, len(broks), 5):
+                pipeline.put(broks[i:i + 5])
+        finally:
+            pipeline.stop()
+        self.assertIsNone(datamgr.batch_writer)
+        self.assertEqual(datamgr.bulk_pending, 0)
+        self.assertEqual(datamgr.counters.count('pipeline_decoded'), len(broks))
+        self.assertEqual(datamgr.counters.count('pipeline_normalized'), len(broks))
+        self.assertEqual(datamgr.counters.count('pipeline_decode_queue'), 0)
+
+        query = """GET services
+Columns: host_name description host_state state
+Filter: host_name = test_host_005
+Filter: description = test_ok_00
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [['test_host_005', 'test_ok_00', 1, 2]])
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
@@ -232,6 +232,67 @@ OutputFormat: python
 
         self.execute_and_assert(query, assert_host_services)
 
+    def test_pre_join_filters(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_005")
+        self.scheduler_loop(3, [[host, 2, 'DOWN']])
+        self.update_broker()
+
+        datamgr = self.livestatus_broker.datamgr
+        stack = datamgr.make_stack()
+        datamgr.add_filter_eq(stack, "comments", "host_state", "1")
+        datamgr.add_filter_eq(stack, "comments", "is_service", "0")
+        pipeline = datamgr.get_filter_query(
+            "comments", stack, ["host_name", "comment"])
+        # Base attributes are matched before the hosts $lookup, the
+        # host attributes right after it
+        self.assertEqual(
+            pipeline[0],
+            {"$match": {"is_service": {"$eq": False}}}
+        )
+        self.assertIn("$lookup", pipeline[1])
+        self.assertEqual(
+            pipeline[3],
+            {"$match": {"__host__.state_id": {"$eq": 1}}}
+        )
+
+        query = """GET services
+Columns: host_name description
+Filter: host_state = 1
+Filter: description = test_ok_00
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [["test_host_005", "test_ok_00"]])
+
+    def test_embedded_host(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        stack = datamgr.make_stack()
+        datamgr.add_filter_eq(stack, "services", "host_state", "1")
+        datamgr.add_filter_eq(stack, "services", "description", "test_ok_00")
+        # Host columns are read from the services documents
+        query = datamgr.get_filter_query(
+            "services", stack, ["host_name", "host_state", "host_alias"])
+        self.assertIsInstance(query, dict)
+
+        service = datamgr.db.services.find_one({"_id": "test_host_005/test_ok_00"})
+        self.assertEqual(service["__host__"]["alias"], "flap_005")
+
+        # Host changes are written to its services
+        host = self.sched.hosts.find_by_name("test_host_005")
+        self.scheduler_loop(3, [[host, 2, 'DOWN']])
+        self.update_broker()
+        service = datamgr.db.services.find_one({"_id": "test_host_005/test_ok_00"})
+        self.assertEqual(service["__host__"]["state_id"], 1)
+
+        query = """GET services
+Columns: host_name description host_state host_plugin_output
+Filter: host_state = 1
+Filter: description = test_ok_00
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [["test_host_005", "test_ok_00", 1, "DOWN"]])
+
     def test_cross_collections_hostgroups(self):
         self.print_header()
         now = time.time()
@@ -293,6 +354,36 @@ OutputFormat: python
         ]
         self.execute_and_assert(query_state, expected_result)
 
+    def test_materialized_states(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        columns = ["name", "num_services", "num_services_hard_crit", "worst_service_hard_state"]
+        # Services states counters are read from the groups documents
+        query = datamgr.get_filter_query("hostgroups", [], columns)
+        self.assertIsInstance(query, dict)
+
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_critical_11")
+        self.scheduler_loop(3, [[svc, 2, 'C']])
+        self.update_broker()
+
+        def get_expected(group):
+            services = list(datamgr.db.services.find({"hostgroups": group}))
+            crit = [s for s in services if s["state_type_id"] == 1 and s["state_id"] == 2]
+            return [group, len(services), len(crit), 2 if crit else 0]
+
+        query = """GET hostgroups
+Columns: %s
+Filter: name = hostgroup_01
+OutputFormat: python
+""" % " ".join(columns)
+        self.execute_and_assert(query, [get_expected("hostgroup_01")])
+
+        hostgroup = datamgr.db.hostgroups.find_one({"_id": "hostgroup_01"})
+        self.assertEqual(
+            sum(hostgroup["__services_states__"].values()),
+            datamgr.db.services.find({"hostgroups": "hostgroup_01"}).count()
+        )
+
     def test_cross_collections_servicegroup(self):
         self.print_header()
         now = time.time()
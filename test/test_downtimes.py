@@ -112,6 +112,66 @@ OutputFormat: python
         ]
         self.execute_and_assert(query, expected_result)
 
+    def test_unchanged_downtimes(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        host = self.sched.hosts.find_by_name("test_host_005")
+        duration = 6000
+        now = int(time.time())
+        end = now + duration
+        cmd = "[%lu] SCHEDULE_HOST_DOWNTIME;%s;%d;%d;1;0;%d;test_contact;dth" % \
+            (now, host.host_name, now, end, duration)
+        self.sched.run_external_command(cmd)
+        self.sched.update_downtimes_and_comments()
+        self.scheduler_loop(1, [[host, 0, 'UP']])
+        self.update_broker()
+
+        skips = datamgr.counters.count('side_skips')
+        self.scheduler_loop(2, [[host, 0, 'UP']])
+        self.update_broker()
+        # The downtime did not change, it is not written again
+        self.assertGreater(datamgr.counters.count('side_skips'), skips)
+
+        query = """GET downtimes
+Columns: host_name author comment start_time end_time duration
+Filter: host_name = test_host_005
+Filter: is_service = 0
+OutputFormat: python
+"""
+        expected_result = [
+            ['test_host_005', 'test_contact', 'dth', now, end, duration]
+        ]
+        self.execute_and_assert(query, expected_result)
+
+    def test_resync_downtimes(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_005")
+        duration = 6000
+        now = int(time.time())
+        end = now + duration
+        cmd = "[%lu] SCHEDULE_HOST_DOWNTIME;%s;%d;%d;1;0;%d;test_contact;dth" % \
+            (now, host.host_name, now, end, duration)
+        self.sched.run_external_command(cmd)
+        self.sched.update_downtimes_and_comments()
+        self.scheduler_loop(1, [[host, 0, 'UP']])
+        self.update_broker()
+
+        # The instance version is the re-sync time, in seconds
+        time.sleep(1.1)
+        self.sched.brokers['Default-Broker'] = {'broks' : [], 'has_full_broks' : False}
+        self.sched.fill_initial_broks('Default-Broker')
+        self.update_broker()
+
+        query = """GET downtimes
+Columns: host_name author comment start_time end_time duration
+Filter: host_name = test_host_005
+Filter: is_service = 0
+OutputFormat: python
+"""
+        expected_result = [
+            ['test_host_005', 'test_contact', 'dth', now, end, duration]
+        ]
+        self.execute_and_assert(query, expected_result)
 
 
 if __name__ == '__main__':
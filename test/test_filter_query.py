@@ -31,6 +31,8 @@ import time
 import unittest
 from pprint import pprint
 from livestatus_test import LivestatusTestBase
+# The module package is importable once livestatus_test has loaded it
+from module.livestatus_mongo_filters import FilterOptimizer
 
 sys.setcheckinterval(10000)
 
@@ -391,6 +393,224 @@ OutputFormat: python
 """
         self.execute_and_assert(query, negate_hosts_condition)
 
+    def test_index_backed_filters(self):
+        datamgr = self.livestatus_broker.datamgr
+
+        # Case insensitive equality uses the lowercase copy
+        stack = datamgr.make_stack()
+        datamgr.add_filter_eq_ci(stack, "hosts", "name", "TEST_host_001")
+        self.assertEqual(stack, [{"host_name__lower": {"$eq": "test_host_001"}}])
+
+        # Anchored regular expressions are completed by a range
+        stack = datamgr.make_stack()
+        datamgr.add_filter_reg(stack, "hosts", "name", "^test_host_00[0-9]")
+        self.assertEqual(stack[0]["$and"][:2], [
+            {"host_name": {"$gte": "test_host_00"}},
+            {"host_name": {"$lt": "test_host_01"}},
+        ])
+        stack = datamgr.make_stack()
+        datamgr.add_filter_reg_ci(stack, "hosts", "name", "^TEST_h?ost")
+        self.assertEqual(stack[0]["$and"][:2], [
+            {"host_name__lower": {"$gte": "test_"}},
+            {"host_name__lower": {"$lt": "test`"}},
+        ])
+        stack = datamgr.make_stack()
+        datamgr.add_filter_reg(stack, "hosts", "name", "^web|^db")
+        self.assertNotIn("$and", stack[0])
+
+        # Non ASCII references are lowercased and compared as unicode
+        stack = datamgr.make_stack()
+        datamgr.add_filter_eq_ci(stack, "hosts", "name", "CAF\xc3\x89")
+        self.assertEqual(stack, [{"host_name__lower": {"$eq": u"caf\xe9"}}])
+        stack = datamgr.make_stack()
+        datamgr.add_filter_reg(stack, "hosts", "name", "^caf\xc3\xa9")
+        self.assertEqual(stack[0]["$and"][:2], [
+            {"host_name": {"$gte": u"caf\xe9"}},
+            {"host_name": {"$lt": u"caf\xea"}},
+        ])
+        stack = datamgr.make_stack()
+        datamgr.add_filter_reg_ci(stack, "hosts", "name", "^CAF\xc3\x89")
+        self.assertEqual(stack[0]["$and"][:2], [
+            {"host_name__lower": {"$gte": u"caf\xe9"}},
+            {"host_name__lower": {"$lt": u"caf\xea"}},
+        ])
+
+        def assert_names(names):
+            def assert_result(result):
+                self.assertEqual(sorted([r[0] for r in result]), names)
+            return assert_result
+
+        names = ["test_host_%03d" % i for i in range(10)]
+        query = """GET hosts
+Columns: name
+Filter: name ~~ ^TEST_HOST_00
+OutputFormat: python
+"""
+        self.execute_and_assert(query, assert_names(names))
+
+        query = """GET hosts
+Columns: name
+Filter: name ~ ^test_host_00
+Filter: name ~ ^test_host_00
+Negate: 1
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [])
+
+        # Negated comparisons
+        query = """GET hosts
+Columns: name
+Filter: name =~ TEST_HOST_001
+Filter: max_check_attempts >= 5
+Negate: 1
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [])
+
+
+    def test_filter_optimization(self):
+        datamgr = self.livestatus_broker.datamgr
+
+        # Equalities on the same attribute are merged into $in
+        stack = datamgr.make_stack()
+        for i in range(10):
+            datamgr.add_filter_eq(stack, "hosts", "name", "test_host_%03d" % i)
+        datamgr.stack_filter_or(stack, "hosts", 10)
+        datamgr.add_filter_eq(stack, "hosts", "name", "test_host_001")
+        datamgr.add_filter_eq(stack, "hosts", "name", "test_host_002")
+        datamgr.stack_filter_or(stack, "hosts", 2)
+        datamgr.stack_filter_and(stack, "hosts", 2)
+        self.assertEqual(datamgr.optimize_filters("hosts", stack), [
+            {"host_name": {"$in": ["test_host_%03d" % i for i in range(10)]}},
+            {"host_name": {"$in": ["test_host_001", "test_host_002"]}},
+        ])
+
+        # Negations are pushed down when exact
+        stack = datamgr.make_stack()
+        datamgr.add_filter_eq(stack, "hosts", "state", 1)
+        datamgr.add_filter_eq(stack, "hosts", "state", 2)
+        datamgr.stack_filter_or(stack, "hosts", 2)
+        datamgr.stack_filter_negate(stack, 1)
+        self.assertEqual(stack, [
+            {"$nor": [{"$or": [{"state_id": {"$eq": 1}}, {"state_id": {"$eq": 2}}]}]}
+        ])
+        self.assertEqual(
+            datamgr.optimize_filters("hosts", stack),
+            [{"state_id": {"$nin": [1, 2]}}]
+        )
+
+        # Duplicates and tautologies are dropped
+        stack = datamgr.make_stack()
+        datamgr.add_filter_eq(stack, "hosts", "name", "test_host_001")
+        datamgr.add_filter_eq(stack, "hosts", "name", "test_host_001")
+        datamgr.add_filter_eq(stack, "hosts", "state", 1)
+        datamgr.add_filter_not_eq(stack, "hosts", "state", 1)
+        datamgr.stack_filter_or(stack, "hosts", 2)
+        self.assertEqual(
+            datamgr.optimize_filters("hosts", stack),
+            [{"host_name": {"$eq": "test_host_001"}}]
+        )
+
+        # Contradictions match nothing
+        stack = datamgr.make_stack()
+        datamgr.add_filter_eq(stack, "hosts", "name", "test_host_001")
+        datamgr.add_filter_eq(stack, "hosts", "name", "test_host_002")
+        self.assertIsNone(datamgr.optimize_filters("hosts", stack))
+        # Unless the attribute is a list
+        stack = datamgr.make_stack()
+        datamgr.add_filter_ge(stack, "hosts", "contacts", "test_contact")
+        datamgr.add_filter_ge(stack, "hosts", "contacts", "test_contact_02")
+        self.assertIsNotNone(datamgr.optimize_filters("hosts", stack))
+
+        query = """GET hosts
+Columns: name
+Filter: name = test_host_001
+Filter: name = test_host_002
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [])
+
+        query = """GET hosts
+Columns: name
+Filter: name = test_host_001
+Filter: name = test_host_002
+Filter: name = test_host_003
+Or: 3
+Filter: name = test_host_003
+Negate: 1
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [["test_host_001"], ["test_host_002"]])
+
+        query = """GET hosts
+Filter: name = test_host_001
+Filter: name = test_host_002
+Stats: state = 0
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [])
+
+        query = """GET hosts
+Filter: name = test_host_001
+Stats: state = 0
+Stats: state = 0
+Stats: state = 1
+StatsAnd: 2
+OutputFormat: python
+"""
+        def assert_stats(result):
+            # The contradictory stat is not computed
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result[0][1], 0)
+
+        self.execute_and_assert(query, assert_stats)
+
+    def test_filter_optimization_types(self):
+        datamgr = self.livestatus_broker.datamgr
+        optimizer = FilterOptimizer(datamgr.get_scalar_attributes("hosts"))
+
+        # str and unicode strings of a same text are equal
+        self.assertEqual(
+            optimizer.optimize({"$and": [
+                {"host_name": "test_host_001"},
+                {"host_name": u"test_host_001"},
+            ]}),
+            {"host_name": "test_host_001"}
+        )
+        self.assertIsNone(optimizer.optimize({"$and": [
+            {"host_name": "h\xc3\xb4te"},
+            {"host_name": {"$ne": u"h\xf4te"}},
+        ]}))
+        self.assertEqual(
+            optimizer.optimize({"$or": [
+                {"host_name": "test_host_001"},
+                {"host_name": u"test_host_001"},
+                {"host_name": "test_host_002"},
+            ]}),
+            {"host_name": {"$in": ["test_host_001", "test_host_002"]}}
+        )
+
+        # Numbers are equal by value, booleans are not numbers
+        self.assertEqual(
+            optimizer.optimize({"$and": [
+                {"state_id": 1},
+                {"state_id": 1.0},
+            ]}),
+            {"state_id": 1}
+        )
+        self.assertEqual(
+            optimizer.optimize({"$or": [
+                {"state_id": 1},
+                {"state_id": 1L},
+                {"state_id": 1.0},
+                {"state_id": 2},
+            ]}),
+            {"state_id": {"$in": [1, 2]}}
+        )
+        self.assertIsNone(optimizer.optimize({"$and": [
+            {"state_id": True},
+            {"state_id": 1},
+        ]}))
 
 if __name__ == '__main__':
     unittest.main()
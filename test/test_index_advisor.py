@@ -0,0 +1,146 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the index advisor.
+#
+
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    def setUp(self):
+        super(LivestatusTest, self).setUp()
+        self.datamgr = self.livestatus_broker.datamgr
+        self.advisor = self.datamgr.advisor
+        self.advisor.clear()
+
+    def tearDown(self):
+        self.datamgr.managed_indexes = 0
+        self.advisor.clear()
+        for name, index in self.datamgr.db.services.index_information().items():
+            if name.startswith(self.advisor.prefix):
+                self.datamgr.db.services.drop_index(name)
+        super(LivestatusTest, self).tearDown()
+
+    def get_suggestion(self, keys):
+        for suggestion in self.advisor.get_suggestions():
+            if suggestion["keys"] == keys:
+                return suggestion
+        self.fail("No suggestion for %s" % keys)
+
+    def test_suggestions(self):
+        self.print_header()
+        query = """GET services
+Columns: host_name description
+Filter: host_name = %s
+Filter: state >= 0
+OutputFormat: python
+"""
+        for name in ("test_host_001", "test_host_005", "test_host_005"):
+            self.execute_and_assert(query % name, lambda result: None)
+
+        # Equality, sort, then range attributes
+        suggestion = self.get_suggestion(
+            [("host_name", 1), ("_id", 1), ("state_id", 1)])
+        self.assertEqual(suggestion["collection"], "services")
+        self.assertEqual(suggestion["queries"], 3)
+        self.assertIsNone(suggestion["partial"])
+
+        # Boolean attributes always compared to the same value are part of
+        # the partial filter
+        query = """GET services
+Columns: host_name description
+Filter: host_name = test_host_005
+Filter: acknowledged = 0
+OutputFormat: python
+"""
+        self.execute_and_assert(query, lambda result: None)
+        suggestion = self.get_suggestion([("host_name", 1), ("_id", 1)])
+        self.assertEqual(
+            suggestion["partial"],
+            {"problem_has_been_acknowledged": False}
+        )
+
+        # Queries served by the _id index are not recorded
+        self.execute_and_assert("""GET services
+Columns: host_name
+OutputFormat: python
+""", lambda result: None)
+        self.assertEqual(len(self.advisor), 2)
+
+        def assert_report(report):
+            self.assertEqual(len(report["suggestions"]), 2)
+            for suggestion in report["suggestions"]:
+                self.assertFalse(suggestion["existing"])
+                self.assertGreater(suggestion["selectivity"], 0)
+                self.assertLess(suggestion["selectivity"], 0.5)
+            names = [i["name"] for i in report["indexes"]]
+            self.assertIn("_id_", names)
+            self.assertIn("host_name_1", names)
+
+        self.execute_and_assert("""GET status
+Explain: indexes
+OutputFormat: python
+""", assert_report)
+
+    def test_managed_indexes(self):
+        self.print_header()
+        query = """GET services
+Columns: host_name description
+Filter: host_name = test_host_005
+Filter: state >= 1
+OutputFormat: python
+"""
+        self.execute_and_assert(query, lambda result: None)
+        suggestion = self.advisor.get_suggestions()[0]
+
+        self.datamgr.managed_indexes = 1
+        self.datamgr.manage_indexes()
+        indexes = self.datamgr.db.services.index_information()
+        self.assertIn(suggestion["name"], indexes)
+        self.assertTrue(self.datamgr.get_indexes_report()["suggestions"][0]["existing"])
+
+        # Not suggested anymore, and unused
+        self.advisor.clear()
+        self.execute_and_assert(query.replace(
+            "host_name = test_host_005", "description = test_ok_00"),
+            lambda result: None)
+        created, dropped = self.advisor.manage(self.datamgr.db, 0)
+        self.assertEqual(created, [])
+        self.assertEqual(dropped, [suggestion["name"]])
+        indexes = self.datamgr.db.services.index_information()
+        self.assertNotIn(suggestion["name"], indexes)
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the groups and contacts links maintenance.
+#
+
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    def get_hostgroup_members(self, group_name):
+        return sorted([
+            h.host_name for h in self.sched.hosts
+            if group_name in [hg.get_name() for hg in h.hostgroups]
+        ])
+
+    def test_hostgroups_links(self):
+        self.print_header()
+        query = """GET hostgroups
+Columns: name members
+Filter: name = hostgroup_01
+OutputFormat: python
+"""
+        members = self.get_hostgroup_members("hostgroup_01")
+        self.assertIn("test_host_005", members)
+        self.execute_and_assert(query, [["hostgroup_01", members]])
+
+    def test_contacts_links(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        contact = datamgr.db.contacts.find_one(
+            {"_id": "test_contact"},
+            projection={"hosts": 1, "services": 1}
+        )
+        hosts = sorted([
+            h.host_name for h in self.sched.hosts
+            if "test_contact" in [c.get_name() for c in h.contacts]
+        ])
+        services = sorted([
+            s.get_full_name() for s in self.sched.services
+            if "test_contact" in [c.get_name() for c in s.contacts]
+        ])
+        self.assertEqual(contact["hosts"], hosts)
+        self.assertEqual(contact["services"], services)
+
+    def test_incremental_links(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        host = self.sched.hosts.find_by_name("test_host_005")
+        self.scheduler_loop(1, [[host, 0, 'UP']])
+        broks = [
+            b for b in self.sched.brokers['Default-Broker']['broks']
+            if b.type == 'update_host_status'
+        ]
+        self.sched.brokers['Default-Broker']['broks'] = []
+        self.assertTrue(broks)
+        brok = broks[0]
+        brok.prepare()
+        old_groups = [hg.get_name() for hg in host.hostgroups]
+        brok.data["hostgroups"] = ["hostgroup_02"]
+
+        datamgr.manage_brok(brok, flush=False)
+        # Only the groups the host left or joined are recomputed
+        self.assertEqual(
+            datamgr.links.dirty["hostgroups"],
+            set(old_groups + ["hostgroup_02"])
+        )
+        datamgr.flush()
+
+        query = """GET hostgroups
+Columns: name members
+Filter: name = hostgroup_01
+Filter: name = hostgroup_02
+Or: 2
+OutputFormat: python
+"""
+        members_01 = self.get_hostgroup_members("hostgroup_01")
+        members_01.remove("test_host_005")
+        members_02 = sorted(self.get_hostgroup_members("hostgroup_02") + ["test_host_005"])
+        self.execute_and_assert(query, [
+            ["hostgroup_01", members_01],
+            ["hostgroup_02", members_02],
+        ])
+        service = datamgr.db.services.find_one(
+            {"_id": "test_host_005/test_ok_00"},
+            projection={"hostgroups": 1}
+        )
+        self.assertEqual(service["hostgroups"], ["hostgroup_02"])
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
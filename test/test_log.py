@@ -28,6 +28,7 @@
 
 import sys
 import time
+import datetime
 import unittest
 from pprint import pprint
 from livestatus_test import LivestatusTestBase
@@ -114,6 +115,57 @@ OutputFormat: python"""
 
         self.execute_and_assert(query, assert_log)
 
+    def test_log_bulk_insert(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_critical_11")
+        self.scheduler_loop(3, [[svc, 2, 'C']])
+        broks = self.sched.brokers['Default-Broker']['broks']
+        self.sched.brokers['Default-Broker']['broks'] = []
+        for brok in broks:
+            brok.prepare()
+        lines = len([b for b in broks if b.type == 'log'])
+        self.assertGreater(lines, 1)
+
+        messages = datamgr.counters.count('log_message')
+        flushes = datamgr.counters.count('log_flushes')
+        datamgr.manage_broks(broks)
+        datamgr.flush()
+        self.assertEqual(datamgr.counters.count('log_message') - messages, lines)
+        # All the lines are inserted at once
+        self.assertEqual(datamgr.counters.count('log_flushes') - flushes, 1)
+
+        query = """GET log
+Columns: type host_name service_description state state_type
+Filter: host_name = test_host_005
+Filter: service_description = test_critical_11
+Filter: type = SERVICE ALERT
+OutputFormat: python"""
+        expected_result = [
+            ['SERVICE ALERT', 'test_host_005', 'test_critical_11', 2, 'SOFT'],
+            ['SERVICE ALERT', 'test_host_005', 'test_critical_11', 2, 'HARD'],
+        ]
+        self.execute_and_assert(query, expected_result)
+
+    def test_log_retention(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_critical_11")
+        self.scheduler_loop(1, [[svc, 2, 'C']])
+        self.update_broker()
+        datamgr.log_retention = 3600
+        try:
+            datamgr.create_log_store()
+            indexes = datamgr.db.log.index_information()
+            self.assertIn("date_1", indexes)
+            self.assertEqual(indexes["date_1"]["expireAfterSeconds"], 3600)
+        finally:
+            datamgr.log_retention = 0
+            datamgr.db.log.drop_index("date_1")
+        log = datamgr.db.log.find_one({"host_name": "test_host_005"})
+        self.assertEqual(log["date"], datetime.datetime.utcfromtimestamp(log["time"]))
+
+
 if __name__ == '__main__':
     #import cProfile
     command = """unittest.main()"""
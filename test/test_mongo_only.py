@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to compare brok ingestion with and without the in
+# memory regenerator, on a big configuration.
+#
+
+import gc
+import os
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase, livestatus_broker
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    cfg_file = 'etc/shinken_5r_100h_2000s.cfg'
+    modconf_options = {'mongo_only': '1'}
+
+    def get_initial_broks(self):
+        """
+        Generates a fresh set of initial broks
+        """
+        self.sched.brokers['Default-Broker'] = {'broks' : [], 'has_full_broks' : False}
+        self.sched.fill_initial_broks('Default-Broker')
+        broks = self.sched.brokers['Default-Broker']['broks']
+        self.sched.brokers['Default-Broker']['broks'] = []
+        return broks
+
+    def ingest(self, regenerator=None):
+        """
+        Feeds the initial broks to the data manager, and to the regenerator
+        if any, as the broker main loop does
+
+        :rtype: tuple
+        :return: The consumed CPU time, and the number of objects still
+                 allocated after ingestion
+        """
+        datamgr = self.livestatus_broker.datamgr
+        datamgr.fingerprints.clear()
+        broks = self.get_initial_broks()
+        gc.collect()
+        objects = len(gc.get_objects())
+        start = os.times()
+        for brok in broks:
+            brok.prepare()
+            if regenerator is not None:
+                regenerator.manage_brok(brok)
+        datamgr.manage_broks(broks)
+        datamgr.flush()
+        end = os.times()
+        del broks
+        gc.collect()
+        cpu = (end[0] + end[1]) - (start[0] + start[1])
+        return cpu, len(gc.get_objects()) - objects
+
+    def test_no_regenerator(self):
+        self.print_header()
+        self.assertTrue(self.livestatus_broker.mongo_only)
+        self.assertIsNone(self.livestatus_broker.rg)
+
+        query = """GET hosts
+Columns: name
+Filter: name = test_host_099
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [['test_host_099']])
+
+    def test_want_brok(self):
+        self.print_header()
+        broks = self.get_initial_broks()
+        # Initial broks are needed to fill the database
+        self.assertTrue(all([self.livestatus_broker.want_brok(b) for b in broks]))
+        brok = broks[0]
+        brok.type = 'unknown_brok_type'
+        self.assertFalse(self.livestatus_broker.want_brok(brok))
+
+    def test_compare_regenerator(self):
+        self.print_header()
+        rg = livestatus_broker.LiveStatusRegenerator(False, True)
+        rg.register_cache(livestatus_broker.LiveStatusQueryCache())
+        rg_cpu, rg_objects = self.ingest(rg)
+        mongo_cpu, mongo_objects = self.ingest()
+        print("With regenerator: %.2fs CPU, %d objects allocated" % (rg_cpu, rg_objects))
+        print("Mongo only:       %.2fs CPU, %d objects allocated" % (mongo_cpu, mongo_objects))
+        # The regenerator keeps a graph of all the hosts and services
+        self.assertGreater(rg_objects, mongo_objects)
+        del rg
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test and benchmark the brok values normalization.
+#
+
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+
+sys.setcheckinterval(10000)
+
+
+def probing_normalize(datamgr, obj):
+    """
+    Normalizes a value probing its attributes at each call, the way it was
+    done before normalizers were cached per type. Used as a reference.
+    """
+    if hasattr(obj, "get_full_name"):
+        return obj.get_full_name()
+    elif hasattr(obj, "get_name"):
+        return obj.get_name()
+    elif hasattr(obj, "weekdays"):
+        return datamgr.normalize_daterange(obj)
+    elif isinstance(obj, list):
+        return [probing_normalize(datamgr, o) for o in obj]
+    elif isinstance(obj, dict):
+        return dict([
+            (k, probing_normalize(datamgr, v)) for k, v in obj.items()
+        ])
+    elif hasattr(obj, "properties"):
+        properties = ["id"]
+        properties.extend(getattr(obj, "properties", {}).keys())
+        properties.extend(getattr(obj, "running_properties", {}).keys())
+        return dict([
+            (p, getattr(obj, p, "")) for p in properties
+        ])
+    else:
+        return obj
+
+
+class LivestatusTest(LivestatusTestBase):
+
+    def get_payloads(self):
+        """
+        Returns the data of the initial broks and of the status broks of a
+        scheduler loop
+        """
+        self.sched.brokers['Default-Broker'] = {'broks' : [], 'has_full_broks' : False}
+        self.sched.fill_initial_broks('Default-Broker')
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 1, 'DOWN'])
+        for service in self.sched.services:
+            objlist.append([service, 2, 'CRITICAL'])
+        self.scheduler_loop(1, objlist)
+        broks = self.sched.brokers['Default-Broker']['broks']
+        self.sched.brokers['Default-Broker']['broks'] = []
+        for brok in broks:
+            brok.prepare()
+        return [brok.data for brok in broks]
+
+    def test_normalize(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        for data in self.get_payloads():
+            self.assertEqual(
+                datamgr.normalize(data),
+                probing_normalize(datamgr, data)
+            )
+
+    def test_normalize_benchmark(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        payloads = self.get_payloads()
+        values = sum([len(data) for data in payloads])
+        rounds = 20
+
+        start = time.time()
+        for i in range(rounds):
+            for data in payloads:
+                for value in data.values():
+                    probing_normalize(datamgr, value)
+        probing = time.time() - start
+
+        start = time.time()
+        for i in range(rounds):
+            for data in payloads:
+                for value in data.values():
+                    datamgr.normalize(value)
+        cached = time.time() - start
+
+        print("Normalized %d broks (%d values) %d times" % (len(payloads), values, rounds))
+        print("Attributes probing:  %.3fs" % probing)
+        print("Cached normalizers:  %.3fs" % cached)
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
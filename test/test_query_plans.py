@@ -0,0 +1,210 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the query plans cache.
+#
+
+import sys
+import json
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+# The module package is importable once livestatus_test has loaded it
+from module.livestatus_mongo_response import LiveStatusResponse
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    def setUp(self):
+        super(LivestatusTest, self).setUp()
+        self.plans = self.livestatus_broker.datamgr.query_plans
+        self.plans.clear()
+
+    def tearDown(self):
+        self.plans.maxsize = 500
+        self.plans.clear()
+        super(LivestatusTest, self).tearDown()
+
+    def get_counts(self):
+        counters = self.livestatus_broker.datamgr.counters
+        return (
+            counters.count("query_plan_hits"),
+            counters.count("query_plan_misses"),
+        )
+
+    def test_plan_reused(self):
+        self.print_header()
+        query = """GET hosts
+Columns: name state
+Filter: name = test_host_005
+OutputFormat: python
+Localtime: %d
+"""
+        hits, misses = self.get_counts()
+        def assert_name(result):
+            self.assertEqual(result[0][0], "test_host_005")
+
+        self.execute_and_assert(query % time.time(), assert_name)
+        self.assertEqual(self.get_counts(), (hits, misses + 1))
+        self.assertEqual(len(self.plans), 1)
+
+        # The cached plan holds the query, not its result
+        host = self.sched.hosts.find_by_name("test_host_005")
+        self.scheduler_loop(3, [[host, 2, 'DOWN']])
+        self.update_broker()
+
+        # Localtime is not part of the plan key
+        self.execute_and_assert(query % (time.time() + 1), [["test_host_005", 1]])
+        self.assertEqual(self.get_counts(), (hits + 1, misses + 1))
+        self.assertEqual(len(self.plans), 1)
+
+        plan = self.plans.plans.values()[0]
+        self.assertIn("hosts", plan.queries)
+        self.assertIsNotNone(plan.formatter)
+
+        # The cached formatter does not keep the response alive
+        pending = list(plan.formatter.getters)
+        while pending:
+            value = pending.pop()
+            self.assertNotIsInstance(value, LiveStatusResponse)
+            self.assertNotIsInstance(getattr(value, "im_self", None), LiveStatusResponse)
+            for cell in getattr(value, "__closure__", None) or ():
+                pending.append(cell.cell_contents)
+
+    def test_response_headers(self):
+        self.print_header()
+        query = """GET hosts
+Columns: name
+Filter: name = test_host_005
+OutputFormat: %s
+"""
+        self.execute_and_assert(query % "python", [["test_host_005"]])
+        response, _ = self.livestatus_broker.livestatus.handle_request(
+            query % "json")
+        self.assertEqual(response.strip(), '[["test_host_005"]]')
+        response, _ = self.livestatus_broker.livestatus.handle_request(
+            query % "python")
+        self.assertEqual(eval(response), [["test_host_005"]])
+        self.assertEqual(len(self.plans), 2)
+
+    def test_stats_plan(self):
+        self.print_header()
+        query = """GET services
+Stats: state = 0
+Stats: state = 2
+OutputFormat: python
+"""
+        def assert_stats(result):
+            self.assertEqual(len(result), 1)
+            self.assertEqual(len(result[0]), 2)
+
+        hits, misses = self.get_counts()
+        self.execute_and_assert(query, assert_stats)
+        self.execute_and_assert(query, assert_stats)
+        self.assertEqual(self.get_counts(), (hits + 1, misses + 1))
+        plan = self.plans.plans.values()[0]
+        # Both stats are computed by a single query
+        self.assertEqual(len(plan.queries["services"][-1]["$facet"]), 2)
+
+    def test_lru_eviction(self):
+        self.print_header()
+        self.plans.maxsize = 2
+        query = """GET hosts
+Columns: name
+Filter: name = %s
+OutputFormat: python
+"""
+        for name in ("test_host_001", "test_host_002", "test_host_001",
+                     "test_host_003"):
+            self.execute_and_assert(query % name, [[name]])
+        # test_host_002 plan was the least recently used one
+        self.assertEqual(
+            self.plans.plans.keys(),
+            [(query % name).strip() for name in ("test_host_001", "test_host_003")]
+        )
+
+    def test_cache_disabled(self):
+        self.print_header()
+        self.plans.maxsize = 0
+        query = """GET hosts
+Columns: name
+Filter: name = test_host_001
+OutputFormat: python
+"""
+        hits, misses = self.get_counts()
+        self.execute_and_assert(query, [["test_host_001"]])
+        self.execute_and_assert(query, [["test_host_001"]])
+        self.assertEqual(self.get_counts(), (hits, misses))
+        self.assertEqual(len(self.plans), 0)
+
+
+    def test_explain(self):
+        self.print_header()
+        query = """GET hosts
+Columns: name state
+Filter: name = test_host_005
+OutputFormat: python
+"""
+        self.execute_and_assert(query, [["test_host_005", 0]])
+
+        def assert_explain(result):
+            self.assertEqual(result["table"], "hosts")
+            self.assertEqual(result["rows"], 1)
+            # The explained query reuses the plan of the query
+            self.assertTrue(result["cached_plan"])
+            self.assertEqual(len(result["queries"]), 1)
+            explained = result["queries"][0]
+            self.assertEqual(explained["method"], "find")
+            self.assertIn("test_host_005", json.dumps(explained["query"]["filter"]))
+            self.assertIn("queryPlanner", explained["explain"])
+            self.assertIn("executionStats", explained["explain"])
+            for name in ("parse", "plan", "execute", "format", "respond"):
+                self.assertGreaterEqual(result["timings"][name], 0)
+
+        self.execute_and_assert(query + "Explain: on\n", assert_explain)
+        self.execute_and_assert(query + "Explain: 1\n", assert_explain)
+        self.assertEqual(len(self.plans), 1)
+
+        query = """GET services
+Filter: host_name = test_host_005
+Stats: state = 0
+Stats: max state
+OutputFormat: json
+Explain: on
+"""
+        response, _ = self.livestatus_broker.livestatus.handle_request(query)
+        result = json.loads(response)
+        self.assertFalse(result["cached_plan"])
+        explained = result["queries"][0]
+        self.assertEqual(explained["method"], "aggregate")
+        self.assertIn("$facet", explained["query"][-1])
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
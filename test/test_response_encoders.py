@@ -0,0 +1,191 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test and benchmark the output formats encoders.
+#
+
+import sys
+import csv
+import json
+import time
+import unittest
+from StringIO import StringIO
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+# The module package is importable once livestatus_test has loaded it
+from module.livestatus_mongo_query import LiveStatusQuery
+from module import livestatus_mongo_encoders as encoders
+
+sys.setcheckinterval(10000)
+
+
+def reference_encode(response, rows):
+    """
+    Encodes rows the way it was done before the encoders were used, with
+    the stdlib json module and a csv writer per response. Used as a
+    reference.
+    """
+    if response.outputformat == "json":
+        return json.dumps(rows)
+    elif response.outputformat.startswith("python"):
+        return repr(rows)
+    else:
+        f = StringIO()
+        writer = csv.writer(f,
+            delimiter=response.separators.field,
+            lineterminator=response.separators.line
+        )
+        writer.writerows([
+            [response._format_csv_value(value) for value in row]
+            for row in rows
+        ])
+        return f.getvalue()
+
+
+class LivestatusTest(LivestatusTestBase):
+
+    columns = [
+        "host_name", "description", "state", "state_type", "last_check",
+        "plugin_output", "acknowledged", "is_flapping", "contacts",
+        "groups", "notifications_enabled", "scheduled_downtime_depth",
+    ]
+
+    def setUp(self):
+        super(LivestatusTest, self).setUp()
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 0, 'UP'])
+        for service in self.sched.services:
+            objlist.append([service, 2, 'CRITICAL'])
+        self.scheduler_loop(1, objlist)
+        self.update_broker()
+        self.items = list(self.livestatus_broker.datamgr.db.services.find())
+
+    def get_response(self, outputformat):
+        query = LiveStatusQuery(self.livestatus_broker.datamgr)
+        query.parse_input("GET services\nOutputFormat: %s\n" % outputformat)
+        query.response.load(query)
+        return query.response
+
+    def get_rows(self, response, count=None):
+        formatter = response.compile_formatter(self.columns)
+        items = self.items
+        if count is not None:
+            items = items * (count / len(items) + 1)
+            items = items[:count]
+        return [formatter(item) for item in items]
+
+    def test_encoders(self):
+        self.print_header()
+        for outputformat in ("csv", "json", "python"):
+            response = self.get_response(outputformat)
+            rows = self.get_rows(response)
+            encoder = encoders.get_encoder(outputformat, response.separators)
+            # Concatenated chunks
+            half = len(rows) / 2
+            encoded = encoder.encode(rows[:half], True, False) + \
+                encoder.encode(rows[half:], False, False) + \
+                encoder.encode([], False, True)
+            self.assertEqual(encoded, encoder.encode(rows))
+            if outputformat == "json":
+                self.assertEqual(json.loads(encoded), rows)
+            elif outputformat == "python":
+                self.assertEqual(eval(encoded), rows)
+            else:
+                self.assertEqual(encoded, reference_encode(response, rows))
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_formats(self):
+        self.print_header()
+        datamgr = self.livestatus_broker.datamgr
+        query = """GET services
+Columns: %s
+ColumnHeaders: on
+ResponseHeader: fixed16
+OutputFormat: %%s
+""" % " ".join(self.columns)
+        response, _ = self.livestatus_broker.livestatus.handle_request(query % "python")
+        expected = eval(response.split("\n", 1)[1])
+        datamgr.response_chunk_size = 7
+        try:
+            for outputformat in ("msgpack", "msgpack_columns"):
+                response, _ = self.livestatus_broker.livestatus.handle_request(query % outputformat)
+                header, body = "".join(response).split("\n", 1)
+                self.assertEqual(header, "200 %11d" % len(body))
+                unpacker = msgpack.Unpacker(raw=False)
+                unpacker.feed(body[:-1])
+                objects = list(unpacker)
+                self.assertEqual(objects[0], self.columns)
+                if outputformat == "msgpack":
+                    rows = objects
+                else:
+                    # Column blocks of the rows of each chunk
+                    rows = objects[:1]
+                    for block in objects[1:]:
+                        self.assertEqual(len(block), len(self.columns))
+                        rows.extend([list(row) for row in zip(*block)])
+                self.assertEqual(rows, expected)
+        finally:
+            datamgr.response_chunk_size = 1000
+
+    def test_encoders_benchmark(self):
+        self.print_header()
+        print("Json backend: %s" % encoders.dumps.__module__)
+        outputformats = ["csv", "json", "python"]
+        if msgpack is not None:
+            outputformats.extend(["msgpack", "msgpack_columns"])
+        for outputformat in outputformats:
+            response = self.get_response(outputformat)
+            rows = self.get_rows(response, 20000)
+            chunk_size = response.chunk_size
+
+            start = time.time()
+            if outputformat.startswith("msgpack"):
+                # Compared to the json encoding
+                json.dumps(rows)
+            else:
+                reference_encode(response, rows)
+            reference = time.time() - start
+
+            start = time.time()
+            encoder = encoders.get_encoder(outputformat, response.separators)
+            for i in range(0, len(rows), chunk_size):
+                encoder.encode(rows[i:i + chunk_size], i == 0, False)
+            encoder.encode([], False, True)
+            encoded = time.time() - start
+
+            print("Encoded %d services x %d columns in %s" % (len(rows), len(self.columns), outputformat))
+            print("Reference: %.3fs (%d rows/s)" % (reference, len(rows) / reference))
+            print("Encoder:   %.3fs (%d rows/s)" % (encoded, len(rows) / encoded))
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
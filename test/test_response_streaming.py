@@ -0,0 +1,210 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the responses streaming.
+#
+
+import sys
+import zlib
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+# The module package is importable once livestatus_test has loaded it
+from module.livestatus_client_thread import LiveStatusClientThread, Error
+from module.livestatus_query_error import LiveStatusQueryError
+from module.livestatus_response import LiveStatusListResponse
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    def setUp(self):
+        super(LivestatusTest, self).setUp()
+        self.datamgr = self.livestatus_broker.datamgr
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 0, 'UP'])
+        for service in self.sched.services:
+            objlist.append([service, 0, 'OK'])
+        self.scheduler_loop(1, objlist)
+        self.update_broker()
+
+    def tearDown(self):
+        self.datamgr.response_chunk_size = 1000
+        self.datamgr.response_spool_size = 10485760
+        self.datamgr.response_compression_min_size = 1024
+        super(LivestatusTest, self).tearDown()
+
+    def handle_request(self, query, chunk_size):
+        self.datamgr.response_chunk_size = chunk_size
+        response, _ = self.livestatus_broker.livestatus.handle_request(query)
+        return response
+
+    def test_streamed_formats(self):
+        self.print_header()
+        for outputformat in ("csv", "json", "python"):
+            query = """GET services
+Columns: host_name description state
+ColumnHeaders: on
+OutputFormat: %s
+""" % outputformat
+            whole = self.handle_request(query, 100000)
+            self.assertIsInstance(whole, str)
+            streamed = self.handle_request(query, 7)
+            self.assertIsInstance(streamed, list)
+            self.assertEqual("".join(streamed), whole)
+        rows = eval(whole)
+        self.assertEqual(rows[0], ["host_name", "description", "state"])
+        self.assertEqual(len(rows), len(self.sched.services) + 1)
+
+    def test_chunk_boundary(self):
+        self.print_header()
+        query = """GET hosts
+Columns: name
+OutputFormat: python
+"""
+        hosts = len(self.sched.hosts)
+        whole = self.handle_request(query, 100000)
+        for chunk_size in (1, hosts - 1, hosts):
+            streamed = self.handle_request(query, chunk_size)
+            self.assertEqual("".join(streamed), whole)
+        self.assertEqual(len(eval(whole)), hosts)
+
+    def test_streamed_fixed16(self):
+        self.print_header()
+        query = """GET services
+Columns: host_name description
+OutputFormat: json
+ResponseHeader: fixed16
+"""
+        whole = self.handle_request(query, 100000)
+        for spool_size in (10485760, 100):
+            # Spooled in memory, then to a temporary file
+            self.datamgr.response_spool_size = spool_size
+            streamed = self.handle_request(query, 7)
+            self.assertIsInstance(streamed, list)
+            streamed = "".join(streamed)
+            self.assertEqual(streamed, whole)
+            header, body = streamed.split("\n", 1)
+            self.assertEqual(header, "200 %11d" % (len(body) + 1))
+
+    def test_compressed_responses(self):
+        self.print_header()
+        query = """GET services
+Columns: host_name description plugin_output
+OutputFormat: json
+"""
+        whole = self.handle_request(query, 100000)
+        for compression, wbits in (("zlib", 15), ("gzip", 31)):
+            for chunk_size in (100000, 7):
+                compressed = self.handle_request(
+                    query + "Compression: %s\n" % compression,
+                    chunk_size
+                )
+                compressed = "".join(compressed)
+                self.assertLess(len(compressed), len(whole))
+                self.assertEqual(zlib.decompress(compressed, wbits), whole)
+
+                response = self.handle_request(
+                    query + "Compression: %s\nResponseHeader: fixed16\n" % compression,
+                    chunk_size
+                )
+                header, body = "".join(response).split("\n", 1)
+                # The length is the one of the compressed body
+                self.assertEqual(header, "200 %11d" % len(body))
+                self.assertEqual(body[-1], "\n")
+                self.assertEqual(zlib.decompress(body[:-1], wbits), whole)
+
+        # Small responses are stored without being compressed
+        self.datamgr.response_compression_min_size = len(whole) + 1
+        compressed = self.handle_request(query + "Compression: zlib\n", 100000)
+        self.assertGreater(len(compressed), len(whole))
+        self.assertEqual(zlib.decompress(compressed), whole)
+
+    def test_late_errors(self):
+        self.print_header()
+        query = """GET hosts
+Columns: name notes
+OutputFormat: json
+"""
+        mapping = self.datamgr.mapping["hosts"]
+        notes = mapping["notes"]
+        calls = []
+        def failing(item):
+            calls.append(item)
+            if len(calls) > 3:
+                raise ValueError("late failure")
+            return ""
+        mapping["notes"] = dict(notes, function=failing)
+        self.datamgr.query_plans.clear()
+        counters = self.datamgr.counters
+        errors = counters.count("response_errors")
+        try:
+            # The first two chunks are formatted before the response is
+            # returned, the failing row is only formatted while it is sent
+            streamed = self.handle_request(query, 1)
+            self.assertIsInstance(streamed, list)
+            self.assertEqual(len(calls), 2)
+
+            class Client(object):
+                def __init__(self):
+                    self.sent = []
+                def _send_data(self, data):
+                    self.sent.append(data)
+            client = Client()
+            send_response = LiveStatusClientThread.send_response.im_func
+            self.assertRaises(
+                Error.ResponseAborted,
+                send_response, client, streamed
+            )
+            self.assertEqual(len(client.sent), 3)
+            self.assertEqual(counters.count("response_errors"), errors + 1)
+
+            # The error is still reported if nothing has been sent
+            def failed():
+                raise LiveStatusQueryError(500, "failed")
+                yield ""
+            self.assertRaises(
+                LiveStatusQueryError,
+                send_response, Client(), LiveStatusListResponse([failed()])
+            )
+
+            # The fixed16 responses are spooled, and report it
+            del calls[:]
+            response = "".join(
+                self.handle_request(query + "ResponseHeader: fixed16\n", 1)
+            )
+            self.assertTrue(response.startswith("500"))
+            self.assertIn("late failure", response)
+        finally:
+            mapping["notes"] = notes
+            self.datamgr.query_plans.clear()
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
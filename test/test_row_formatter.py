@@ -0,0 +1,151 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test and benchmark the compiled row formatter.
+#
+
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+# The module package is importable once livestatus_test has loaded it
+from module.livestatus_mongo_query import LiveStatusQuery
+from module.livestatus_query_error import LiveStatusQueryError
+
+sys.setcheckinterval(10000)
+
+
+def per_cell_format(response, item, columns):
+    """
+    Formats an item looking each cell mapping up, the way it was done
+    before formatters were compiled. Used as a reference.
+    """
+    row = []
+    for column in columns:
+        mapping = response.query.mapping[response.query.table][column]
+        attr = mapping.get('filters', {}).get('attr', column)
+        try:
+            if "function" in mapping:
+                value = mapping["function"](item)
+            elif "datatype" in mapping:
+                datatype = mapping["datatype"]
+                default = datatype()
+                value = item.get(attr, default)
+                value = datatype(value)
+            else:
+                value = item.get(attr, "")
+            row.append(value)
+        except Exception as e:
+            raise LiveStatusQueryError(
+                500,
+                "failed to map value %s/%s: %s" %
+                (response.query.table, column, e)
+            )
+    return row
+
+
+class LivestatusTest(LivestatusTestBase):
+
+    def setUp(self):
+        super(LivestatusTest, self).setUp()
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 0, 'UP'])
+        for service in self.sched.services:
+            objlist.append([service, 2, 'CRITICAL'])
+        self.scheduler_loop(1, objlist)
+        self.update_broker()
+        self.items = list(self.livestatus_broker.datamgr.db.services.find())
+
+    def get_response(self, outputformat):
+        query = LiveStatusQuery(self.livestatus_broker.datamgr)
+        query.parse_input("GET services\nOutputFormat: %s\n" % outputformat)
+        query.response.load(query)
+        return query.response
+
+    def get_columns(self, response, count=None):
+        """
+        Returns the services columns the items can be formatted with
+        """
+        columns = []
+        for column in sorted(response.query.mapping["services"].keys()):
+            try:
+                for item in self.items:
+                    per_cell_format(response, item, [column])
+            except Exception:
+                continue
+            columns.append(column)
+        return columns[:count]
+
+    def test_row_formatter(self):
+        self.print_header()
+        response = self.get_response("python")
+        columns = self.get_columns(response)
+        formatter = response.compile_formatter(columns)
+        for item in self.items:
+            self.assertEqual(
+                formatter(item),
+                per_cell_format(response, item, columns)
+            )
+
+        response = self.get_response("csv")
+        formatter = response.compile_formatter(columns)
+        for item in self.items:
+            self.assertEqual(
+                formatter(item),
+                [
+                    response._format_csv_value(value) for value in
+                    per_cell_format(response, item, columns)
+                ]
+            )
+
+    def test_row_formatter_benchmark(self):
+        self.print_header()
+        response = self.get_response("python")
+        columns = self.get_columns(response, 30)
+        items = self.items * (20000 / len(self.items) + 1)
+        items = items[:20000]
+
+        start = time.time()
+        for item in items:
+            per_cell_format(response, item, columns)
+        per_cell = time.time() - start
+
+        start = time.time()
+        formatter = response.compile_formatter(columns)
+        for item in items:
+            formatter(item)
+        compiled = time.time() - start
+
+        print("Formatted %d services x %d columns" % (len(items), len(columns)))
+        print("Per cell mapping lookups: %.3fs (%d rows/s)" % (per_cell, len(items) / per_cell))
+        print("Compiled formatter:       %.3fs (%d rows/s)" % (compiled, len(items) / compiled))
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()
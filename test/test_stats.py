@@ -580,6 +580,61 @@ OutputFormat: python"""
         self.execute_and_assert(query, assert_in)
 
 
+    def test_single_pass_stats(self):
+        self.print_header()
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 0, 'UP'])
+        for service in self.sched.services:
+            objlist.append([service, 0, 'OK'])
+        self.scheduler_loop(1, objlist)
+        svc1 = self.sched.services.find_srv_by_name_and_hostname("test_host_001", "test_warning_19")
+        svc2 = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_critical_11")
+        self.scheduler_loop(1, [[svc1, 1, 'W'], [svc2, 2, 'C']])
+        self.update_broker()
+
+        datamgr = self.livestatus_broker.datamgr
+        for columns in (None, ["host_name"]):
+            filters = datamgr.make_stack()
+            datamgr.add_filter_gt(filters, "services", "state", 0)
+            stats = []
+            for state in (1, 2):
+                stack = datamgr.make_stack()
+                datamgr.add_filter_eq(stack, "services", "state", state)
+                stats.append(stack.pop())
+            datamgr.add_aggregation_max(stats, "services", "state", columns)
+            datamgr.add_aggregation_sum(stats, "services", "host_state", columns)
+
+            # One query gives the results of each per stat query
+            query = datamgr.get_stats_query("services", filters, stats, columns)
+            facets = list(datamgr.aggregate("services", query))
+            self.assertEqual(len(facets), 1)
+            # Running each stat separately gives the same results
+            separate = list(datamgr.iter_stats_facets("services", query))
+            for i, stat in enumerate(stats):
+                expected = [
+                    result
+                    for document in separate
+                    for result in document.get("s%d" % i, [])
+                ]
+                key = lambda r: sorted((r["group"] or {}).items())
+                self.assertEqual(
+                    sorted(facets[0]["s%d" % i], key=key),
+                    sorted(expected, key=key)
+                )
+
+        query = """GET services
+Filter: state > 0
+Columns: host_name
+Stats: state = 1
+Stats: state = 2
+Stats: max state
+OutputFormat: python"""
+        self.execute_and_assert(query, [
+            ["test_host_001", 1, 0, 1],
+            ["test_host_005", 0, 1, 2],
+        ])
+
 if __name__ == '__main__':
     #import cProfile
     command = """unittest.main()"""
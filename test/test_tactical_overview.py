@@ -0,0 +1,206 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Sebastien Coavoux, s.coavoux@free.fr
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the tactical overview counters.
+#
+
+import sys
+import time
+import unittest
+from pprint import pprint
+from livestatus_test import LivestatusTestBase
+
+sys.setcheckinterval(10000)
+
+class LivestatusTest(LivestatusTestBase):
+
+    def setUp(self):
+        super(LivestatusTest, self).setUp()
+        self.overview = self.livestatus_broker.datamgr.overview
+        now = time.time()
+        objlist = []
+        for host in self.sched.hosts:
+            objlist.append([host, 0, 'UP'])
+        for service in self.sched.services:
+            objlist.append([service, 0, 'OK'])
+        self.scheduler_loop(1, objlist)
+        self.update_broker()
+        svc1 = self.sched.services.find_srv_by_name_and_hostname("test_host_001", "test_warning_19")
+        svc2 = self.sched.services.find_srv_by_name_and_hostname("test_host_003", "test_warning_03")
+        svc3 = self.sched.services.find_srv_by_name_and_hostname("test_host_000", "test_critical_03")
+        svc4 = self.sched.services.find_srv_by_name_and_hostname("test_host_005", "test_critical_11")
+        svc5 = self.sched.services.find_srv_by_name_and_hostname("test_host_007", "test_critical_02")
+        self.scheduler_loop(3, [[svc1, 1, 'W'], [svc2, 1, 'W'], [svc3, 2, 'C'], [svc4, 3, 'U'], [svc5, 2, 'C']])
+        host1 = self.sched.hosts.find_by_name("test_host_005")
+        self.scheduler_loop(3, [[host1, 1, 'D']])
+        cmd = "[%lu] ACKNOWLEDGE_HOST_PROBLEM;test_host_005;1;1;1;test_contact;ackh" % now
+        self.sched.run_external_command(cmd)
+        for service in (svc1, svc3):
+            cmd = "[%lu] ACKNOWLEDGE_SVC_PROBLEM;%s;%s;1;1;1;test_contact;acks" % \
+                (now, service.host_name, service.service_description)
+            self.sched.run_external_command(cmd)
+        self.scheduler_loop(1, [], do_sleep=False)
+        self.update_broker()
+
+    def tearDown(self):
+        self.overview.enabled = True
+        super(LivestatusTest, self).tearDown()
+
+    def get_counts(self):
+        counters = self.livestatus_broker.datamgr.counters
+        return (
+            counters.count("overview_hits"),
+            counters.count("overview_fallbacks"),
+        )
+
+    def get_aggregation_result(self, query):
+        self.overview.enabled = False
+        try:
+            response, _ = self.livestatus_broker.livestatus.handle_request(query)
+        finally:
+            self.overview.enabled = True
+        return eval(response)
+
+    def assert_same_result(self, query, answered=True):
+        """
+        Asserts the query result is the same with and without the counters
+        """
+        expected = self.get_aggregation_result(query)
+        hits, fallbacks = self.get_counts()
+        self.execute_and_assert(query, expected)
+        if answered:
+            self.assertEqual(self.get_counts(), (hits + 1, fallbacks))
+        else:
+            self.assertEqual(self.get_counts(), (hits, fallbacks + 1))
+        return expected
+
+    def test_services_overview(self):
+        self.print_header()
+        self.assertTrue(self.overview.is_ready())
+        query = """GET services
+Stats: state = 0
+Stats: state = 1
+Stats: state = 2
+Stats: state = 3
+OutputFormat: python"""
+        result = self.assert_same_result(query)
+        self.assertEqual(result[0][1:], [2, 2, 1])
+
+        # Unhandled problems
+        query = """GET services
+Filter: state_type = 1
+Stats: state = 1
+Stats: acknowledged = 0
+StatsAnd: 2
+Stats: state = 2
+Stats: acknowledged = 0
+Stats: scheduled_downtime_depth = 0
+StatsAnd: 3
+Stats: state = 2
+Stats: acknowledged = 1
+StatsOr: 2
+Stats: checks_enabled = 0
+OutputFormat: python"""
+        self.assert_same_result(query)
+
+        query = """GET services
+Filter: state > 0
+Filter: state != 3
+Stats: acknowledged = 1
+Stats: acknowledged = 1
+StatsNegate:
+Stats: has_been_checked = 1
+OutputFormat: python"""
+        self.assert_same_result(query)
+
+        # No object matches
+        query = """GET services
+Filter: state = 4
+Stats: state = 4
+OutputFormat: python"""
+        self.assertEqual(self.assert_same_result(query), [])
+
+    def test_hosts_overview(self):
+        self.print_header()
+        query = """GET hosts
+Stats: state = 0
+Stats: state = 1
+Stats: state = 1
+Stats: acknowledged = 1
+StatsAnd: 2
+Stats: is_flapping = 1
+Stats: notifications_enabled = 0
+Stats: accept_passive_checks = 1
+OutputFormat: python"""
+        result = self.assert_same_result(query)
+        self.assertEqual(result[0][1:3], [1, 1])
+
+    def test_fallback(self):
+        self.print_header()
+        # Grouped stats
+        query = """GET services
+Columns: host_name
+Filter: state > 0
+Stats: state = 1
+OutputFormat: python"""
+        self.assert_same_result(query, answered=False)
+
+        # Attributes that are not counted
+        query = """GET services
+Stats: host_state = 0
+Stats: state = 0
+OutputFormat: python"""
+        self.assert_same_result(query, answered=False)
+
+        query = """GET services
+Filter: host_name = test_host_005
+Stats: state = 3
+OutputFormat: python"""
+        self.assertEqual(self.assert_same_result(query, answered=False), [[1]])
+
+        # Other aggregations
+        query = """GET services
+Stats: max state
+OutputFormat: python"""
+        self.assert_same_result(query, answered=False)
+
+    def test_incremental_update(self):
+        self.print_header()
+        query = """GET services
+Stats: state = 2
+Stats: acknowledged = 1
+OutputFormat: python"""
+        before = self.assert_same_result(query)
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_002", "test_ok_00")
+        self.scheduler_loop(3, [[svc, 2, 'C']])
+        self.update_broker()
+        after = self.assert_same_result(query)
+        self.assertEqual(after[0][0], before[0][0] + 1)
+
+
+if __name__ == '__main__':
+    #import cProfile
+    command = """unittest.main()"""
+    unittest.main()